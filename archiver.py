@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+"""
+Background archiver of finished task logs
+"""
+import datetime
+import glob
+import logging
+import os
+import tarfile
+import threading
+import time
+from typing import Dict, List
+
+
+class LogArchiver:
+    """
+    Packs finished task logs (log_archive/*.txt) into
+    daily rolling archives log_archive_<date>_<number>.tar.gz
+    Runs when 'archive_batch' tasks have finished
+    or every 'archive_interval' seconds
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.archive_dir = config['log_dir'] + 'log_archive/'
+        self.batch = int(config.get('archive_batch', 50))
+        self.interval = float(config.get('archive_interval', 3600))
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.finished = 0
+        self.archived = 0
+        self.archives = 0
+        self.last_flush = time.monotonic()
+
+    def notify(self) -> None:
+        """
+        Task completion event (the task log is in the archive directory)
+        """
+        with self.lock:
+            self.finished += 1
+            due = self.finished >= self.batch
+        if due:
+            self.wake.set()
+
+    def finished_logs(self) -> List[str]:
+        """
+        Finished task logs
+
+        Returns:
+            (list): Log file names
+        """
+        return sorted(name for name in os.listdir(self.archive_dir)
+                      if name.endswith('.txt'))
+
+    def next_path(self) -> str:
+        """
+        Path of the next archive of the day
+
+        Returns:
+            (str): Archive path
+        """
+        prefix = self.archive_dir + 'log_archive_' + \
+            datetime.datetime.today().strftime('%Y-%m-%d') + '_'
+        number = len(glob.glob(prefix + '*.tar.gz')) + 1
+        while os.path.exists(prefix + f'{number:03d}' + '.tar.gz'):
+            number += 1
+        return prefix + f'{number:03d}' + '.tar.gz'
+
+    def archive(self, names: List[str]) -> str:
+        """
+        Streams logs into a new archive,
+        the logs are deleted after the archive is written to disk
+
+        Args:
+            names (list): Log file names
+
+        Returns:
+            (str): Archive path
+        """
+        path = self.next_path()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as archive_f:
+            with tarfile.open(fileobj=archive_f, mode='w:gz') as tar:
+                for name in names:
+                    tar.add(self.archive_dir + name, arcname=name)
+            archive_f.flush()
+            os.fsync(archive_f.fileno())
+        os.replace(tmp_path, path)
+        for name in names:
+            os.remove(self.archive_dir + name)
+        self.archived += len(names)
+        self.archives += 1
+        return path
+
+    def flush(self, force: bool = False) -> None:
+        """
+        Archives the finished logs if there are enough of them
+
+        Args:
+            force (bool): Archive any number of logs
+        """
+        names = self.finished_logs()
+        if names and (force or len(names) >= self.batch):
+            with self.lock:
+                self.finished = 0
+            self.archive(names)
+            self.last_flush = time.monotonic()
+
+    def run(self) -> None:
+        """
+        Archiver loop
+        """
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.flush(time.monotonic() - self.last_flush >=
+                           self.interval)
+            # Catch all ¯\_(ツ)_/¯
+            except Exception:
+                logging.exception('Task log archiving failed')
+
+    def start(self) -> None:
+        """
+        Starts the archiver thread
+        """
+        threading.Thread(target=self.run,
+                         name='psec_archiver',
+                         daemon=True).start()
+
+    def report(self) -> Dict[str, str]:
+        """
+        Archiver statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        return {
+            'Archived task logs': str(self.archived),
+            'Log archives written': str(self.archives),
+        }
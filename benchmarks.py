@@ -0,0 +1,335 @@
+#! /usr/bin/env python3
+"""
+Offline benchmarks
+"""
+import datetime
+import random
+import re
+import tempfile
+import time
+from typing import Any, List, Tuple
+
+from mac_extract import extract_macs
+from service_funcs import (clearing_message,
+                           create_sql_query,
+                           find_macs_in_mess)
+from syslog_db import SyslogDB
+
+
+def random_mac() -> str:
+    """
+    Random MAC-address (without separators)
+    """
+    return '%012x' % random.getrandbits(48)
+
+
+def fill_syslog_db(db: SyslogDB, rows: int, macs: List[str]) -> None:
+    """
+    Generates today's SystemEvents rows
+    (port-security violations for 'macs' and random noise)
+
+    Args:
+        db (SyslogDB): SQLite stand-in of the log server DB
+        rows (int): Number of rows
+        macs (list): MAC-addresses that get a violation event
+    """
+    start = datetime.datetime.combine(datetime.date.today(),
+                                      datetime.time(8))
+    step = rows // len(macs)
+    data = []
+    for number in range(rows):
+        if number % step == 0 and macs:
+            mac = macs.pop()
+        else:
+            mac = random_mac()
+        mac_cisco = mac[:4] + '.' + mac[4:8] + '.' + mac[8:12]
+        data.append((start + datetime.timedelta(seconds=number % 36000),
+                     '10.0.' + str(number % 200) + '.1',
+                     '%PORT_SECURITY-2-PSECURE_VIOLATION: Security violation '
+                     'occurred, caused by MAC address ' + mac_cisco +
+                     ' on port GigabitEthernet1/0/' + str(number % 48 + 1)))
+    with db.connection() as conn:
+        conn.executemany('INSERT INTO SystemEvents (DeviceReportedTime, '
+                         'FromHost, Message) VALUES (?, ?, ?)', data)
+
+
+def old_sql_query(macs: List[str]) -> Tuple[str, List[Any]]:
+    """
+    Query of the previous version: LIKE on the report time
+    and REGEXP on the message, no index can serve them
+
+    Args:
+        macs (list): Device MAC-addresses
+
+    Returns:
+        (str): SQL query
+        (list): Query parameters
+    """
+    macs_cisco = [re.escape(mac[:4] + '.' + mac[4:8] + '.' + mac[8:12])
+                  for mac in macs]
+    return ('SELECT ID, FromHost, Message, DeviceReportedTime '
+            'FROM SystemEvents WHERE DeviceReportedTime LIKE %s '
+            'AND Message REGEXP %s ORDER BY ID DESC',
+            ['%' + datetime.date.today().strftime('%Y-%m-%d') + '%',
+             '(' + '|'.join(macs_cisco) + ')'])
+
+
+def old_find_macs_in_mess(decoded_message: str) -> str:
+    """
+    MAC search of the previous version: the regex is compiled
+    on every call, matches are cleaned by a chain of replaces
+
+    Args:
+        decoded_message (str): Decoded message from email
+
+    Returns:
+        (str): Device MAC-address or an error
+    """
+    reg = re.compile(r'\s(?P<mac>([0-9A-Fa-fАаВСсЕеOО]{2}[\s:.-]){5}'
+                     r'([0-9A-Fa-fАаВСсЕеOО]{2})'
+                     r'|([0-9A-Fa-fАаВСсЕеOО]{3}[\s:.-]){3}'
+                     r'([0-9A-Fa-fАаВСсЕеOО]{3})'
+                     r'|([([0-9A-Fa-fАаВСсЕеOО]{4}[\s:.-]){2}'
+                     r'([0-9A-Fa-fАаВСсЕеOО]{4})'
+                     r'|([0-9A-Fa-fАаВСсЕеOО]{12}))\s')
+    format_matches = []
+    for mat in reg.finditer(decoded_message):
+        match = mat.group('mac')
+        match = match.replace(':', "").replace('-', "").replace('.', "") \
+                     .replace(' ', "").replace('\n', "").replace('\t', "")
+        match = match.lower()
+        match = match.replace('а', 'a').replace('в', 'b').replace('с', 'c') \
+                     .replace('е', 'e').replace('о', '0').replace('o', '0')
+        format_matches.append(match)
+    if len(format_matches) == 1:
+        return format_matches[0]
+    elif len(format_matches) == 0:
+        return 'No MAC addresses found\r\n\r\nTask failed'
+    return 'To many matches\r\n\r\nTask failed'
+
+
+def ticket_corpus(tickets: int) -> List[str]:
+    """
+    Ticket messages as users write them: a greeting, the MAC-address
+    in one of the usual notations (sometimes typed in the Cyrillic layout),
+    a phone number and a signature
+
+    Args:
+        tickets (int): Number of messages
+
+    Returns:
+        (list): Decoded messages
+    """
+    notations = [lambda mac: ':'.join(mac[i:i + 2] for i in range(0, 12, 2)),
+                 lambda mac: '-'.join(mac[i:i + 2] for i in range(0, 12, 2)),
+                 lambda mac: '.'.join(mac[i:i + 4] for i in range(0, 12, 4)),
+                 lambda mac: mac.upper(),
+                 lambda mac: mac.upper().replace('A', 'А').replace('0', 'О'),
+                 lambda mac: ' '.join(mac[i:i + 3] for i in range(0, 12, 3))]
+    greetings = ['Добрый день!', 'Здравствуйте,', 'Коллеги, привет.', '']
+    bodies = ['Прошу подключить принтер в кабинете 305, MAC-адрес: {}',
+              'Не работает сеть на ПК {} после переезда, порт 1/0/7',
+              'Новый IP-телефон\r\nMAC {}\r\nинв. номер 004512',
+              'Просьба разблокировать порт для устройства {} , '
+              'заявка от отдела кадров']
+    signatures = ['С уважением,\r\nИванов И.И.\r\nтел. 8 (495) 123-45-67',
+                  '--\r\nPetrov P.\r\nEngineer, IT dept.\r\n+7 916 555 0101',
+                  'Спасибо!',
+                  'С уважением,\r\nСидорова А.\r\n\r\n' +
+                  'Это сообщение и любые приложения к нему содержат '
+                  'конфиденциальную информацию и предназначены только для '
+                  'адресата. Если вы получили его по ошибке, сообщите '
+                  'отправителю и удалите сообщение. ' * 3]
+    corpus = []
+    for number in range(tickets):
+        mac = random_mac()
+        corpus.append(random.choice(greetings) + '\r\n\r\n' +
+                      random.choice(bodies).format(
+                          random.choice(notations)(mac)) +
+                      '\r\n\r\n' + random.choice(signatures) + '\r\n')
+    return corpus
+
+
+def bench_mac_extract(tickets: int = 20000) -> None:
+    """
+    MAC search of the previous version against the compiled extractor
+    (one call per message and the batch API)
+
+    Args:
+        tickets (int): Number of ticket messages
+    """
+    corpus = ticket_corpus(tickets)
+    start = time.perf_counter()
+    old = [old_find_macs_in_mess(message) for message in corpus]
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = [find_macs_in_mess(message) for message in corpus]
+    new_time = time.perf_counter() - start
+    start = time.perf_counter()
+    batch = extract_macs(corpus)
+    batch_time = time.perf_counter() - start
+    same = sum(1 for old_mac, new_mac in zip(old, new) if old_mac == new_mac)
+    print(f'MAC extraction: {tickets} tickets')
+    print(f'  old find_macs_in_mess: {old_time:.3f} s')
+    print(f'  new find_macs_in_mess: {new_time:.3f} s '
+          f'({same} equal results)')
+    print(f'  extract_macs (batch):  {batch_time:.3f} s '
+          f'({sum(len(found) for found in batch)} candidates)')
+
+
+def old_clearing_message(message: str) -> str:
+    """
+    Message clearing of the previous version (one regex over the body)
+
+    Args:
+        message (str): Decoded message from email
+
+    Returns:
+        (str): Cleared message
+    """
+    clean_mess = re.sub(r'<[\s\S|.]*?>|&nbsp;|&quot;|.*?;}', '', message)
+    return re.sub(r'(\r\n){5,}', '\r\n', clean_mess)
+
+
+def outlook_body(paragraphs: int) -> str:
+    """
+    HTML body as Outlook writes it: a style block,
+    long lines of inline CSS and a MAC-address in the middle
+
+    Args:
+        paragraphs (int): Number of paragraphs
+
+    Returns:
+        (str): HTML body
+    """
+    style = ('<style><!--\r\n' +
+             ''.join('p.MsoNormal' + str(number) + ', li.MsoNormal' +
+                     str(number) + ' {margin:0cm; font-size:11.0pt; '
+                     'font-family:"Calibri",sans-serif}\r\n'
+                     for number in range(50)) + '--></style>\r\n')
+    paragraph = ('<p class="MsoNormal" style="margin:0cm;font-size:11.0pt;'
+                 'font-family:&quot;Calibri&quot;,sans-serif;color:#1F497D;'
+                 'mso-fareast-language:RU">Просьба подключить '
+                 'устройство&nbsp;в&nbsp;кабинете&nbsp;305<o:p></o:p></p>')
+    body = [paragraph * 20 + '\r\n' for number in range(paragraphs)]
+    body.insert(paragraphs // 2, '<p> 0912.AB34.0009 </p>\r\n')
+    return '<html><head>' + style + '</head><body>' + ''.join(body) + \
+        '</body></html>'
+
+
+def bench_clearing(size: int = 200000) -> None:
+    """
+    Old message clearing against the linear one on pathological bodies:
+    a large Outlook HTML mail, long lines without ';}'
+    and many unclosed '<' (the last two are kept small,
+    the old clearing is quadratic on them)
+
+    Args:
+        size (int): Approximate size of the Outlook body in characters
+    """
+    bodies = [('Outlook HTML', outlook_body(size // 5000)),
+              ('long lines without ";}"',
+               ('color:#1F497D; font-size:11.0pt ' * 300 + '\r\n') * 3),
+              ('unclosed "<"', 'a < b ' * 2000)]
+    print('message clearing:')
+    for name, body in bodies:
+        start = time.perf_counter()
+        old = old_clearing_message(body)
+        old_time = time.perf_counter() - start
+        start = time.perf_counter()
+        new = clearing_message({'message': body}, 0)['message']
+        new_time = time.perf_counter() - start
+        print(f'  {name} ({len(body)} characters):')
+        print(f'    old: {old_time:.3f} s ({len(old)} characters left)')
+        print(f'    new: {new_time:.3f} s ({len(new)} characters left)')
+
+
+def query_plan(db: SyslogDB, query: str, params: List[Any]) -> str:
+    """
+    SQLite query plan
+
+    Args:
+        db (SyslogDB): SQLite stand-in of the log server DB
+        query (str): SQL query
+        params (list): Query parameters
+
+    Returns:
+        (str): Query plan steps
+    """
+    rows = db.execute('EXPLAIN QUERY PLAN ' + query, params)
+    return '; '.join(row[-1] for row in rows)
+
+
+def bench_syslog_db(rows: int = 20000, waiting: int = 150) -> None:
+    """
+    One query per waiting MAC on a new connection (old behaviour)
+    against one batched query on a pooled connection
+
+    Args:
+        rows (int): Number of SystemEvents rows
+        waiting (int): Number of waiting MACs
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = {'db_backend': 'sqlite',
+                  'db_path': tmp_dir + '/syslog.db',
+                  'db_pool_size': 1}
+        db = SyslogDB(config)
+        macs = [random_mac() for number in range(waiting)]
+        fill_syslog_db(db, rows, list(macs))
+        start = time.perf_counter()
+        for mac in macs:
+            single = SyslogDB(config)
+            single.events(*old_sql_query([mac]))
+            single.close()
+        per_mac = time.perf_counter() - start
+        start = time.perf_counter()
+        found = db.events(*old_sql_query(macs))
+        batched = time.perf_counter() - start
+        db.close()
+    print(f'syslog db: {rows} rows, {waiting} waiting MACs')
+    print(f'  per-MAC queries, new connection: {per_mac:.3f} s')
+    print(f'  one batched query, pooled:       {batched:.3f} s '
+          f'({len(found)} events)')
+
+
+def bench_syslog_cursor(rows: int = 200000,
+                        new_rows: int = 1000,
+                        waiting: int = 150
+                        ) -> None:
+    """
+    Old full-day query against the ID cursor query
+    (a poll after 'new_rows' rows were added)
+
+    Args:
+        rows (int): Number of SystemEvents rows
+        new_rows (int): Rows added since the previous poll
+        waiting (int): Number of waiting MACs
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = SyslogDB({'db_backend': 'sqlite',
+                       'db_path': tmp_dir + '/syslog.db',
+                       'db_pool_size': 1})
+        macs = [random_mac() for number in range(waiting)]
+        fill_syslog_db(db, rows, list(macs))
+        max_id = db.execute('SELECT MAX(ID) FROM SystemEvents')[0][0]
+        queries = [('old (LIKE + REGEXP)', old_sql_query(macs)),
+                   ('new (ID cursor + time range)',
+                    create_sql_query(macs, max_id - new_rows, max_id)),
+                   ('new MACs (today before the cursor)',
+                    create_sql_query(macs, 0, max_id - new_rows))]
+        print(f'syslog cursor: {rows} rows, {new_rows} new rows, '
+              f'{waiting} waiting MACs')
+        for name, (query, params) in queries:
+            start = time.perf_counter()
+            found = db.events(query, params)
+            elapsed = time.perf_counter() - start
+            print(f'  {name}: {elapsed:.3f} s ({len(found)} events)')
+            print(f'    plan: {query_plan(db, query, params)}')
+        db.close()
+
+
+if __name__ == '__main__':
+    bench_syslog_db()
+    bench_syslog_cursor()
+    bench_mac_extract()
+    bench_clearing()
@@ -6,13 +6,122 @@ import datetime
 import logging
 import re
 import time
-from typing import Any, Dict
-
-from netmiko import ConnectHandler
+from typing import Any, Dict, List, NamedTuple, Optional
 
+from command_timing import CommandTimer
+from commit_scheduler import get_scheduler
+from metrics import timed
+from service_funcs import end_task
+from ssh_pool import get_pool
+from worker_pool import check_cancelled
 from wrapp_class import Wrapp
 
 
+def short_port(port: str) -> str:
+    """
+    Short interface name as in 'sh port-security address'
+
+    Args:
+        port (str): Interface name (GigabitEthernet1/0/7)
+
+    Returns:
+        (str): Short name (Gi1/0/7)
+    """
+    match_num = re.search(r'\d', port)
+    if match_num is None:
+        return port
+    return port[:2] + port[match_num.start():]
+
+
+class InterfaceConfig(NamedTuple):
+    """
+    Interface section of the running config
+    """
+    name: str
+    text: str
+    access: bool
+    maximum: int
+    sticky_macs: List[str]
+
+    @property
+    def hub(self) -> bool:
+        """
+        Several devices are allowed on the port (a hub is connected)
+        """
+        return self.maximum > 1
+
+
+class RunningConfig:
+    """
+    Interface index of the running config
+    (one parse, then dictionary lookups by interface and sticky MAC)
+    """
+    def __init__(self, sh_run: str) -> None:
+        """
+        Args:
+            sh_run (str): Running config ('interface' sections)
+        """
+        self.interfaces: Dict[str, InterfaceConfig] = {}
+        self.macs: Dict[str, List[str]] = {}
+        name = ''
+        lines: List[str] = []
+        for line in sh_run.splitlines():
+            if line.startswith('interface '):
+                self.add(name, lines)
+                name = line.split()[1]
+                lines = [line]
+            elif line.startswith(' ') and name:
+                lines.append(line)
+            else:
+                self.add(name, lines)
+                name = ''
+                lines = []
+        self.add(name, lines)
+
+    def add(self, name: str, lines: List[str]) -> None:
+        """
+        Indexes one interface section
+
+        Args:
+            name (str): Interface name
+            lines (list): Section lines
+        """
+        if not name:
+            return
+        access = False
+        maximum = 1
+        sticky_macs: List[str] = []
+        for line in lines:
+            words = line.split()
+            if words[:3] == ['switchport', 'mode', 'access']:
+                access = True
+            elif words[:3] == ['switchport', 'port-security', 'maximum'] \
+                    and len(words) > 3 and words[3].isdigit():
+                maximum = int(words[3])
+            elif words[:4] == ['switchport', 'port-security',
+                               'mac-address', 'sticky'] and len(words) > 4:
+                sticky_macs.append(words[4])
+        self.interfaces[name] = InterfaceConfig(name,
+                                                '\n'.join(lines),
+                                                access,
+                                                maximum,
+                                                sticky_macs)
+        for mac in sticky_macs:
+            self.macs.setdefault(mac, []).append(name)
+
+    def mac_ports(self, mac: str) -> List[str]:
+        """
+        Interfaces the MAC is stuck to
+
+        Args:
+            mac (str): Device MAC-address (Cisco format)
+
+        Returns:
+            (list): Interface names
+        """
+        return self.macs.get(mac, [])
+
+
 class BaseCiscoSSH(Wrapp):
     """
     Cisco switch connection class
@@ -21,38 +130,261 @@ class BaseCiscoSSH(Wrapp):
                  task_params: Dict[str, str],
                  log_file_name: str,
                  config: dict,
-                 **cisco: Any
+                 ssh: Any,
+                 timer: Optional[CommandTimer] = None
                  ) -> None:
         """
         Args:
             task_params (dict): Dict with task params
             log_file_name (str): Log file name (for current task)
             config (dict): Dict with config data
-            **cisco: Cisco connection params
+            ssh (netmiko.BaseConnection): SSH session (privileged mode)
+                from the session pool
+            timer (CommandTimer): Adaptive command timing
+                (None - fixed delay factors)
         """
+        self.host = task_params['ip_addr']
         self.port = task_params['port_num']
         self.date = datetime.datetime.today().strftime('%b %d')
         self.mac = task_params['mac_addr']
         self.config = config
         self.log_file_name = log_file_name
-        self.ssh = ConnectHandler(**cisco)
-        self.ssh.enable()
-        self.logging_mac = self.ssh.send_command('sh logging | include ' +
-                                                 self.date,
-                                                 delay_factor=10)
-        self.log = self.ssh.send_command('sh run interface ' +
-                                         self.port,
-                                         delay_factor=5)
-        self.int_stat = self.ssh.send_command('sh interface ' +
-                                              self.port,
-                                              delay_factor=5)
-        self.sh_run = self.ssh.send_command('sh run', delay_factor=5)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self) -> None:
-        self.ssh.disconnect()
+        self.ssh = ssh
+        self.timer = timer
+        # Show command outputs, each command is sent on first use
+        self.outputs: Dict[str, str] = {}
+        # Change number of the running config to save (0 - no change)
+        self.change = 0
+
+    def send(self, key: str, command: str, delay_factor: int) -> str:
+        """
+        Sends a command (timed if there is a command timer)
+
+        Args:
+            key (str): Command key (command without the arguments)
+            command (str): Command
+            delay_factor (int): Netmiko delay factor
+
+        Returns:
+            (str): Command output
+        """
+        # A killed task stops before the next command
+        check_cancelled()
+        if self.timer is None:
+            return self.ssh.send_command(command, delay_factor=delay_factor)
+        return self.timer.send(key, command, delay_factor)
+
+    def show(self, key: str, command: str, delay_factor: int) -> str:
+        """
+        Show command output (sent once per task)
+
+        Args:
+            key (str): Command key (command without the arguments)
+            command (str): Command
+            delay_factor (int): Netmiko delay factor
+
+        Returns:
+            (str): Command output
+        """
+        if command not in self.outputs:
+            self.outputs[command] = self.send(key, command, delay_factor)
+        return self.outputs[command]
+
+    def log_timing(self) -> None:
+        """
+        Adds the command timing of the task to the task log
+        """
+        if self.timer is not None and self.timer.commands:
+            logging.info(self.timer.summary())
+
+    def finish(self, task_result: str, reason: str = '') -> None:
+        """
+        Ends the task with the result of a check
+        (after the save of the running config changes is confirmed)
+
+        Args:
+            task_result (str): Task result string
+            reason (str): Failed check (metrics label)
+        """
+        if self.change:
+            self.commit()
+        self.log_timing()
+        end_task(self.log_file_name,
+                 self.mac,
+                 task_result,
+                 self.config,
+                 reason)
+
+    def save(self) -> None:
+        """
+        Marks the running config changed
+        (saved by the commit scheduler before the task ends)
+        """
+        self.change = get_scheduler(self.config).mark(self.host)
+
+    def write_config(self) -> str:
+        """
+        Saves the running config (the host lock is taken by the caller)
+
+        Returns:
+            (str): Command output
+        """
+        return self.send('wr mem', 'wr mem', delay_factor=20)
+
+    def commit(self) -> None:
+        """
+        Waits until the running config change is saved
+        ('wr mem' of this task or of another task on the switch)
+        """
+        saved, changes = get_scheduler(self.config).commit(
+            self.host, self.change, self.write_config)
+        if saved:
+            logging.info('!!!OK!!! Running config saved (' + str(changes) +
+                         ' changes on the switch)\r\n')
+        else:
+            logging.info('!!!OK!!! Running config saved by another task '
+                         'on the switch\r\n')
+        self.change = 0
+
+    @property
+    def log(self) -> str:
+        """
+        Port running config
+        """
+        return self.show('sh run interface',
+                         'sh run interface ' + self.port, 5)
+
+    @property
+    def port_config(self) -> InterfaceConfig:
+        """
+        Parsed port running config
+        """
+        return RunningConfig(self.log).interfaces.get(
+            self.port, InterfaceConfig(self.port, '', False, 1, []))
+
+    @property
+    def sticky_ports(self) -> List[str]:
+        """
+        Ports the MAC is stuck to ('sh port-security address' short names)
+        """
+        table = self.show('sh port-security address',
+                          'sh port-security address | include ' + self.mac,
+                          2)
+        ports = []
+        for line_sec in table.split('\n'):
+            words = line_sec.split()
+            if self.mac in words and 'SecureSticky' in words:
+                ports.append(words[-2])
+        return ports
+
+    def interface_config(self, port: str) -> InterfaceConfig:
+        """
+        Parsed running config of another port
+
+        Args:
+            port (str): Interface name (short or full)
+
+        Returns:
+            (InterfaceConfig): Interface section
+        """
+        interfaces = RunningConfig(
+            self.show('sh run interface', 'sh run interface ' + port, 5))
+        return next(iter(interfaces.interfaces.values()),
+                    InterfaceConfig(port, '', False, 1, []))
+
+    @property
+    def int_stat(self) -> str:
+        """
+        Port status line
+        """
+        return self.show('sh interface status',
+                         'sh interface ' + self.port +
+                         ' | include line protocol', 5)
+
+    @property
+    def logging_mac(self) -> str:
+        """
+        Today's port-security messages from the switch log
+        """
+        return self.show('sh logging',
+                         'sh logging | include ' + self.date +
+                         '.*%PORT_SECURITY', 10)
+
+    def wait_sticky(self, timeout: float) -> bool:
+        """
+        Polls the secure MAC table with backoff
+        until the MAC is learned on the port
+
+        Args:
+            timeout (float): Overall deadline in seconds
+
+        Returns:
+            (bool): True if the MAC was learned before the deadline
+        """
+        with timed('psec_sticky_wait_seconds'):
+            return self.poll_sticky(timeout)
+
+    def poll_sticky(self, timeout: float) -> bool:
+        """
+        Secure MAC table polling loop of wait_sticky()
+
+        Args:
+            timeout (float): Overall deadline in seconds
+
+        Returns:
+            (bool): True if the MAC was learned before the deadline
+        """
+        start = time.monotonic()
+        delay = 1.0
+        while True:
+            table = self.send('sh port-security address',
+                              'sh port-security address '
+                              '| include ' + self.mac,
+                              delay_factor=2)
+            if self.learned(table):
+                logging.info('!!!OK!!! MAC learned in ' +
+                             f'{time.monotonic() - start:.1f}' +
+                             ' s\r\n')
+                return True
+            left = start + timeout - time.monotonic()
+            if left <= 0:
+                logging.info('MAC not learned in ' + f'{timeout:.0f}' +
+                             ' s\r\n')
+                return False
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 10.0)
+
+    def learned(self, table: str) -> bool:
+        """
+        Checks if the MAC is learned on the port
+
+        Args:
+            table (str): Secure MAC table ('sh port-security address')
+
+        Returns:
+            (bool): True if learned
+        """
+        for line_sec in table.split('\n'):
+            if self.mac in line_sec and \
+                    short_port(self.port) in line_sec.split():
+                return True
+        return False
+
+    def configure(self, key: str, command: str, delay_factor: int) -> str:
+        """
+        Sends a configuration command
+        (serialized with other tasks on the same switch)
+
+        Args:
+            key (str): Command key (command without the arguments)
+            command (str): Command
+            delay_factor (int): Netmiko delay factor
+
+        Returns:
+            (str): Command output
+        """
+        with get_pool(self.config).host_lock(self.host):
+            return self.send(key, command, delay_factor)
 
     @Wrapp.next_check
     def check_completed_task(self) -> bool:
@@ -66,7 +398,6 @@ class BaseCiscoSSH(Wrapp):
         if self.mac in self.log:
             logging.info('<<<OK>>> Settings have been made before '
                          '<<<OK>>>\r\n\r\nTask completed')
-            self.ssh.disconnect()
             return True
         else:
             logging.info('!!!OK!!!! Setup required\r\n')
@@ -85,7 +416,6 @@ class BaseCiscoSSH(Wrapp):
             logging.info('!!!OK!!! Access port\r\n')
             return True
         else:
-            self.ssh.disconnect()
             logging.info('!!!NOT OK!!!! Not an access port\r\n\r\nTask failed')
             return False
 
@@ -98,11 +428,10 @@ class BaseCiscoSSH(Wrapp):
             (bool): True if only one device allowed per port
             (bool): False if configuring multiple devices
         """
-        if 'maximum' not in self.log:
+        if not self.port_config.hub:
             logging.info('!!!OK!!! Only one device allowed per port\r\n')
             return True
         else:
-            self.ssh.disconnect()
             logging.info('!!!NOT OK!!! Configuring multiple devices '
                          'per port\r\n\r\nTask failed')
             return False
@@ -117,7 +446,6 @@ class BaseCiscoSSH(Wrapp):
             (bool): False if port status DOWN
         """
         if ' is down' in self.int_stat:
-            self.ssh.disconnect()
             logging.info('!!!NOT OK!!! Port status DOWN\r\n\r\nTask failed')
             return False
         else:
@@ -145,7 +473,6 @@ class BaseCiscoSSH(Wrapp):
         # If there were PSECURE_VIOLATION on the same port
         # today but with a different MAC
         if len(logging_mac_split_clean) >= 1:
-            self.ssh.disconnect()
             logging.info('!!!NOT OK!!! Multiple devices on a port '
                          'connect through a hub\r\n\r\nTask failed')
             return False
@@ -163,38 +490,28 @@ class BaseCiscoSSH(Wrapp):
             (bool): True if MAC is not stick other port
                 (and after sticky reset)
         """
-        if self.mac not in self.sh_run:
-            return True
-        else:
-            int_list = re.findall(r'(\S+Ethernet\S+)', self.sh_run)
-            for ints in int_list:
-                sh_int = self.ssh.send_command('sh run interface ' +
-                                               ints,
-                                               delay_factor=10)
-                # Clear sticky is not done if this MAC address
-                # is stick to the port behind which the hub is located
-                if self.mac not in sh_int:
-                    return True
-                else:
-                    if 'maximum' in sh_int:
-                        self.ssh.disconnect()
-                        logging.info('!!!NOT OK!!! MAC on another port ' +
-                                     ints +
-                                     ', but a hub is connected '
-                                     'there\r\n\r\nTask failed')
-                        return False
-                    else:
-                        self.ssh.send_command('clear port-security '
-                                              'sticky interface ' +
-                                              ints,
-                                              delay_factor=10)
-                        time.sleep(5)
-                        logging.info('!!!OK!!! Port sticky reset '
-                                     'on other port ' +
-                                     ints +
-                                     '\r\n')
-                        return True
-            return True
+        for ints in self.sticky_ports:
+            if ints == short_port(self.port):
+                continue
+            # Clear sticky is not done if this MAC address
+            # is stick to the port behind which the hub is located
+            if self.interface_config(ints).hub:
+                logging.info('!!!NOT OK!!! MAC on another port ' +
+                             ints +
+                             ', but a hub is connected '
+                             'there\r\n\r\nTask failed')
+                return False
+            self.configure('clear port-security sticky',
+                           'clear port-security '
+                           'sticky interface ' +
+                           ints,
+                           delay_factor=10)
+            time.sleep(5)
+            logging.info('!!!OK!!! Port sticky reset '
+                         'on other port ' +
+                         ints +
+                         '\r\n')
+        return True
 
     @Wrapp.next_check
     def check_already_stick(self) -> bool:
@@ -205,13 +522,12 @@ class BaseCiscoSSH(Wrapp):
             (bool): True if success
             (bool): False if not
         """
-        log = self.ssh.send_command('sh run interface ' +
-                                    self.port,
-                                    delay_factor=10)
+        log = self.send('sh run interface',
+                        'sh run interface ' + self.port,
+                        delay_factor=10)
         if self.mac in log:
             logging.info(log)
-            self.ssh.send_command('wr mem', delay_factor=20)
-            self.ssh.disconnect()
+            self.save()
             logging.info('<<<OK>>> SUCCESSFUL SETUP '
                          '<<<OK>>>\r\n\r\nTask completed')
             return True
@@ -228,18 +544,18 @@ class BaseCiscoSSH(Wrapp):
             (bool): True if success
             (bool): False if not (MAC not stick, second try needed)
         """
-        self.ssh.send_command('clear port-security sticky interface ' +
-                              self.port,
-                              delay_factor=5)
-        time.sleep(30)
+        self.configure('clear port-security sticky',
+                       'clear port-security sticky interface ' +
+                       self.port,
+                       delay_factor=5)
+        self.wait_sticky(float(self.config.get('sticky_first_timeout', 30)))
         # Update port information
-        log = self.ssh.send_command('sh run interface ' +
-                                    self.port,
-                                    delay_factor=5)
+        log = self.send('sh run interface',
+                        'sh run interface ' + self.port,
+                        delay_factor=5)
         if self.mac in log:
             logging.info(log)
-            self.ssh.send_command('wr mem', delay_factor=20)
-            self.ssh.disconnect()
+            self.save()
             logging.info('<<<OK>>> SUCCESSFUL SETUP '
                          '<<<OK>>>\r\n\r\nTask completed')
             return True
@@ -257,23 +573,154 @@ class BaseCiscoSSH(Wrapp):
             (bool): False if not (MAC not stick, unable to setup)
         """
         # If there is not enough time to stick, one more attempt is made
-        self.ssh.send_command('clear port-security sticky interface ' +
-                              self.port,
-                              delay_factor=5)
-        time.sleep(240)
+        self.configure('clear port-security sticky',
+                       'clear port-security sticky interface ' +
+                       self.port,
+                       delay_factor=5)
+        self.wait_sticky(float(self.config.get('sticky_second_timeout', 240)))
         # Update port information
-        log = self.ssh.send_command('sh run interface ' +
-                                    self.port,
-                                    delay_factor=5)
+        log = self.send('sh run interface',
+                        'sh run interface ' + self.port,
+                        delay_factor=5)
         if self.mac in log:
             logging.info(log)
-            self.ssh.send_command('wr mem', delay_factor=20)
-            self.ssh.disconnect()
+            self.save()
             logging.info('<<<OK>>> SUCCESSFUL SETUP (second reset) '
                          '<<<OK>>>\r\n\r\nTask completed')
             return True
         else:
-            self.ssh.disconnect()
             logging.info('!!!NOT OK!!! UNABLE TO SET UP, '
                          'MAC DOES NOT STICK TO THE PORT\r\n\r\nTask failed')
             return False
+
+
+class PortResult(Exception):
+    """
+    Result of one port of a bulk task
+    """
+    def __init__(self, task_result: str, reason: str = '') -> None:
+        """
+        Args:
+            task_result (str): Task result string
+            reason (str): Failed check
+        """
+        super().__init__(task_result)
+        self.task_result = task_result
+        self.reason = reason
+
+
+class BulkCiscoSSH(BaseCiscoSSH):
+    """
+    One port of a bulk task
+    The result is raised as PortResult instead of ending the task,
+    sticky resets of all ports of the switch are waited for together,
+    the running config is saved once for all ports
+    """
+    def __init__(self,
+                 task_params: Dict[str, str],
+                 log_file_name: str,
+                 config: dict,
+                 ssh: Any,
+                 timer: Optional[CommandTimer] = None
+                 ) -> None:
+        super().__init__(task_params, log_file_name, config, ssh, timer)
+        self.unsaved = False
+
+    def finish(self, task_result: str, reason: str = '') -> None:
+        raise PortResult(task_result, reason)
+
+    def save(self) -> None:
+        self.unsaved = True
+
+    def save_config(self) -> None:
+        """
+        Saves the running config (once for all ports of the switch)
+        """
+        super().save()
+        self.commit()
+        self.unsaved = False
+
+    def run_checks(self) -> Optional[PortResult]:
+        """
+        Runs the checks of the port (up to the sticky reset)
+
+        Returns:
+            (PortResult): Port result
+            (None): Sticky reset required
+        """
+        try:
+            self.check_completed_task()
+            self.check_access()
+            self.check_max_devices()
+            self.check_port_stat()
+            self.check_hub()
+            self.check_mac_on_other_port()
+            self.check_already_stick()
+        except PortResult as result:
+            return result
+        return None
+
+    def clear_sticky(self) -> None:
+        """
+        Port sticky reset
+        """
+        self.configure('clear port-security sticky',
+                       'clear port-security sticky interface ' +
+                       self.port,
+                       delay_factor=5)
+
+    def check_stick(self, last: bool) -> Optional[PortResult]:
+        """
+        Checks if the MAC sticks to the port after the reset
+
+        Args:
+            last (bool): The second reset
+
+        Returns:
+            (PortResult): Port result
+            (None): Second reset required
+        """
+        log = self.send('sh run interface',
+                        'sh run interface ' + self.port,
+                        delay_factor=5)
+        if self.mac in log:
+            logging.info(log)
+            self.save()
+            logging.info('<<<OK>>> SUCCESSFUL SETUP ' + self.mac +
+                         ' <<<OK>>>\r\n')
+            return PortResult('Task completed')
+        if last:
+            logging.info('!!!NOT OK!!! UNABLE TO SET UP, ' + self.mac +
+                         ' DOES NOT STICK TO THE PORT\r\n')
+            return PortResult('Task failed', 'port_sec_second_try')
+        logging.info('!!!OK!!! ' + self.mac + ' not stick, '
+                     'second try needed\r\n')
+        return None
+
+
+def wait_learned(ports: List[BulkCiscoSSH], timeout: float) -> None:
+    """
+    Polls the secure MAC table of the switch with backoff
+    until the MACs of all ports are learned
+
+    Args:
+        ports (list): Ports of one switch after the sticky reset
+        timeout (float): Overall deadline in seconds
+    """
+    start = time.monotonic()
+    delay = 1.0
+    waiting = list(ports)
+    with timed('psec_sticky_wait_seconds'):
+        while waiting:
+            table = waiting[0].send('sh port-security table',
+                                    'sh port-security address',
+                                    delay_factor=2)
+            waiting = [port for port in waiting if not port.learned(table)]
+            left = start + timeout - time.monotonic()
+            if not waiting or left <= 0:
+                break
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 10.0)
+    logging.info(str(len(ports) - len(waiting)) + ' of ' + str(len(ports)) +
+                 ' MACs learned in ' + f'{time.monotonic() - start:.1f}' +
+                 ' s\r\n')
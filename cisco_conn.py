@@ -6,8 +6,47 @@ import json
 import logging
 from typing import Dict
 
-from cisco_class import BaseCiscoSSH
+from cisco_class import BaseCiscoSSH, BulkCiscoSSH, PortResult, wait_learned
+from command_timing import CommandTimer, get_timing
+from commit_scheduler import get_scheduler
 from service_funcs import end_task
+from ssh_pool import get_pool
+
+
+def load_cisco_params(host: str, config: dict) -> dict:
+    """
+    Netmiko connection params of the switch
+
+    Args:
+        host (str): Switch address
+        config (dict): Dict with config data
+
+    Returns:
+        (dict): Connection params
+    """
+    with open(config['proj_dir'] + 'cisco_params.json', 'r') as cisco_params:
+        cisco = json.load(cisco_params)
+    cisco.update({'host': host})
+    return cisco
+
+
+def start_log(task_params: Dict[str, str]) -> None:
+    """
+    Switch setup header of the task log
+
+    Args:
+        task_params (dict): Dict with task params
+    """
+    logging.info('\r\n>>>-----------------SWITCH-SETUP------------'
+                 '--------<<<\r\n\r\n\r\n!!!STARTLOG!!! ' +
+                 task_params['vendor'] +
+                 ' ' +
+                 task_params['ip_addr'] +
+                 ' ' +
+                 task_params['port_num'] +
+                 ' ' +
+                 task_params['mac_addr'] +
+                 ' !!!STARTLOG!!!\r\n\r\n')
 
 
 def cisco_connection(log_file_name: str,
@@ -27,25 +66,22 @@ def cisco_connection(log_file_name: str,
         RuntimeError("end_task() does not work properly"): If end_task()
             does not end the process
     """
-    with open(config['proj_dir'] + 'cisco_params.json', 'r') as cisco_params:
-        cisco = json.load(cisco_params)
-    cisco.update({'host': task_params['ip_addr']})
+    cisco = load_cisco_params(task_params['ip_addr'], config)
     try:
-        with BaseCiscoSSH(task_params,
-                          log_file_name,
-                          config,
-                          **cisco
-                          ) as cisco_conn:
-            logging.info('\r\n>>>-----------------SWITCH-SETUP------------'
-                         '--------<<<\r\n\r\n\r\n!!!STARTLOG!!! ' +
-                         task_params['vendor'] +
-                         ' ' +
-                         task_params['ip_addr'] +
-                         ' ' +
-                         task_params['port_num'] +
-                         ' ' +
-                         task_params['mac_addr'] +
-                         ' !!!STARTLOG!!!\r\n\r\n')
+        # The session to the switch is reused by the following tasks,
+        # the running config is saved together with the other tasks
+        with get_scheduler(config).writing(task_params['ip_addr']), \
+                get_pool(config).session(task_params['ip_addr'],
+                                         cisco) as ssh:
+            timer = CommandTimer(get_timing(config),
+                                 ssh,
+                                 task_params['ip_addr'])
+            cisco_conn = BaseCiscoSSH(task_params,
+                                      log_file_name,
+                                      config,
+                                      ssh,
+                                      timer)
+            start_log(task_params)
             cisco_conn.check_completed_task()
             cisco_conn.check_access()
             cisco_conn.check_max_devices()
@@ -60,5 +96,97 @@ def cisco_connection(log_file_name: str,
         logging.exception('REQUEST PERFORMANCE '
                           'ERROR\r\n\r\nTask failed\r\n\r\n')
         task_result = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
+        end_task(log_file_name, mac, task_result, config, 'device_error')
         raise RuntimeError("end_task() does not work properly")
+
+
+def port_result(result: PortResult) -> str:
+    """
+    Port result of a bulk task
+
+    Args:
+        result (PortResult): Port result
+
+    Returns:
+        (str): 'completed' or the failure reason
+    """
+    if 'Task completed' in result.task_result:
+        return 'completed'
+    return result.reason or 'other'
+
+
+def cisco_bulk_connection(log_file_name: str,
+                          host: str,
+                          ports: Dict[str, Dict[str, str]],
+                          config: dict
+                          ) -> Dict[str, str]:
+    """
+    Configures the ports of a bulk task on one switch in one session:
+    the checks of every port, then the sticky reset of all ports
+    that need it with one wait, the running config is saved once
+
+    Args:
+        log_file_name (str): Log file name (for current task)
+        host (str): Switch address
+        ports (dict): Task params by device MAC-address
+        config (dict): Dict with config data
+
+    Returns:
+        results (dict): 'completed' or the failure reason by MAC
+    """
+    results: Dict[str, str] = {}
+    cisco_conns: Dict[str, BulkCiscoSSH] = {}
+    try:
+        with get_scheduler(config).writing(host), \
+                get_pool(config).session(host,
+                                         load_cisco_params(host,
+                                                           config)) as ssh:
+            timer = CommandTimer(get_timing(config), ssh, host)
+            for mac, task_params in ports.items():
+                start_log(task_params)
+                cisco_conns[mac] = BulkCiscoSSH(task_params,
+                                                log_file_name,
+                                                config,
+                                                ssh,
+                                                timer)
+                result = cisco_conns[mac].run_checks()
+                if result is not None:
+                    results[mac] = port_result(result)
+            waiting = [mac for mac in ports if mac not in results]
+            # If there is not enough time to stick, one more attempt is made
+            for last, timeout in ((False, config.get('sticky_first_timeout',
+                                                     30)),
+                                  (True, config.get('sticky_second_timeout',
+                                                    240))):
+                if not waiting:
+                    break
+                for mac in waiting:
+                    cisco_conns[mac].clear_sticky()
+                wait_learned([cisco_conns[mac] for mac in waiting],
+                             float(timeout))
+                for mac in waiting:
+                    result = cisco_conns[mac].check_stick(last)
+                    if result is not None:
+                        results[mac] = port_result(result)
+                waiting = [mac for mac in waiting if mac not in results]
+            unsaved = [mac for mac, cisco_conn in cisco_conns.items()
+                       if cisco_conn.unsaved]
+            if unsaved:
+                cisco_conns[unsaved[0]].save_config()
+                # The save covers the changes of every port
+                for mac in unsaved:
+                    cisco_conns[mac].unsaved = False
+                logging.info('!!!OK!!! Running config of ' + host +
+                             ' saved for ' + str(len(unsaved)) +
+                             ' ports\r\n')
+            if timer.commands:
+                logging.info(timer.summary())
+    # Catch all netmiko exceptions
+    except Exception:
+        logging.exception('REQUEST PERFORMANCE ERROR ' + host + '\r\n\r\n')
+        # Ports not finished or not saved
+        for mac in ports:
+            if mac not in results or \
+                    mac in cisco_conns and cisco_conns[mac].unsaved:
+                results[mac] = 'device_error'
+    return results
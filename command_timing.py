@@ -0,0 +1,295 @@
+#! /usr/bin/env python3
+"""
+Adaptive switch command timing
+Response times are measured per device model and command,
+kept in a local SQLite store and used for the netmiko read deadlines
+"""
+import logging
+import math
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from process_local import SQLiteStore, process_instance
+
+# Netmiko send_command() reads the channel every 0.2 * delay_factor s,
+# 500 times at most
+LOOP_DELAY = 0.2
+FIXED_LOOPS = 500
+
+# Model line of 'show version'
+MODEL_COMMAND = 'sh version | include [Mm]odel [Nn]umber'
+
+TIMING_SCHEMA = '''CREATE TABLE IF NOT EXISTS command_timing (
+    model TEXT NOT NULL,
+    command TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    srtt REAL NOT NULL,
+    rttvar REAL NOT NULL,
+    PRIMARY KEY (model, command)
+)'''
+
+MODEL_SCHEMA = '''CREATE TABLE IF NOT EXISTS device_models (
+    host TEXT PRIMARY KEY,
+    model TEXT NOT NULL
+)'''
+
+
+def parse_model(output: str) -> str:
+    """
+    Device model from the 'show version' model line
+
+    Args:
+        output (str): Command output
+            ('Model number                    : WS-C2960X-48FPD-L')
+
+    Returns:
+        (str): Model or 'unknown'
+    """
+    for line in output.splitlines():
+        if ':' in line and 'odel' in line:
+            model = line.split(':', 1)[1].strip()
+            if model:
+                return model
+    return 'unknown'
+
+
+class TimingStore(SQLiteStore):
+    """
+    Smoothed response times by device model and command
+    (shared by all task processes, survives a restart)
+    """
+    schema = (TIMING_SCHEMA, MODEL_SCHEMA)
+
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        super().__init__(config.get('timing_db',
+                                    config['proj_dir'] + 'timing.db'))
+        self.min_samples = int(config.get('timing_min_samples', 5))
+        self.min_timeout = float(config.get('timing_min_timeout', 5))
+
+    def estimate(self, model: str, command: str
+                 ) -> Optional[Tuple[int, float, float]]:
+        """
+        Measured response time of the command
+
+        Args:
+            model (str): Device model
+            command (str): Command key
+
+        Returns:
+            (tuple): Samples, smoothed time and its variation in seconds
+            (None): Not measured yet
+        """
+        with self.lock:
+            rows = self.connection().execute(
+                'SELECT samples, srtt, rttvar FROM command_timing '
+                'WHERE model = ? AND command = ?',
+                (model, command)).fetchall()
+        return rows[0] if rows else None
+
+    def update(self, model: str, command: str, elapsed: float) -> None:
+        """
+        Adds a response time (smoothed as the TCP round-trip time,
+        RFC 6298)
+
+        Args:
+            model (str): Device model
+            command (str): Command key
+            elapsed (float): Response time in seconds
+        """
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    'SELECT samples, srtt, rttvar FROM command_timing '
+                    'WHERE model = ? AND command = ?',
+                    (model, command)).fetchall()
+                if rows:
+                    samples, srtt, rttvar = rows[0]
+                    rttvar = 0.75 * rttvar + 0.25 * abs(srtt - elapsed)
+                    srtt = 0.875 * srtt + 0.125 * elapsed
+                else:
+                    samples, srtt, rttvar = 0, elapsed, elapsed / 2
+                conn.execute('INSERT OR REPLACE INTO command_timing '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (model, command, samples + 1, srtt, rttvar))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def timeout(self, model: str, command: str, fixed: float) -> float:
+        """
+        Read deadline of the command
+        (the fixed deadline until there are enough measurements)
+
+        Args:
+            model (str): Device model
+            command (str): Command key
+            fixed (float): Deadline of the fixed delay factor in seconds
+
+        Returns:
+            (float): Deadline in seconds
+        """
+        estimate = self.estimate(model, command)
+        if estimate is None or estimate[0] < self.min_samples:
+            return fixed
+        samples, srtt, rttvar = estimate
+        return min(fixed, max(self.min_timeout, srtt + 4 * rttvar))
+
+    def model(self, host: str) -> Optional[str]:
+        """
+        Known model of the switch
+
+        Args:
+            host (str): Switch address
+
+        Returns:
+            (str): Device model
+            (None): Not known yet
+        """
+        with self.lock:
+            rows = self.connection().execute(
+                'SELECT model FROM device_models WHERE host = ?',
+                (host,)).fetchall()
+        return rows[0][0] if rows else None
+
+    def set_model(self, host: str, model: str) -> None:
+        """
+        Saves the model of the switch
+
+        Args:
+            host (str): Switch address
+            model (str): Device model
+        """
+        with self.lock:
+            self.connection().execute(
+                'INSERT OR REPLACE INTO device_models VALUES (?, ?)',
+                (host, model))
+
+
+class CommandTimer:
+    """
+    Sends the commands of one task with adaptive read deadlines
+    and counts the time saved against the fixed delay factors
+    """
+    def __init__(self, store: TimingStore, ssh: Any, host: str) -> None:
+        """
+        Args:
+            store (TimingStore): Response time store
+            ssh (netmiko.BaseConnection): SSH session
+            host (str): Switch address
+        """
+        self.store = store
+        self.ssh = ssh
+        self.host = host
+        self.device_model = ''
+        self.commands = 0
+        self.elapsed = 0.0
+        self.saved = 0.0
+
+    def loop_delay(self, delay_factor: float) -> float:
+        """
+        Channel read interval of the session for a delay factor
+        (netmiko applies the global delay factor and fast_cli)
+
+        Args:
+            delay_factor (float): Netmiko delay factor
+
+        Returns:
+            (float): Interval in seconds
+        """
+        select = getattr(self.ssh, 'select_delay_factor', None)
+        if select is not None:
+            delay_factor = select(delay_factor)
+        return LOOP_DELAY * delay_factor
+
+    @property
+    def model(self) -> str:
+        """
+        Switch model (asked once per switch)
+        """
+        if not self.device_model:
+            model = self.store.model(self.host)
+            if model is None:
+                model = parse_model(self.ssh.send_command(MODEL_COMMAND))
+                self.store.set_model(self.host, model)
+            self.device_model = model
+        return self.device_model
+
+    def send(self, key: str, command: str, delay_factor: int) -> str:
+        """
+        Sends a command
+        The output is polled at the shortest interval until the deadline
+        measured for the command; a show command without an answer
+        by then is sent again with the fixed delay factor
+
+        Args:
+            key (str): Command key (command without the arguments)
+            command (str): Command
+            delay_factor (int): Fixed netmiko delay factor (fallback)
+
+        Returns:
+            (str): Command output
+        """
+        fixed_delay = self.loop_delay(delay_factor)
+        fixed = FIXED_LOOPS * fixed_delay
+        # Configuration commands are not repeated, they keep the deadline
+        retry = command.startswith('sh ')
+        timeout = self.store.timeout(self.model, key, fixed) if retry \
+            else fixed
+        max_loops = max(1, int(math.ceil(timeout / self.loop_delay(1))))
+        start = time.monotonic()
+        try:
+            output = self.ssh.send_command(command,
+                                           delay_factor=1,
+                                           max_loops=max_loops)
+        except OSError:
+            if not retry or timeout >= fixed:
+                raise
+            logging.info('No answer to ' + command + ' in ' +
+                         f'{timeout:.1f}' + ' s, sent again with '
+                         'the fixed delay factor\r\n')
+            output = self.ssh.send_command(command,
+                                           delay_factor=delay_factor)
+        elapsed = time.monotonic() - start
+        self.store.update(self.model, key, elapsed)
+        # The fixed factor reads at longer intervals
+        steps = max(1, int(math.ceil(elapsed / fixed_delay)))
+        self.commands += 1
+        self.elapsed += elapsed
+        self.saved += steps * fixed_delay - elapsed
+        return output
+
+    def summary(self) -> str:
+        """
+        Timing line for the task log
+
+        Returns:
+            (str): Commands, their time and the time saved
+        """
+        return 'Command timing (' + self.model + '): ' + \
+            str(self.commands) + ' commands in ' + \
+            f'{self.elapsed:.1f}' + ' s, ' + f'{self.saved:.1f}' + \
+            ' s saved against the fixed delay factors\r\n'
+
+
+# Timing store of the current task process
+_store: Dict[str, TimingStore] = {}
+
+
+def get_timing(config: dict) -> TimingStore:
+    """
+    Timing store of the current task process
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        (TimingStore): Response time store
+    """
+    return process_instance(_store, lambda: TimingStore(config))
@@ -0,0 +1,255 @@
+#! /usr/bin/env python3
+"""
+Per-switch commit scheduler
+Tasks mark the running config of a switch changed, one 'wr mem'
+after a short quiet window saves the changes of all tasks on the switch
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple
+
+from metrics import count, observe
+from process_local import SQLiteStore, process_instance
+from ssh_pool import get_pool
+from worker_pool import check_cancelled
+
+COMMIT_SCHEMA = '''CREATE TABLE IF NOT EXISTS switch_commits (
+    host TEXT PRIMARY KEY,
+    changes INTEGER NOT NULL,
+    changed REAL NOT NULL,
+    saved INTEGER NOT NULL
+)'''
+
+WRITER_SCHEMA = '''CREATE TABLE IF NOT EXISTS switch_writers (
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    thread INTEGER NOT NULL,
+    change INTEGER NOT NULL,
+    PRIMARY KEY (host, pid, thread)
+)'''
+
+
+def process_alive(pid: int) -> bool:
+    """
+    Is the process running?
+
+    Args:
+        pid (int): Process ID
+
+    Returns:
+        (bool): False if there is no such process
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class CommitScheduler(SQLiteStore):
+    """
+    Running config changes and saves by switch
+    (shared by all task processes)
+    Each change gets the next number of the switch, a save covers
+    every change numbered before it, the task waits for the save
+    covering its change before reporting success
+    The switch is saved at once if no other task is changing it
+    """
+    schema = (COMMIT_SCHEMA, WRITER_SCHEMA)
+
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        super().__init__(config.get('commit_db',
+                                    config['proj_dir'] + 'commits.db'))
+        self.delay = float(config.get('commit_delay', 2))
+        self.max_wait = float(config.get('commit_max_wait', 10))
+        self.config = config
+
+    def state(self, host: str) -> Tuple[int, float, int]:
+        """
+        Commit state of the switch
+
+        Args:
+            host (str): Switch address
+
+        Returns:
+            (tuple): Last change number, time of the last change,
+                last saved change number
+        """
+        with self.lock:
+            rows = self.connection().execute(
+                'SELECT changes, changed, saved FROM switch_commits '
+                'WHERE host = ?', (host,)).fetchall()
+        return rows[0] if rows else (0, 0.0, 0)
+
+    @contextmanager
+    def writing(self, host: str) -> Iterator[None]:
+        """
+        Registers the task as changing the switch
+        (the other tasks wait for its change before saving)
+
+        Args:
+            host (str): Switch address
+        """
+        with self.lock:
+            self.connection().execute(
+                'INSERT OR REPLACE INTO switch_writers VALUES (?, ?, ?, 0)',
+                (host, os.getpid(), threading.get_ident()))
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.connection().execute(
+                    'DELETE FROM switch_writers '
+                    'WHERE host = ? AND pid = ? AND thread = ?',
+                    (host, os.getpid(), threading.get_ident()))
+
+    def pending(self, host: str) -> int:
+        """
+        Other tasks changing the switch that have not made
+        their change yet (writers of ended processes are removed)
+
+        Args:
+            host (str): Switch address
+
+        Returns:
+            (int): Number of tasks
+        """
+        with self.lock:
+            rows = self.connection().execute(
+                'SELECT pid, thread FROM switch_writers '
+                'WHERE host = ? AND change = 0', (host,)).fetchall()
+        writers = 0
+        for pid, thread in rows:
+            if not process_alive(pid):
+                with self.lock:
+                    self.connection().execute(
+                        'DELETE FROM switch_writers WHERE pid = ?', (pid,))
+            elif (pid, thread) != (os.getpid(), threading.get_ident()):
+                writers += 1
+        return writers
+
+    def mark(self, host: str) -> int:
+        """
+        Marks the running config of the switch changed
+
+        Args:
+            host (str): Switch address
+
+        Returns:
+            (int): Change number
+        """
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR IGNORE INTO switch_commits '
+                             'VALUES (?, 0, 0, 0)', (host,))
+                conn.execute('UPDATE switch_commits SET changes = '
+                             'changes + 1, changed = ? WHERE host = ?',
+                             (time.time(), host))
+                change = conn.execute('SELECT changes FROM switch_commits '
+                                      'WHERE host = ?',
+                                      (host,)).fetchall()[0][0]
+                conn.execute('UPDATE switch_writers SET change = ? '
+                             'WHERE host = ? AND pid = ? AND thread = ?',
+                             (change, host, os.getpid(),
+                              threading.get_ident()))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return change
+
+    def saved(self, host: str, change: int) -> None:
+        """
+        Marks the changes of the switch saved
+
+        Args:
+            host (str): Switch address
+            change (int): Last change number covered by the save
+        """
+        with self.lock:
+            self.connection().execute(
+                'UPDATE switch_commits SET saved = MAX(saved, ?) '
+                'WHERE host = ?', (change, host))
+
+    def commit(self, host: str, change: int, save: Callable[[], str]
+               ) -> Tuple[bool, int]:
+        """
+        Waits until the change is saved
+        The save is made by the first task that finds no other task
+        changing the switch, the switch quiet for 'commit_delay' seconds
+        or has waited 'commit_max_wait' seconds, the other tasks
+        of the window only wait for it
+
+        Args:
+            host (str): Switch address
+            change (int): Change number
+            save (Callable): Sends 'wr mem' (under the host lock),
+                returns the command output
+
+        Returns:
+            (tuple): True if the save was made by this task,
+                number of changes covered by the save
+
+        Raises:
+            RuntimeError: If the switch did not confirm the save
+        """
+        start = time.monotonic()
+        while True:
+            changes, changed, saved = self.state(host)
+            if saved >= change:
+                count('psec_config_commits_total', result='covered')
+                observe('psec_commit_wait_seconds',
+                        time.monotonic() - start)
+                return False, 0
+            quiet = time.time() - changed
+            waited = time.monotonic() - start
+            if quiet >= self.delay or waited >= self.max_wait or \
+                    not self.pending(host):
+                break
+            check_cancelled()
+            time.sleep(max(0.05, min(0.2,
+                                     self.delay - quiet,
+                                     self.max_wait - waited)))
+        with get_pool(self.config).host_lock(host):
+            # Saved by another task while the lock was taken
+            changes, changed, saved = self.state(host)
+            if saved >= change:
+                count('psec_config_commits_total', result='covered')
+                observe('psec_commit_wait_seconds',
+                        time.monotonic() - start)
+                return False, 0
+            output = save()
+            if '[OK]' not in output:
+                raise RuntimeError('Running config of ' + host +
+                                   ' not saved: ' + output.strip())
+            self.saved(host, changes)
+        count('psec_config_commits_total', result='saved')
+        observe('psec_commit_wait_seconds', time.monotonic() - start)
+        return True, changes - saved
+
+
+# Commit scheduler of the current task process
+_scheduler: Dict[str, CommitScheduler] = {}
+
+
+def get_scheduler(config: dict) -> CommitScheduler:
+    """
+    Commit scheduler of the current task process
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        (CommitScheduler): Commit scheduler
+    """
+    return process_instance(_scheduler, lambda: CommitScheduler(config))
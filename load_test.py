@@ -0,0 +1,587 @@
+#! /usr/bin/env python3
+"""
+Synthetic load test
+Runs psec.main() against local stand-ins: POP3 mailbox, SMTP relay,
+SQLite log server DB and simulated Cisco IOS switches
+"""
+import argparse
+import datetime
+import email
+import json
+import multiprocessing
+import os
+import re
+import resource
+import socketserver
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import psec
+import ssh_pool
+from benchmarks import random_mac, ticket_corpus
+from cisco_class import short_port
+from ssh_pool import SessionPool
+from syslog_db import SyslogDB
+
+
+class Ticket(NamedTuple):
+    """
+    Scripted ticket: the device and where it connects
+    """
+    mac: str
+    switch: str
+    port: str
+    message: str
+
+
+class FakePOP3Handler(socketserver.StreamRequestHandler):
+    """
+    Minimal POP3 server session
+    """
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self) -> None:
+        with self.server.lock:
+            mailbox = list(self.server.mailbox)
+        deleted: set = set()
+        self.reply('+OK ready')
+        for raw_line in self.rfile:
+            command, *args = raw_line.decode().split()
+            command = command.upper()
+            if command in ('USER', 'PASS'):
+                self.reply('+OK')
+            elif command == 'STAT':
+                self.reply('+OK ' + str(len(mailbox)) + ' ' +
+                           str(sum(len(mail) for mail in mailbox)))
+            elif command == 'LIST':
+                self.reply('+OK')
+                for number, mail in enumerate(mailbox, 1):
+                    self.reply(str(number) + ' ' + str(len(mail)))
+                self.reply('.')
+            elif command == 'RETR':
+                self.wfile.write(b'+OK\r\n' + mailbox[int(args[0]) - 1] +
+                                 b'.\r\n')
+            elif command == 'DELE':
+                deleted.add(id(mailbox[int(args[0]) - 1]))
+                self.reply('+OK')
+            elif command == 'QUIT':
+                with self.server.lock:
+                    self.server.mailbox[:] = [
+                        mail for mail in self.server.mailbox
+                        if id(mail) not in deleted]
+                self.reply('+OK')
+                return
+
+
+class FakePOP3Server(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the mailbox (mail can be added while it runs)
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakePOP3Handler)
+        self.mailbox: List[bytes] = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def deliver(self, sender: str, text: str) -> None:
+        """
+        Puts a ticket in the mailbox
+
+        Args:
+            sender (str): Sender address
+            text (str): Message text
+        """
+        mail = ('From: Infsec <' + sender + '>\r\n'
+                'Subject: ticket\r\n'
+                'Date: ' + formatdate() + '\r\n'
+                'Content-Type: text/plain; charset="utf-8"\r\n'
+                '\r\n' + text.replace('\r\n.', '\r\n..') + '\r\n').encode()
+        with self.lock:
+            self.mailbox.append(mail)
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP session, the delivered mail is recorded
+    """
+    def handle(self) -> None:
+        self.wfile.write(b'220 fake ESMTP\r\n')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = []
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                    data.append(data_line)
+                self.server.delivered(
+                    email.message_from_bytes(b''.join(data)))
+                self.wfile.write(b'250 queued\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the mail relay
+    Result mail ('Task completed <MAC>', 'Task failed <MAC>'
+    or the result table of a bulk task) is matched to the tickets
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.results: Dict[str, Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def delivered(self, msg: Any) -> None:
+        """
+        Records a delivered message
+
+        Args:
+            msg (email.message.Message): Message
+        """
+        subject = msg.get('Subject', '')
+        found = []
+        for result in ('Task completed', 'Task failed'):
+            if subject.startswith(result + ' '):
+                found.append((subject[len(result) + 1:].replace('.', ''),
+                              result))
+        if subject.startswith('Bulk task:'):
+            text = msg.get_payload()[0].get_payload(decode=True).decode()
+            found += re.findall(r'^([0-9a-f]{12}) \|.*\| (Task \w+)',
+                                text, re.MULTILINE)
+        with self.lock:
+            for mac, result in found:
+                self.results.setdefault(mac, (result, time.time()))
+            self.done.notify_all()
+
+
+class FakeNetwork:
+    """
+    Simulated Cisco IOS switches
+    Every ticket device is connected to its own access port,
+    a cleared port learns the device MAC after 'learn_delay' seconds
+    """
+    def __init__(self,
+                 tickets: List[Ticket],
+                 latency: float,
+                 save_latency: float,
+                 learn_delay: float
+                 ) -> None:
+        """
+        Args:
+            tickets (list): Scripted tickets
+            latency (float): Response time of a command in seconds
+            save_latency (float): Response time of 'wr mem' in seconds
+            learn_delay (float): Sticky learn time after a clear in seconds
+        """
+        self.latency = latency
+        self.save_latency = save_latency
+        self.learn_delay = learn_delay
+        # 'wr mem' of all task processes
+        self.saves: Any = multiprocessing.Value('i', 0)
+        self.ports: Dict[str, Dict[str, str]] = {}
+        for ticket in tickets:
+            self.ports.setdefault(ticket.switch, {})[ticket.port] = \
+                cisco_mac(ticket.mac)
+
+    def connect(self, params: Dict[str, Any]) -> 'FakeIOS':
+        """
+        Session pool connection factory
+
+        Args:
+            params (dict): Netmiko connection params
+
+        Returns:
+            (FakeIOS): Switch session
+        """
+        time.sleep(self.latency * 4)
+        return FakeIOS(self, params['host'])
+
+
+class FakeIOS:
+    """
+    Switch session answering the commands of BaseCiscoSSH
+    (the state is kept by the task process)
+    """
+    def __init__(self, network: FakeNetwork, host: str) -> None:
+        """
+        Args:
+            network (FakeNetwork): Simulated switches
+            host (str): Switch address
+        """
+        self.network = network
+        self.ports = network.ports.get(host, {})
+        # Learn time of the sticky MAC by port
+        self.learned: Dict[str, float] = {}
+
+    def is_alive(self) -> bool:
+        return True
+
+    def disconnect(self) -> None:
+        pass
+
+    def sticky(self, port: str) -> Optional[str]:
+        """
+        Sticky MAC of the port
+
+        Args:
+            port (str): Interface name
+
+        Returns:
+            (str): MAC-address (Cisco format)
+            (None): Nothing learned yet
+        """
+        if self.learned.get(port, float('inf')) <= time.monotonic():
+            return self.ports[port]
+        return None
+
+    def interface(self, port: str) -> str:
+        """
+        Interface section of the running config
+
+        Args:
+            port (str): Interface name
+
+        Returns:
+            (str): Config text
+        """
+        lines = ['interface ' + port,
+                 ' switchport access vlan 10',
+                 ' switchport mode access',
+                 ' switchport port-security',
+                 ' switchport port-security mac-address sticky']
+        if self.sticky(port) is not None:
+            lines.append(' switchport port-security mac-address sticky ' +
+                         self.sticky(port))
+        return '\n'.join(lines) + '\n!\n'
+
+    def send_command(self,
+                     command: str,
+                     delay_factor: int = 1,
+                     max_loops: int = 500
+                     ) -> str:
+        """
+        Command output
+
+        Args:
+            command (str): Command
+            delay_factor (int): Netmiko delay factor (not used)
+            max_loops (int): Netmiko read loops (not used)
+
+        Returns:
+            (str): Command output
+        """
+        words = command.split()
+        if command == 'wr mem':
+            time.sleep(self.network.save_latency)
+            with self.network.saves.get_lock():
+                self.network.saves.value += 1
+            return 'Building configuration...\n[OK]'
+        time.sleep(self.network.latency)
+        if words[:2] == ['sh', 'version']:
+            return 'Model number                    : WS-C2960X-48FPD-L'
+        if words[:3] == ['sh', 'run', 'interface']:
+            return 'Building configuration...\n\n' + \
+                self.interface(words[3]) + 'end\n'
+        if words[:2] == ['sh', 'interface']:
+            return words[2] + ' is up, line protocol is up (connected)'
+        if command.startswith('sh logging'):
+            # Port names are matched as substrings by check_hub(),
+            # all ports have two-digit numbers
+            date = datetime.datetime.today().strftime('%b %d')
+            return '\n'.join(date + ' 09:00:00: %PORT_SECURITY-2-'
+                             'PSECURE_VIOLATION: Security violation '
+                             'occurred, caused by MAC address ' + mac +
+                             ' on port ' + port + '.'
+                             for port, mac in sorted(self.ports.items()))
+        if words[:2] == ['sh', 'port-security']:
+            # Whole table or '| include <MAC>'
+            return '\n'.join('  10    ' + str(self.sticky(port)) +
+                             '    SecureSticky   ' + short_port(port) +
+                             '    -'
+                             for port in sorted(self.ports)
+                             if self.sticky(port) is not None and
+                             (len(words) == 3 or
+                              self.sticky(port) == words[-1]))
+        if words[:4] == ['clear', 'port-security', 'sticky', 'interface']:
+            self.learned[words[4]] = time.monotonic() + \
+                self.network.learn_delay
+            return ''
+        return ''
+
+
+def cisco_mac(mac: str) -> str:
+    """
+    MAC-address in the Cisco format
+
+    Args:
+        mac (str): MAC-address without separators
+
+    Returns:
+        (str): xxxx.xxxx.xxxx
+    """
+    return mac[:4] + '.' + mac[4:8] + '.' + mac[8:12]
+
+
+def make_tickets(count: int, switches: int) -> List[Ticket]:
+    """
+    Tickets spread over the switches
+    (ports Gi<member>/0/10 - Gi<member>/0/48)
+
+    Args:
+        count (int): Number of tickets
+        switches (int): Number of switches
+
+    Returns:
+        (list): Scripted tickets
+    """
+    messages = ticket_corpus(count)
+    tickets = []
+    for number in range(count):
+        slot = number // switches
+        port = 'GigabitEthernet' + str(slot // 39 + 1) + '/0/' + \
+            str(slot % 39 + 10)
+        mac = random_mac()
+        # The corpus message gets the MAC of the scripted device
+        text = messages[number].split('\r\n\r\n')
+        text[1] = 'Прошу подключить устройство ' + cisco_mac(mac).upper() + \
+            ' в кабинете ' + str(100 + number % 400)
+        tickets.append(Ticket(mac,
+                              '10.0.' + str(number % switches // 250) + '.' +
+                              str(number % switches % 250 + 1),
+                              port,
+                              '\r\n\r\n'.join(text)))
+    return tickets
+
+
+def process_rss(pid: int) -> int:
+    """
+    Resident set size of a process
+
+    Args:
+        pid (int): Process ID
+
+    Returns:
+        (int): RSS in kB (0 if unknown)
+    """
+    try:
+        with open('/proc/' + str(pid) + '/status', 'r') as status_f:
+            for line in status_f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Nearest-rank percentile
+
+    Args:
+        values (list): Values
+        share (float): Percentile from 0 to 1
+
+    Returns:
+        (float): Value
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(share * len(values)), len(values) - 1)]
+
+
+def run_load(tickets: int = 500,
+             switches: int = 20,
+             workers: int = 8,
+             latency: float = 0.05,
+             save_latency: float = 0.5,
+             learn_delay: float = 0.5,
+             connect_delay: float = 2.0,
+             interval: float = 0.0,
+             timeout: float = 1800.0,
+             bulk: int = 1
+             ) -> Dict[str, str]:
+    """
+    Sends the tickets through psec.main() and waits for all results
+
+    Args:
+        tickets (int): Number of tickets
+        switches (int): Number of switches
+        workers (int): Number of task processes
+        latency (float): Response time of a switch command in seconds
+        save_latency (float): Response time of 'wr mem' in seconds
+        learn_delay (float): Sticky learn time after a clear in seconds
+        connect_delay (float): Time from the ticket to the violation event
+            in the log server DB in seconds
+        interval (float): Time between tickets in seconds (0 - one burst)
+        timeout (float): Test duration limit in seconds
+        bulk (int): Devices per ticket (more than 1 - bulk tickets)
+
+    Returns:
+        (dict): Results names and values
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='psec_load_') + '/'
+    os.makedirs(tmp_dir + 'logs/')
+    pop3 = FakePOP3Server()
+    smtp = FakeSMTPServer()
+    with open(tmp_dir + 'cisco_params.json', 'w') as cisco_f:
+        json.dump({'device_type': 'cisco_ios', 'host': '',
+                   'username': 'psec', 'password': 'psec'}, cisco_f)
+    config = {
+        'proj_dir': tmp_dir,
+        'log_dir': tmp_dir + 'logs/',
+        'mail_server': '127.0.0.1',
+        'pop3_port': pop3.server_address[1],
+        'smtp_server': '127.0.0.1:' + str(smtp.server_address[1]),
+        'mailbox': 'netadmin@example.com',
+        'mail_from': 'psec@example.com',
+        'mail_pass': 'PASS',
+        'mail_backend': 'pop3',
+        'mail_poll_interval': 0.5,
+        'pool_workers': workers,
+        # A burst is not rejected
+        'pool_queue_size': max(100, tickets),
+        'pool_max_tasks': 0,
+        'log_poll_interval': 1,
+        'log_register_delay': 0.5,
+        'work_end_hour': 24,
+        'bulk_max_macs': max(bulk, 50),
+        'outbox_poll_interval': 0.2,
+        'db_backend': 'sqlite',
+        'db_path': tmp_dir + 'syslog.db',
+        'db_pool_size': 1,
+        'bad_ips': [],
+        'infsec_emails': ['infsec@example.com'],
+    }
+    scripted = make_tickets(tickets, switches)
+    network = FakeNetwork(scripted, latency, save_latency, learn_delay)
+    syslog = SyslogDB(config)
+    psec.init_service(config)
+    # Task processes are forked with the simulated switches
+    ssh_pool._pool['instance'] = SessionPool(config, network.connect)
+    threading.Thread(target=psec.main, name='psec_main', daemon=True).start()
+
+    peak = {'total': 0, 'main': 0, 'worker': 0}
+
+    def sample_rss() -> None:
+        while True:
+            main_rss = process_rss(os.getpid())
+            worker_rss = [process_rss(proc.pid)
+                          for proc in psec.pool.workers if proc is not None]
+            peak['main'] = max(peak['main'], main_rss)
+            peak['worker'] = max([peak['worker']] + worker_rss)
+            peak['total'] = max(peak['total'], main_rss + sum(worker_rss))
+            time.sleep(0.5)
+    threading.Thread(target=sample_rss, daemon=True).start()
+
+    sent: Dict[str, float] = {}
+
+    def connect_device(ticket: Ticket) -> None:
+        with syslog.connection() as conn:
+            conn.execute('INSERT INTO SystemEvents (DeviceReportedTime, '
+                         'FromHost, Message) VALUES (?, ?, ?)',
+                         (datetime.datetime.now(), ticket.switch,
+                          '%PORT_SECURITY-2-PSECURE_VIOLATION: Security '
+                          'violation occurred, caused by MAC address ' +
+                          cisco_mac(ticket.mac) + ' on port ' +
+                          ticket.port + '.'))
+
+    start = time.time()
+    for number in range(0, len(scripted), bulk):
+        batch = scripted[number:number + bulk]
+        if len(batch) == 1:
+            message = batch[0].message
+        else:
+            message = 'Прошу подключить устройства:\r\n' + \
+                '\r\n'.join(cisco_mac(ticket.mac).upper()
+                             for ticket in batch)
+        for ticket in batch:
+            sent[ticket.mac] = time.time()
+        pop3.deliver('infsec@example.com', message)
+        for ticket in batch:
+            timer = threading.Timer(connect_delay, connect_device, [ticket])
+            timer.daemon = True
+            timer.start()
+        if interval:
+            time.sleep(interval)
+    with smtp.lock:
+        smtp.done.wait_for(lambda: len(smtp.results) >= tickets,
+                           timeout=timeout)
+        results = dict(smtp.results)
+    elapsed = max([finished for result, finished in results.values()] +
+                  [start]) - start
+    provision = [finished - sent[mac]
+                 for mac, (result, finished) in results.items()
+                 if result == 'Task completed' and mac in sent]
+    stats = psec.service_stats()
+    psec.pool.close(timeout=1)
+    syslog.close()
+    pop3.shutdown()
+    smtp.shutdown()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        'Tickets': str(tickets),
+        'Mails': str(len(range(0, len(scripted), bulk))),
+        'Completed': str(len(provision)),
+        'Failed': str(len([result for result, finished in results.values()
+                           if result == 'Task failed'])),
+        'No result': str(tickets - len(results)),
+        'Duration (s)': f'{elapsed:.1f}',
+        'Tickets/hour': f'{len(results) / elapsed * 3600:.0f}'
+                        if elapsed else '0',
+        'Time-to-provision p50 (s)': f'{percentile(provision, 0.5):.2f}',
+        'Time-to-provision p95 (s)': f'{percentile(provision, 0.95):.2f}',
+        'Peak RSS total (MB)': f'{peak["total"] / 1024:.1f}',
+        'Peak RSS main process (MB)': f'{peak["main"] / 1024:.1f}',
+        'Peak RSS task process (MB)':
+            f'{max(peak["worker"], children) / 1024:.1f}',
+        'Log server queries': stats.get('Log watcher queries', ''),
+        'Config saves (wr mem)': str(network.saves.value),
+        'Work directory': tmp_dir,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tickets', type=int, default=500)
+    parser.add_argument('--switches', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='switch command response time, s')
+    parser.add_argument('--save-latency', type=float, default=0.5,
+                        help="'wr mem' response time, s")
+    parser.add_argument('--learn-delay', type=float, default=0.5,
+                        help='sticky learn time after a clear, s')
+    parser.add_argument('--connect-delay', type=float, default=2.0,
+                        help='time from the ticket to the log server '
+                        'event, s')
+    parser.add_argument('--interval', type=float, default=0.0,
+                        help='time between tickets, s (0 - one burst)')
+    parser.add_argument('--timeout', type=float, default=1800.0)
+    parser.add_argument('--bulk', type=int, default=1,
+                        help='devices per ticket (more than 1 - bulk '
+                        'tickets)')
+    args = parser.parse_args()
+    results = run_load(args.tickets, args.switches, args.workers,
+                       args.latency, args.save_latency, args.learn_delay,
+                       args.connect_delay, args.interval, args.timeout,
+                       args.bulk)
+    for name, value in results.items():
+        print(f'{name}: {value}')
@@ -4,9 +4,15 @@ Parser for answers from log-server
 """
 import logging
 import re
-from typing import Dict
+from typing import Dict, List, Tuple
 
 from service_funcs import end_task
+from syslog_db import SyslogEvent
+
+# Switch address and port in a port-security message
+REG_IP = r'([0-9]{1,3}[.]){3}([0-9]{1,3})'
+RE_PORT = r'(\S+Ethernet\d+/\d+/\d+)' \
+    r'|(\S+Ethernet\d+/\d+)|(\S+Ethernet\d+)'
 
 
 def get_cisco_ip_addr(answer: str,
@@ -30,13 +36,12 @@ def get_cisco_ip_addr(answer: str,
     Returns:
         ip (str): Device IP-address
     """
-    reg_ip: str = r'([0-9]{1,3}[.]){3}([0-9]{1,3})'
-    match_ip = re.search(reg_ip, answer)
+    match_ip = re.search(REG_IP, answer)
     if match_ip is None:
         logging.info('IP-address cannot be found in message\r\n\r\n'
                      '\r\n\r\nTask failed')
         task_result = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
+        end_task(log_file_name, mac, task_result, config, 'log_parse')
         raise RuntimeError("end_task() does not work properly")
     ip = match_ip.group()
     return ip
@@ -63,14 +68,12 @@ def get_cisco_port_num(answer: str,
     Returns:
         port (str): Device port number
     """
-    re_port: str = r'(\S+Ethernet\d+/\d+/\d+)' \
-        r'|(\S+Ethernet\d+/\d+)|(\S+Ethernet\d+)'
-    match_port = re.search(re_port, answer)
+    match_port = re.search(RE_PORT, answer)
     if match_port is None:
         logging.info('Port number cannot be found in message\r\n\r\n'
                      '\r\n\r\nTask failed')
         task_result = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
+        end_task(log_file_name, mac, task_result, config, 'log_parse')
         raise RuntimeError("end_task() does not work properly")
     port = match_port.group()
     return port
@@ -110,3 +113,82 @@ def log_parse(sql_answer: Dict[str, str],
     else:
         raise ValueError("task_params['vendor'] must be 'cisco'"
                          "other vendors are not yet implemented")
+
+
+def bulk_parse(answers: Dict[str, Dict[str, str]],
+               config: dict
+               ) -> Tuple[Dict[str, Dict[str, str]], Dict[str, str]]:
+    """
+    Task params of every MAC of a bulk task
+    (the checks of a single task, a failed MAC does not end the task)
+
+    Args:
+        answers (dict): Answers from log-server with vendor indication
+            by MAC
+        config (dict): Dict with config data
+
+    Returns:
+        ports (dict): Task params by MAC
+        failed (dict): Failure reason by MAC
+    """
+    ports: Dict[str, Dict[str, str]] = {}
+    failed: Dict[str, str] = {}
+    for mac, sql_answer in answers.items():
+        answer = sql_answer['answer']
+        if 'Task failed' in answer:
+            logging.info(mac + ': ' + answer)
+            if 'CONNECTION ERROR' in answer:
+                failed[mac] = 'log_server_error'
+            else:
+                failed[mac] = 'not_located'
+            continue
+        logging.info(mac + ' SQL_ANSWER: ' + answer + '\r\n')
+        match_ip = re.search(REG_IP, answer)
+        match_port = re.search(RE_PORT, answer)
+        if sql_answer['vendor'] != 'cisco' or \
+                match_ip is None or match_port is None:
+            logging.info('!!!NOT OK!!! ' + mac + ': IP-address or port '
+                         'number cannot be found in message\r\n')
+            failed[mac] = 'log_parse'
+        elif match_ip.group() in config['bad_ips']:
+            logging.info('!!!NOT OK!!! ' + mac + ': the host is in the '
+                         'list of excluded addresses\r\n')
+            failed[mac] = 'excluded_switch'
+        else:
+            ports[mac] = {
+                'vendor': 'cisco',
+                'ip_addr': match_ip.group(),
+                'mac_addr': mac[:4] + '.' + mac[4:8] + '.' + mac[8:12],
+                'port_num': match_port.group(),
+            }
+    return ports, failed
+
+
+def match_events(events: List[SyslogEvent],
+                 macs: List[str]
+                 ) -> Dict[str, Dict[str, str]]:
+    """
+    Splits the events found by a batched query by MAC
+    (rows are sorted from the newest, the newest event is taken)
+
+    Args:
+        events (list): SystemEvents rows
+        macs (list): Device MAC-addresses
+
+    Returns:
+        found (dict): Answers from log-server with vendor indication by MAC
+    """
+    macs_cisco = {mac[:4] + '.' + mac[4:8] + '.' + mac[8:12]: mac
+                  for mac in macs}
+    reg_mac: str = r'[0-9a-f]{4}[.][0-9a-f]{4}[.][0-9a-f]{4}'
+    found: dict = {}
+    for event in events:
+        if 'PORT_SECURITY-2-PSECURE_VIOLATION' not in event.message:
+            continue
+        for mac_cisco in re.findall(reg_mac, event.message):
+            mac = macs_cisco.get(mac_cisco)
+            if mac is not None and mac not in found:
+                found[mac] = {'vendor': 'cisco',
+                              'answer': event.from_host + ' ' +
+                              event.message}
+    return found
@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+"""
+Structured task logging
+Task processes send log records to the main process,
+one writer appends them to a JSONL file
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+from worker_pool import post_event, wait_reply
+
+# Task fields of every record
+TASK_FIELDS = ('tracker', 'mac', 'stage', 'switch', 'outcome')
+
+# Writer of the main process
+_main: Dict[str, 'TaskLogWriter'] = {}
+
+
+def record_dict(record: logging.LogRecord) -> Dict[str, Any]:
+    """
+    Log record in the JSONL form
+
+    Args:
+        record (logging.LogRecord): Log record
+
+    Returns:
+        (dict): Record fields
+    """
+    message = record.getMessage()
+    if record.exc_info:
+        message += '\n' + logging.Formatter().formatException(
+            record.exc_info)
+    data: Dict[str, Any] = {'time': record.created,
+                            'level': record.levelname}
+    for field in TASK_FIELDS:
+        data[field] = getattr(record, field, '')
+    data['duration'] = round(getattr(record, 'duration', 0.0), 3)
+    data['message'] = message
+    return data
+
+
+class TaskContext(logging.Filter):
+    """
+    Adds the fields of the current task to the records
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.fields: Dict[str, str] = {}
+        self.start = time.time()
+
+    def set(self, **fields: str) -> None:
+        """
+        Updates the task fields
+
+        Args:
+            **fields: tracker, mac, stage, switch
+        """
+        if 'tracker' in fields and \
+                fields['tracker'] != self.fields.get('tracker'):
+            self.fields = {}
+            self.start = time.time()
+        self.fields.update(fields)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for field in TASK_FIELDS:
+            if not hasattr(record, field):
+                setattr(record, field, self.fields.get(field, ''))
+        if not hasattr(record, 'duration'):
+            record.duration = record.created - self.start
+        return True
+
+
+class EventHandler(logging.Handler):
+    """
+    Sends records from a task process to the main process
+    """
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            post_event('log', record_dict(record))
+        # Catch all ¯\_(ツ)_/¯
+        except Exception:
+            self.handleError(record)
+
+
+class WriterHandler(logging.Handler):
+    """
+    Writes records of the main process
+    """
+    def __init__(self, writer: 'TaskLogWriter') -> None:
+        super().__init__()
+        self.writer = writer
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.writer.write(record_dict(record))
+        # Catch all ¯\_(ツ)_/¯
+        except Exception:
+            self.handleError(record)
+
+
+class TaskLogWriter:
+    """
+    Single append-only JSONL writer (main process)
+    Records of open tasks are kept for rendering the task log,
+    the file is moved to the archive directory every day
+    (the records of tasks open at that moment are saved
+    next to the file and loaded after a restart)
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.path = config.get('task_log_file',
+                               config['log_dir'] + 'tasks.jsonl')
+        self.open_path = self.path + '.open'
+        self.archive_dir = config['log_dir'] + 'log_archive/'
+        self.fsync_interval = float(config.get('log_fsync_interval', 5))
+        self.lock = threading.Lock()
+        self.records: Dict[str, List[Dict[str, Any]]] = {}
+        self.log_f: Any = None
+        self.day = ''
+        self.last_fsync = 0.0
+        self.written = 0
+
+    def open(self) -> None:
+        """
+        Opens the JSONL file, records of open tasks are loaded
+        """
+        with self.lock:
+            # Tasks open at the last rotation, then the current file
+            for path in (self.open_path, self.path):
+                if not os.path.exists(path):
+                    continue
+                with open(path, 'r') as log_f:
+                    for line in log_f:
+                        try:
+                            self.keep(json.loads(line))
+                        except ValueError:
+                            continue
+            # Finished tasks are not kept
+            for tracker in list(self.records):
+                if any(data.get('outcome')
+                       for data in self.records[tracker]):
+                    del self.records[tracker]
+            if os.path.exists(self.path):
+                self.day = datetime.date.fromtimestamp(
+                    os.path.getmtime(self.path)).isoformat()
+            else:
+                self.day = datetime.date.today().isoformat()
+            self.log_f = open(self.path, 'a')
+
+    def keep(self, data: Dict[str, Any]) -> None:
+        """
+        Keeps a record of an open task
+
+        Args:
+            data (dict): Record fields
+        """
+        if data.get('tracker'):
+            self.records.setdefault(data['tracker'], []).append(data)
+
+    def rotate(self) -> None:
+        """
+        Moves the file of the previous day to the archive directory
+        The records of open tasks are saved first
+        """
+        with open(self.open_path + '.tmp', 'w') as open_f:
+            for records in self.records.values():
+                for data in records:
+                    open_f.write(json.dumps(data, ensure_ascii=False) + '\n')
+        os.replace(self.open_path + '.tmp', self.open_path)
+        self.log_f.close()
+        os.makedirs(self.archive_dir, exist_ok=True)
+        os.replace(self.path,
+                   self.archive_dir + 'tasks_' + self.day + '.jsonl')
+        self.log_f = open(self.path, 'a')
+        self.day = datetime.date.today().isoformat()
+
+    def write(self, data: Dict[str, Any]) -> None:
+        """
+        Appends a record
+
+        Args:
+            data (dict): Record fields
+        """
+        with self.lock:
+            if self.log_f is None:
+                return
+            if datetime.date.today().isoformat() != self.day:
+                self.rotate()
+            self.log_f.write(json.dumps(data, ensure_ascii=False) + '\n')
+            self.keep(data)
+            self.written += 1
+            now = time.monotonic()
+            if now - self.last_fsync >= self.fsync_interval:
+                self.log_f.flush()
+                os.fsync(self.log_f.fileno())
+                self.last_fsync = now
+
+    def render(self, tracker: str) -> str:
+        """
+        Human-readable task log
+        The records of a task with an outcome are released
+
+        Args:
+            tracker (str): Task tracker
+
+        Returns:
+            (str): Task log
+        """
+        with self.lock:
+            records = self.records.get(tracker, [])
+            if any(data.get('outcome') for data in records):
+                self.records.pop(tracker, None)
+        return ''.join(datetime.datetime.fromtimestamp(data['time'])
+                       .strftime('%Y-%m-%d %H:%M:%S') + ' ' +
+                       data['message'] + '\n' for data in records)
+
+    def release(self, tracker: str) -> None:
+        """
+        Releases the records of a task that ended without an outcome
+        (failed with an error or killed)
+
+        Args:
+            tracker (str): Task tracker
+        """
+        with self.lock:
+            self.records.pop(tracker, None)
+
+    def close(self) -> None:
+        """
+        Flushes and closes the JSONL file
+        """
+        with self.lock:
+            if self.log_f is not None:
+                self.log_f.flush()
+                os.fsync(self.log_f.fileno())
+                self.log_f.close()
+                self.log_f = None
+
+    def report(self) -> Dict[str, str]:
+        """
+        Writer statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        return {
+            'Log records written': str(self.written),
+            'Open task logs': str(len(self.records)),
+        }
+
+
+def install_writer(writer: TaskLogWriter) -> None:
+    """
+    Main process logging: records go straight to the writer
+
+    Args:
+        writer (TaskLogWriter): JSONL writer
+    """
+    _main['writer'] = writer
+    logging.root.addHandler(WriterHandler(writer))
+    logging.root.setLevel(logging.INFO)
+
+
+def task_logging(context: TaskContext) -> None:
+    """
+    Task process logging: records go to the main process
+    (set up once per process)
+
+    Args:
+        context (TaskContext): Current task fields
+    """
+    if any(isinstance(handler, EventHandler)
+           for handler in logging.root.handlers):
+        return
+    # Handlers inherited from the main process are dropped
+    _main.clear()
+    for handler in logging.root.handlers[:]:
+        logging.root.removeHandler(handler)
+        handler.close()
+    handler = EventHandler()
+    handler.addFilter(context)
+    logging.root.addHandler(handler)
+    logging.root.setLevel(logging.INFO)
+    logging.getLogger("paramiko").setLevel(logging.WARNING)
+
+
+def task_log(tracker: str) -> str:
+    """
+    Human-readable task log (from any process)
+
+    Args:
+        tracker (str): Task tracker
+
+    Returns:
+        (str): Task log
+    """
+    if 'writer' in _main:
+        return _main['writer'].render(tracker)
+    post_event('render', tracker)
+    # No reply in time - the task is closed with an empty log
+    return wait_reply('render ' + tracker, default='')
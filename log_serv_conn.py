@@ -2,73 +2,96 @@
 """
 Connection to log-server
 """
-import datetime
 import json
 import logging
-import time
-from typing import Dict
+import os
+from typing import Dict, List, Optional, Set
 
-from netmiko import (ConnectHandler,
-                     NetmikoAuthenticationException,
-                     NetmikoTimeoutException)
+from log_parser import match_events
+from service_funcs import create_sql_query
+from syslog_db import SyslogDB
+from worker_pool import post_event
 
-from service_funcs import end_task
 
+class LogServerDB:
+    """
+    Log server database queries for the log watcher (main process)
+    Each poll scans only the rows added since the previous poll
+    (ID cursor), a newly registered MAC is searched once
+    in today's rows before the cursor
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.db = SyslogDB(config)
+        self.cursor_file = config.get('log_cursor_file',
+                                      config['proj_dir'] + 'log_cursor.json')
+        self.last_id: Optional[int] = None
+        if os.path.exists(self.cursor_file):
+            with open(self.cursor_file, 'r') as cursor_f:
+                self.last_id = json.load(cursor_f)['last_id']
+        self.known_macs: Set[str] = set()
+
+    def save_cursor(self, last_id: int) -> None:
+        """
+        Persists the ID cursor
+
+        Args:
+            last_id (int): Last ID seen
+        """
+        self.last_id = last_id
+        with open(self.cursor_file + '.tmp', 'w') as cursor_f:
+            json.dump({'last_id': last_id}, cursor_f)
+        os.replace(self.cursor_file + '.tmp', self.cursor_file)
+
+    def lookup(self, macs: List[str]) -> Dict[str, Dict[str, str]]:
+        """
+        Sends SQL queries for all waiting MACs to the log server database
 
-def log_server_check(sql_query: str,
-                     log_file_name: str,
-                     mac: str,
-                     config: dict
-                     ) -> Dict[str, str]:
+        Args:
+            macs (list): Device MAC-addresses
+
+        Returns:
+            (dict): Answers from log-server with vendor indication by MAC
+        """
+        max_id = self.db.execute('SELECT MAX(ID) FROM SystemEvents')[0][0]
+        max_id = max_id or 0
+        # First start or the table was recreated
+        if self.last_id is None or self.last_id > max_id:
+            self.last_id = max_id
+        events = []
+        if max_id > self.last_id:
+            events += self.db.events(*create_sql_query(macs,
+                                                       self.last_id,
+                                                       max_id))
+        new_macs = [mac for mac in macs if mac not in self.known_macs]
+        if new_macs:
+            events += self.db.events(*create_sql_query(new_macs,
+                                                       0,
+                                                       self.last_id))
+        self.known_macs = set(macs)
+        if max_id != self.last_id:
+            self.save_cursor(max_id)
+        return match_events(events, macs)
+
+
+def log_server_watch(task_id: int, log_file_name: str, mac: str) -> None:
     """
-    Sends an SQL query to the log server database
-    and waits for response during the working day
+    Registers the MAC in the log watcher
+    The task process is released, the task is resumed
+    when the device connects or at the end of the working day
 
     Args:
-        sql_query (str): SQL query
+        task_id (int): Task ID
         log_file_name (str): Log file name (for current task)
         mac (str): Device MAC-address
-        config (dict): Dict with config data
-
-    Raises:
-        RuntimeError("end_task() does not work properly"): If end_task()
-            does not end the process
-
-    Returns:
-        answer (dict): Answer from log-server with vendor indication
-        answer (dict): End of the working day - events with this device
-            were not found in the log server database
     """
-    with open(config['proj_dir'] + 'sql_params.json', 'r') as sql_params:
-        sql = json.load(sql_params)
-    try:
-        with ConnectHandler(**sql) as sql_ssh:
-            logging.info('\r\n>>>------------------------SQL-QUERY---------'
-                         '----------------<<<\r\n\r\n\r\n' +
-                         sql_query.split('"')[1] +
-                         '\r\n\r\nWaiting for device connection............'
-                         '...\r\n\r\n')
-            while True:
-                hour = int(datetime.datetime.today().strftime('%H'))
-                if hour < 18:
-                    answer = sql_ssh.send_command(sql_query, delay_factor=30)
-                    if 'PORT_SECURITY-2-PSECURE_VIOLATION' in answer:
-                        answer = {'vendor': 'cisco', 'answer': answer}
-                        sql_ssh.disconnect()
-                        return answer
-                    time.sleep(60)
-                # End of the working day
-                else:
-                    no_connecting = '!!!NOT OK!!! Events with this device' \
-                        'were not found in the log server database ' \
-                        'during the working day\r\n\r\nTask failed'
-                    answer = {'vendor': 'None', 'answer': no_connecting}
-                    sql_ssh.disconnect()
-                    return answer
-    except (NetmikoTimeoutException, NetmikoAuthenticationException) as error:
-        logging.info('LOG SERVER CONNECTION ERROR\r\n\r\n' +
-                     str(error) +
-                     '\r\n\r\nTask failed')
-        task_result = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
-        raise RuntimeError("end_task() does not work properly")
+    logging.info('\r\n>>>------------------------SQL-QUERY---------'
+                 '----------------<<<\r\n\r\n\r\n' +
+                 mac +
+                 ' is registered in the log watcher'
+                 '\r\n\r\nWaiting for device connection............'
+                 '...\r\n\r\n')
+    post_event('locate', task_id)
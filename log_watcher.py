@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+"""
+Shared log-server watcher for all waiting tasks
+"""
+import datetime
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+class LogWatcher:
+    """
+    Waits for device connection events of all registered MACs
+    One batched log-server query per interval covers every pending MAC,
+    the results are passed to the waiting tasks
+    A failed query is retried with a growing delay, the waiting tasks
+    fail only if the log server stays unavailable
+    """
+    def __init__(self,
+                 lookup: Callable[[List[str]], Dict[str, Dict[str, str]]],
+                 config: dict
+                 ) -> None:
+        """
+        Args:
+            lookup (Callable): Batched log-server query,
+                gets MACs and returns answers by MAC
+            config (dict): Dict with config data
+        """
+        self.lookup = lookup
+        self.interval = float(config.get('log_poll_interval', 60))
+        self.register_delay = float(config.get('log_register_delay', 2))
+        self.end_hour = int(config.get('work_end_hour', 18))
+        self.error_timeout = float(config.get('log_error_timeout', 600))
+        self.retry_delay = float(config.get('log_retry_delay', 5))
+        self.pending: Dict[str, Dict[str, Callable]] = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.queries = 0
+        self.notified = 0
+        self.last_query = 0.0
+        # Failed queries in a row, time of the first one, next attempt
+        self.failures = 0
+        self.failing_since = 0.0
+        self.retry_at = 0.0
+
+    def register(self, mac: str, key: str, callback: Callable) -> None:
+        """
+        Registers a waiting task
+
+        Args:
+            mac (str): Device MAC-address
+            key (str): Waiter key (task tracker)
+            callback (Callable): Gets the answer from log-server
+                with vendor indication
+        """
+        with self.lock:
+            self.pending.setdefault(mac, {})[key] = callback
+        self.wake.set()
+
+    def unregister(self, mac: str, key: str) -> None:
+        """
+        Removes a waiting task
+
+        Args:
+            mac (str): Device MAC-address
+            key (str): Waiter key (task tracker)
+        """
+        with self.lock:
+            waiters = self.pending.get(mac, {})
+            waiters.pop(key, None)
+            if not waiters:
+                self.pending.pop(mac, None)
+
+    def notify(self, mac: str, answer: Dict[str, str]) -> int:
+        """
+        Passes the answer to all tasks waiting for the MAC
+
+        Args:
+            mac (str): Device MAC-address
+            answer (dict): Answer from log-server with vendor indication
+
+        Returns:
+            (int): Number of notified tasks
+        """
+        with self.lock:
+            waiters = self.pending.pop(mac, {})
+        for callback in waiters.values():
+            callback(answer)
+        self.notified += len(waiters)
+        return len(waiters)
+
+    def poll(self) -> None:
+        """
+        One batched log-server query for all pending MACs
+        """
+        with self.lock:
+            macs = sorted(self.pending)
+        if not macs:
+            return
+        hour = int(datetime.datetime.today().strftime('%H'))
+        # End of the working day
+        if hour >= self.end_hour:
+            no_connecting = '!!!NOT OK!!! Events with this device' \
+                'were not found in the log server database ' \
+                'during the working day\r\n\r\nTask failed'
+            for mac in macs:
+                self.notify(mac, {'vendor': 'None', 'answer': no_connecting})
+            return
+        start = time.monotonic()
+        if start < self.retry_at:
+            return
+        try:
+            found = self.lookup(macs)
+        # Catch all ¯\_(ツ)_/¯
+        except Exception as error:
+            self.failed(macs, error)
+            return
+        self.failures = 0
+        self.retry_at = 0.0
+        self.queries += 1
+        self.last_query = time.monotonic() - start
+        for mac, answer in found.items():
+            self.notify(mac, answer)
+
+    def failed(self, macs: List[str], error: Exception) -> None:
+        """
+        Failed log-server query
+        The MACs stay pending and the query is retried, the delay
+        doubles up to the poll interval, the waiting tasks fail
+        after 'log_error_timeout' seconds of failed queries
+
+        Args:
+            macs (list): Pending MACs
+            error (Exception): Query error
+        """
+        now = time.monotonic()
+        if not self.failures:
+            self.failing_since = now
+        self.failures += 1
+        logging.warning('Log server query failed (' + str(self.failures) +
+                        ' in a row): ' + str(error))
+        if now - self.failing_since < self.error_timeout:
+            self.retry_at = now + min(self.interval, self.retry_delay *
+                                      2 ** (self.failures - 1))
+            return
+        connection_error = 'LOG SERVER CONNECTION ERROR\r\n\r\n' + \
+            str(error) + '\r\n\r\nTask failed'
+        for mac in macs:
+            self.notify(mac, {'vendor': 'None', 'answer': connection_error})
+        # Tasks registered later get their own waiting time
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def run(self) -> None:
+        """
+        Watcher loop
+        """
+        while True:
+            # New MACs are queried right away,
+            # a short delay gathers a burst into one query,
+            # a failed query is retried earlier
+            timeout = self.interval
+            if self.retry_at:
+                timeout = max(0.0, min(timeout,
+                                       self.retry_at - time.monotonic()))
+            if self.wake.wait(timeout):
+                time.sleep(self.register_delay)
+            self.wake.clear()
+            self.poll()
+
+    def start(self) -> None:
+        """
+        Starts the watcher thread
+        """
+        threading.Thread(target=self.run,
+                         name='psec_log_watcher',
+                         daemon=True).start()
+
+    def report(self) -> Dict[str, str]:
+        """
+        Watcher statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        with self.lock:
+            macs = len(self.pending)
+            waiters = sum(len(waiters) for waiters in self.pending.values())
+        return {
+            'Log watcher pending MACs': str(macs),
+            'Log watcher waiting tasks': str(waiters),
+            'Log watcher queries': str(self.queries),
+            'Log watcher last query (s)': f'{self.last_query:.2f}',
+            'Log watcher notified tasks': str(self.notified),
+        }
@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+"""
+MAC-address extraction from ticket messages
+"""
+import re
+from typing import Iterable, List, NamedTuple
+
+# Hex digit or a look-alike letter (Cyrillic 'А', 'В', 'С', 'Е', 'О',
+# Latin 'O')
+MAC_CHAR = '[0-9A-Fa-fАаВСсЕеOО]'
+# Any whitespace or one of the usual separators
+MAC_SEP = r'[\s:.-]'
+
+# A MAC-address between whitespace (or the message ends):
+# 6 groups of 2, 4 groups of 3, 3 groups of 4 or 12 characters
+# The pattern starts with a character class, so the regex engine
+# skips the positions that cannot start a MAC-address
+MAC_RE = re.compile(r'({c}(?<!\S.)(?:'
+                    r'{c}(?:{s}{c}{{2}}){{4}}{s}{c}{{2}}'
+                    r'|{c}{{2}}(?:{s}{c}{{3}}){{3}}'
+                    r'|{c}{{3}}(?:{s}{c}{{4}}){{2}}'
+                    r'|{c}{{11}}'
+                    r'))(?!\S)'.format(c=MAC_CHAR, s=MAC_SEP))
+
+# Characters of the whitespace class (all are below U+3001)
+WHITESPACE = ''.join(char for char in map(chr, range(0x3001))
+                     if char.isspace())
+
+# Separators are deleted, look-alike letters become hex digits
+NORMALIZE = str.maketrans('ABCDEFАаВвСсЕеOoОо',
+                          'abcdefaabbccee0000',
+                          ':.-' + WHITESPACE)
+
+# Hex digits are deleted, look-alike letters (typed in the Cyrillic
+# layout or 'O' for zero) become '*', only the separators are kept
+CLASSIFY = str.maketrans('АаВвСсЕеOoОо', '*' * 12,
+                         '0123456789ABCDEFabcdef')
+
+# Candidates below this confidence (12 digits, look-alike letters
+# with mixed separators) are dropped if the message has better ones
+MIN_CONFIDENCE = 0.6
+
+
+class MacCandidate(NamedTuple):
+    """
+    MAC-address found in a message
+    """
+    mac: str
+    start: int
+    end: int
+    confidence: float
+
+
+def confidence(raw: str, mac: str) -> float:
+    """
+    How much the match looks like a MAC-address typed on purpose
+
+    1.0 - usual notation (xx:xx:xx:xx:xx:xx, xx-xx-..., xxxx.xxxx.xxxx
+    or 12 characters with hex letters), less for unusual separators,
+    mixed separators, look-alike letters and 12 digits
+    (more likely a phone or an inventory number)
+
+    Args:
+        raw (str): Matched text
+        mac (str): Normalized MAC-address
+
+    Returns:
+        (float): Confidence from 0 to 1
+    """
+    separators = set(raw.translate(CLASSIFY))
+    look_alike = '*' in separators
+    separators.discard('*')
+    if not separators:
+        value = 1.0 if not mac.isdigit() else 0.5
+    elif len(separators) > 1:
+        value = 0.7
+    elif len(raw) == 17 and separators <= {':', '-'} or \
+            len(raw) == 14 and separators == {'.'}:
+        value = 1.0
+    else:
+        value = 0.9
+    if look_alike:
+        value -= 0.2
+    return round(value, 2)
+
+
+def mac_candidates(message: str) -> List[MacCandidate]:
+    """
+    All MAC-addresses of a message
+
+    Args:
+        message (str): Decoded message from email
+
+    Returns:
+        (list): MAC candidates in order of position
+    """
+    candidates = []
+    for match in MAC_RE.finditer(message):
+        raw = match.group(1)
+        mac = raw.translate(NORMALIZE)
+        start, end = match.span(1)
+        candidates.append(MacCandidate(mac, start, end,
+                                       confidence(raw, mac)))
+    return candidates
+
+
+def extract_macs(messages: Iterable[str]) -> List[List[MacCandidate]]:
+    """
+    MAC-addresses of many messages
+
+    Args:
+        messages (Iterable): Decoded messages
+
+    Returns:
+        (list): MAC candidates of every message
+    """
+    return [mac_candidates(message) for message in messages]
+
+
+def ticket_macs(message: str) -> List[str]:
+    """
+    MAC-addresses of a ticket, each once in order of the message
+    (a phone or an inventory number next to a MAC-address is not one)
+
+    Args:
+        message (str): Decoded message from email
+
+    Returns:
+        (list): MAC-addresses
+    """
+    candidates = mac_candidates(message)
+    if any(candidate.confidence >= MIN_CONFIDENCE
+           for candidate in candidates):
+        candidates = [candidate for candidate in candidates
+                      if candidate.confidence >= MIN_CONFIDENCE]
+    return list(dict.fromkeys(candidate.mac for candidate in candidates))
@@ -0,0 +1,530 @@
+#! /usr/bin/env python3
+"""
+Mail intake backends
+"""
+import imaplib
+import logging
+import poplib
+import select
+import time
+import traceback
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.parser import Parser
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from outbox import spool_message
+
+
+class IntakeStats:
+    """
+    Mail intake throughput and latency counters
+    """
+    def __init__(self, backend: str = 'POP3') -> None:
+        """
+        Args:
+            backend (str): Intake backend name
+        """
+        self.backend = backend
+        self.messages = 0
+        self.sessions = 0
+        self.seconds = 0.0
+        self.last_batch = 0
+        self.last_rate = 0.0
+        self.dispatched_count = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.pending = 0
+
+    def update(self, count: int, elapsed: float, pending: int = 0) -> None:
+        """
+        Accounts one mailbox session
+
+        Args:
+            count (int): Number of messages picked up in the session
+            elapsed (float): Session duration in seconds
+            pending (int): Messages left in the mailbox (batch limit)
+        """
+        self.sessions += 1
+        self.pending = pending
+        self.messages += count
+        self.seconds += elapsed
+        self.last_batch = count
+        if count and elapsed > 0:
+            self.last_rate = count / elapsed
+
+    def dispatch(self, received: Optional[float]) -> None:
+        """
+        Accounts intake-to-dispatch latency of one message
+
+        Args:
+            received (float): Message timestamp (from the topmost
+                Received header)
+        """
+        if received is None:
+            return
+        latency = max(time.time() - received, 0.0)
+        self.dispatched_count += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def report(self) -> Dict[str, str]:
+        """
+        Intake statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        if self.seconds > 0:
+            rate = self.messages / self.seconds
+        else:
+            rate = 0.0
+        if self.dispatched_count:
+            latency = self.latency_sum / self.dispatched_count
+        else:
+            latency = 0.0
+        name = 'Intake ' + self.backend + ' '
+        return {
+            name + 'sessions': str(self.sessions),
+            name + 'messages': str(self.messages),
+            name + 'last batch': str(self.last_batch),
+            name + 'last batch rate (msg/s)': f'{self.last_rate:.2f}',
+            name + 'average rate (msg/s)': f'{rate:.2f}',
+            name + 'average dispatch latency (s)': f'{latency:.2f}',
+            name + 'max dispatch latency (s)': f'{self.latency_max:.2f}',
+        }
+
+
+def parse_message(lines: List[bytes]) -> Dict[str, str]:
+    """
+    Parses a message picked up from the mailbox
+
+    Args:
+        lines (list): Raw message lines
+
+    Returns:
+        raw_message_dict (dict): Dict with message data
+            (senders email, actual data in raw format,
+            HTML flag and message timestamp)
+    """
+    msg_content = b'\r\n'.join(lines).decode('utf-8')
+    msg = Parser().parsestr(msg_content)
+    email_from = (msg.get('From')).split('<')[1].replace('>', '')
+    body = msg
+    if msg.is_multipart():
+        # The text/plain alternative is taken if there is one,
+        # it needs no HTML clearing
+        parts = [part for part in msg.walk()
+                 if part.get_content_maintype() == 'text' and
+                 part.get_filename() is None]
+        plain = [part for part in parts
+                 if part.get_content_subtype() == 'plain']
+        body = (plain or parts)[0]
+    charset = body.get_content_charset() or 'utf-8'
+    raw_mess = body.get_payload(decode=True).decode(charset)
+    html = body.get_content_subtype() == 'html'
+    # The topmost Received header is added by our mail server,
+    # the Date header is the sender's clock
+    try:
+        received = parsedate_to_datetime(
+            msg.get('Received').rsplit(';', 1)[1]).timestamp()
+    except (AttributeError, IndexError, TypeError, ValueError):
+        received = time.time()
+    raw_message_dict = {'email': email_from,
+                        'message': raw_mess,
+                        'html': html,
+                        'received': received}
+    return raw_message_dict
+
+
+def forward_unreadable(content: bytes, config: dict) -> None:
+    """
+    Forwards a message that can not be parsed to the network admin
+    mailbox before it is deleted (called from the exception handler)
+
+    Args:
+        content (bytes): Raw message
+        config (dict): Dict with config data
+    """
+    logging.exception('Unreadable message forwarded to ' +
+                      config['mailbox'])
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Unreadable message removed from the Psec mailbox'
+    msg.attach(MIMEText('The message could not be parsed, it is attached '
+                        'as received\r\n\r\n' + traceback.format_exc()))
+    attachment = MIMEApplication(content, _subtype='octet-stream')
+    attachment.add_header('Content-Disposition',
+                          'attachment',
+                          filename='message.eml')
+    msg.attach(attachment)
+    spool_message(config, [config['mailbox']], msg.as_string())
+
+
+def handled(raw_message_dict: Dict[str, str],
+            handle: Optional[Callable[[Dict[str, str]], None]]
+            ) -> bool:
+    """
+    Passes a picked up message to the handler
+    (the message is deleted from the mailbox only if it is handled)
+
+    Args:
+        raw_message_dict (dict): Dict with message data
+        handle (Callable): Message handler (saves the ticket)
+
+    Returns:
+        (bool): False if the handler failed, the message is left
+            in the mailbox and read again in the next session
+    """
+    if handle is None:
+        return True
+    try:
+        handle(raw_message_dict)
+    # Catch all ¯\_(ツ)_/¯
+    except Exception:
+        logging.exception('Message from ' + raw_message_dict['email'] +
+                          ' not handled, left in the mailbox')
+        return False
+    return True
+
+
+def read_mail(config: dict,
+              stats: Optional[IntakeStats] = None,
+              handle: Optional[Callable[[Dict[str, str]], None]] = None
+              ) -> List[Dict[str, str]]:
+    """
+    Picks up all pending mail from mailbox in a single POP3 session
+    The number of messages per session is limited
+    by the 'mail_batch_size' parameter (0 - no limit)
+    A message is deleted after the handler has saved it,
+    if the session breaks, the messages are read again
+
+    Args:
+        config (dict): Dict with config data
+        stats (IntakeStats): Intake throughput counters
+        handle (Callable): Message handler
+
+    Returns:
+        raw_messages (list): Dicts with message data
+            (senders email, and actual data in raw format)
+        (list): Empty list if mailbox is empty (or other exception)
+    """
+    start = time.monotonic()
+    raw_messages: list = []
+    pending = 0
+    server = poplib.POP3(config['mail_server'],
+                         config.get('pop3_port', poplib.POP3_PORT))
+    try:
+        server.user(config['mail_from'])
+        server.pass_(config['mail_pass'])
+        count, size = server.stat()
+        if count:
+            resp, listing, octets = server.list()
+            numbers = [int(line.split()[0]) for line in listing]
+            batch_size = int(config.get('mail_batch_size', 0))
+            if batch_size > 0:
+                numbers = numbers[:batch_size]
+            pending = count - len(numbers)
+            for number in numbers:
+                resp, lines, octets = server.retr(number)
+                # Unreadable message is forwarded and deleted too,
+                # otherwise it will block the mailbox
+                try:
+                    raw_message_dict = parse_message(lines)
+                except Exception:
+                    forward_unreadable(b'\r\n'.join(lines), config)
+                    server.dele(number)
+                    continue
+                if handled(raw_message_dict, handle):
+                    raw_messages.append(raw_message_dict)
+                    server.dele(number)
+        # Deleting processed messages
+        server.quit()
+    # Session is broken ¯\_(ツ)_/¯
+    # (deletions are not committed, messages will be read again)
+    except Exception:
+        server.close()
+        return []
+    if stats is not None:
+        stats.update(len(raw_messages), time.monotonic() - start, pending)
+    return raw_messages
+
+
+class Pop3Intake:
+    """
+    POP3 polling intake
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.config = config
+        self.stats = IntakeStats('POP3')
+
+    def fetch(self,
+              handle: Optional[Callable[[Dict[str, str]], None]] = None
+              ) -> List[Dict[str, str]]:
+        """
+        Picks up pending mail
+
+        Args:
+            handle (Callable): Message handler
+
+        Returns:
+            (list): Dicts with message data
+        """
+        return read_mail(self.config, self.stats, handle)
+
+    def wait(self) -> None:
+        """
+        Waits before the next mailbox check
+        """
+        time.sleep(self.config.get('mail_poll_interval', 60))
+
+    def dispatch(self, received: Optional[float]) -> None:
+        """
+        Accounts intake-to-dispatch latency of one message
+
+        Args:
+            received (float): Message timestamp
+        """
+        self.stats.dispatch(received)
+
+    def pending(self) -> int:
+        """
+        Messages left in the mailbox after the last session
+
+        Returns:
+            (int): Number of messages
+        """
+        return self.stats.pending
+
+    def report(self) -> Dict[str, str]:
+        """
+        Intake statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        return self.stats.report()
+
+
+class ImapIdleIntake:
+    """
+    IMAP IDLE push intake
+    One long-lived connection, POP3 polling is used as a fallback
+    while the IMAP server is unavailable
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.config = config
+        self.stats = IntakeStats('IMAP')
+        self.fallback = Pop3Intake(config)
+        self.imap: Any = None
+        self.last_backend: Any = self.stats
+
+    def connect(self) -> None:
+        """
+        Opens the IMAP connection and selects the inbox
+
+        Raises:
+            imaplib.IMAP4.error("IMAP server does not support IDLE"):
+                IDLE capability is missing
+        """
+        imap = imaplib.IMAP4(self.config['mail_server'],
+                             self.config.get('imap_port', imaplib.IMAP4_PORT))
+        try:
+            if 'IDLE' not in imap.capabilities:
+                raise imaplib.IMAP4.error('IMAP server does not support IDLE')
+            imap.login(self.config['mail_from'], self.config['mail_pass'])
+            imap.select('INBOX')
+        except Exception:
+            imap.shutdown()
+            raise
+        self.imap = imap
+
+    def close(self) -> None:
+        """
+        Drops the IMAP connection
+        """
+        if self.imap is not None:
+            try:
+                self.imap.logout()
+            except Exception:
+                pass
+            self.imap = None
+
+    def fetch(self,
+              handle: Optional[Callable[[Dict[str, str]], None]] = None
+              ) -> List[Dict[str, str]]:
+        """
+        Picks up pending mail (falls back to POP3 if IMAP is unavailable)
+
+        Args:
+            handle (Callable): Message handler
+
+        Returns:
+            (list): Dicts with message data
+        """
+        try:
+            if self.imap is None:
+                self.connect()
+            raw_messages = self.fetch_imap(handle)
+            self.last_backend = self.stats
+            return raw_messages
+        except (imaplib.IMAP4.error, OSError, EOFError):
+            self.close()
+            self.last_backend = self.fallback.stats
+            return self.fallback.fetch(handle)
+
+    def fetch_imap(self,
+                   handle: Optional[Callable[[Dict[str, str]], None]] = None
+                   ) -> List[Dict[str, str]]:
+        """
+        Picks up all pending mail in the held IMAP session
+        A message is deleted after the handler has saved it
+
+        Args:
+            handle (Callable): Message handler
+
+        Returns:
+            raw_messages (list): Dicts with message data
+        """
+        start = time.monotonic()
+        raw_messages: list = []
+        typ, data = self.imap.search(None, 'ALL')
+        numbers = data[0].split()
+        pending = len(numbers)
+        batch_size = int(self.config.get('mail_batch_size', 0))
+        if batch_size > 0:
+            numbers = numbers[:batch_size]
+        pending -= len(numbers)
+        for number in numbers:
+            typ, data = self.imap.fetch(number, '(RFC822)')
+            # Unreadable message is forwarded and deleted too,
+            # otherwise it will block the mailbox
+            try:
+                raw_message_dict = parse_message(data[0][1].split(b'\r\n'))
+            except Exception:
+                forward_unreadable(data[0][1], self.config)
+                self.imap.store(number, '+FLAGS', '\\Deleted')
+                continue
+            if handled(raw_message_dict, handle):
+                raw_messages.append(raw_message_dict)
+                self.imap.store(number, '+FLAGS', '\\Deleted')
+        if numbers:
+            self.imap.expunge()
+        self.stats.update(len(raw_messages), time.monotonic() - start,
+                          pending)
+        return raw_messages
+
+    def wait(self) -> None:
+        """
+        Waits until a new message lands in the mailbox
+        (or the IDLE timeout expires)
+        """
+        if self.imap is None:
+            self.fallback.wait()
+            return
+        try:
+            self.idle(self.config.get('imap_idle_timeout', 300))
+        except (imaplib.IMAP4.error, OSError, EOFError):
+            self.close()
+
+    def idle(self, timeout: float) -> bool:
+        """
+        IDLE command (RFC 2177)
+
+        Args:
+            timeout (float): Maximum waiting time in seconds
+
+        Raises:
+            imaplib.IMAP4.abort("IDLE rejected"): Server rejected IDLE
+            imaplib.IMAP4.abort("connection closed"): Connection is lost
+
+        Returns:
+            (bool): True if a new message has arrived
+            (bool): False if timeout expired
+        """
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.send(tag + b' IDLE\r\n')
+        if not imap.readline().startswith(b'+'):
+            raise imaplib.IMAP4.abort('IDLE rejected')
+        arrived = False
+        deadline = time.monotonic() + timeout
+        while not arrived:
+            remaining = deadline - time.monotonic()
+            # select() is used instead of a socket timeout,
+            # a timed out socket file can not be read anymore
+            if remaining <= 0 or \
+                    not select.select([imap.sock], [], [], remaining)[0]:
+                break
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed')
+            arrived = line.rstrip().endswith(b'EXISTS')
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imaplib.IMAP4.abort('connection closed')
+            if line.startswith(tag):
+                return arrived
+
+    def dispatch(self, received: Optional[float]) -> None:
+        """
+        Accounts intake-to-dispatch latency of one message
+
+        Args:
+            received (float): Message timestamp
+        """
+        self.last_backend.dispatch(received)
+
+    def pending(self) -> int:
+        """
+        Messages left in the mailbox after the last session
+
+        Returns:
+            (int): Number of messages
+        """
+        return self.last_backend.pending
+
+    def report(self) -> Dict[str, str]:
+        """
+        Intake statistics for the <REPORT> message
+
+        Returns:
+            stats (dict): Statistics names and values
+        """
+        stats = self.stats.report()
+        stats.update(self.fallback.report())
+        return stats
+
+
+def make_intake(config: dict) -> Any:
+    """
+    Intake backend selection
+
+    Args:
+        config (dict): Dict with config data
+
+    Raises:
+        ValueError("config['mail_backend'] must be 'pop3' or 'imap'"):
+            Unknown intake backend
+
+    Returns:
+        (Pop3Intake or ImapIdleIntake): Intake backend
+    """
+    backend = config.get('mail_backend', 'pop3')
+    if backend == 'pop3':
+        return Pop3Intake(config)
+    elif backend == 'imap':
+        return ImapIdleIntake(config)
+    else:
+        raise ValueError("config['mail_backend'] must be 'pop3' or 'imap'")
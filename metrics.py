@@ -0,0 +1,316 @@
+#! /usr/bin/env python3
+"""
+Service metrics in the Prometheus text format
+Task processes send observations to the main process,
+the main process serves them over HTTP
+"""
+import bisect
+import http.server
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from worker_pool import in_worker, post_event
+
+# Histogram buckets in seconds (from a show command to the log server wait)
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+           900, 1800, 3600, 14400)
+
+# Metric types and descriptions
+METRICS = {
+    'psec_stage_duration_seconds':
+        ('histogram', 'Duration of a task stage'),
+    'psec_cisco_method_duration_seconds':
+        ('histogram', 'Duration of a BaseCiscoSSH check or setup step'),
+    'psec_ssh_login_duration_seconds':
+        ('histogram', 'SSH login to a switch'),
+    'psec_sticky_wait_seconds':
+        ('histogram', 'Wait for the MAC to be learned after a sticky reset'),
+    'psec_commit_wait_seconds':
+        ('histogram', 'Wait for the save of a running config change'),
+    'psec_mail_fetch_duration_seconds':
+        ('histogram', 'Mailbox session'),
+    'psec_tasks_total':
+        ('counter', 'Finished tasks by result'),
+    'psec_task_failures_total':
+        ('counter', 'Failed tasks by reason'),
+    'psec_tickets_rejected_total':
+        ('counter', 'Tickets rejected while the pool backlog was full'),
+    'psec_config_commits_total':
+        ('counter', 'Running config changes saved by the task (wr mem) '
+                    'or covered by the save of another task'),
+    'psec_tasks_active':
+        ('gauge', 'Tasks in progress'),
+    'psec_mailbox_pending':
+        ('gauge', 'Messages left in the mailbox after the last session'),
+    'psec_outbox_pending':
+        ('gauge', 'Outgoing messages in the spool'),
+    'psec_pool_queue_depth':
+        ('gauge', 'Tickets waiting for a task process'),
+    'psec_log_watcher_pending_macs':
+        ('gauge', 'MACs waiting for a log server event'),
+    'psec_ssh_open_sessions':
+        ('gauge', 'Open switch SSH sessions of a task process'),
+}
+
+# Registry of the main process
+_main: Dict[str, 'MetricsRegistry'] = {}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """
+    Histograms, counters and gauges of the service (main process)
+    Callback gauges are read on each scrape
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        # Bucket counts, sum and count by labels
+        self.histograms: Dict[str, Dict[Labels, List[float]]] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[Labels, float]] = {}
+        self.callbacks: Dict[str, Callable[[], float]] = {}
+
+    def record(self,
+               kind: str,
+               name: str,
+               labels: Dict[str, str],
+               value: float
+               ) -> None:
+        """
+        Records an observation
+
+        Args:
+            kind (str): 'observe', 'count' or 'gauge'
+            name (str): Metric name
+            labels (dict): Label names and values
+            value (float): Observed value, increment or gauge value
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if kind == 'observe':
+                data = self.histograms.setdefault(name, {}).setdefault(
+                    key, [0.0] * (len(BUCKETS) + 2))
+                data[bisect.bisect_left(BUCKETS, value)] += 1
+                data[-1] += value
+            elif kind == 'count':
+                counters = self.counters.setdefault(name, {})
+                counters[key] = counters.get(key, 0.0) + value
+            else:
+                self.gauges.setdefault(name, {})[key] = value
+
+    def gauge(self, name: str, callback: Callable[[], float]) -> None:
+        """
+        Registers a gauge read on each scrape
+
+        Args:
+            name (str): Metric name
+            callback (Callable): Returns the current value
+        """
+        self.callbacks[name] = callback
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text format
+
+        Returns:
+            (str): Exposition text
+        """
+        lines: List[str] = []
+        with self.lock:
+            histograms = {name: {key: list(data)
+                                 for key, data in series.items()}
+                          for name, series in self.histograms.items()}
+            counters = {name: dict(series)
+                        for name, series in self.counters.items()}
+            gauges = {name: dict(series)
+                      for name, series in self.gauges.items()}
+        for name, callback in self.callbacks.items():
+            try:
+                gauges[name] = {(): float(callback())}
+            # A broken gauge must not break the scrape ¯\_(ツ)_/¯
+            except Exception:
+                continue
+        for name in sorted(set(histograms) | set(counters) | set(gauges)):
+            kind, description = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP ' + name + ' ' + description)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for key, data in sorted(histograms.get(name, {}).items()):
+                total = 0.0
+                for bound, number in zip(BUCKETS + ('+Inf',), data):
+                    total += number
+                    lines.append(name + '_bucket' +
+                                 label_text(key + (('le', str(bound)),)) +
+                                 ' ' + number_text(total))
+                lines.append(name + '_sum' + label_text(key) + ' ' +
+                             number_text(data[-1]))
+                lines.append(name + '_count' + label_text(key) + ' ' +
+                             number_text(total))
+            for series in (counters.get(name, {}), gauges.get(name, {})):
+                for key, value in sorted(series.items()):
+                    lines.append(name + label_text(key) + ' ' +
+                                 number_text(value))
+        return '\n'.join(lines) + '\n'
+
+
+def label_text(key: Labels) -> str:
+    """
+    Label set in the exposition format
+
+    Args:
+        key (tuple): Label names and values
+
+    Returns:
+        (str): {name="value",...} or empty string
+    """
+    if not key:
+        return ''
+    return '{' + ','.join(name + '="' + value.replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n') + '"'
+                          for name, value in key) + '}'
+
+
+def number_text(value: float) -> str:
+    """
+    Sample value in the exposition format
+
+    Args:
+        value (float): Value
+
+    Returns:
+        (str): Integer values without the fraction
+    """
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+def install_metrics(registry: MetricsRegistry) -> None:
+    """
+    Main process metrics: observations go straight to the registry
+
+    Args:
+        registry (MetricsRegistry): Metrics registry
+    """
+    _main['registry'] = registry
+
+
+def record(kind: str, name: str, value: float, labels: Dict[str, str]
+           ) -> None:
+    """
+    Records an observation from any process
+    (not recorded if there is no registry, e.g. in tests)
+
+    Args:
+        kind (str): 'observe', 'count' or 'gauge'
+        name (str): Metric name
+        value (float): Value
+        labels (dict): Label names and values
+    """
+    # The registry inherited from the main process is not used
+    if in_worker():
+        post_event('metric', kind, name, labels, value)
+    elif 'registry' in _main:
+        _main['registry'].record(kind, name, labels, value)
+
+
+def observe(name: str, value: float, **labels: str) -> None:
+    """
+    Histogram observation
+
+    Args:
+        name (str): Metric name
+        value (float): Value in seconds
+        **labels: Label values
+    """
+    record('observe', name, value, labels)
+
+
+def count(name: str, **labels: str) -> None:
+    """
+    Counter increment
+
+    Args:
+        name (str): Metric name
+        **labels: Label values
+    """
+    record('count', name, 1, labels)
+
+
+def set_gauge(name: str, value: float, **labels: str) -> None:
+    """
+    Gauge value
+
+    Args:
+        name (str): Metric name
+        value (float): Value
+        **labels: Label values
+    """
+    record('gauge', name, value, labels)
+
+
+@contextmanager
+def timed(name: str, **labels: str) -> Iterator[None]:
+    """
+    Observes the duration of the block
+    (also when the block ends the task with end_task())
+
+    Args:
+        name (str): Histogram name
+        **labels: Label values
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /metrics
+    """
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Scrapes are not logged
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    HTTP endpoint of the metrics ('metrics_port', 'metrics_host')
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, config: dict, registry: MetricsRegistry) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+            registry (MetricsRegistry): Metrics registry
+        """
+        super().__init__((config.get('metrics_host', '127.0.0.1'),
+                          int(config['metrics_port'])),
+                         MetricsHandler)
+        self.registry = registry
+
+    def start(self) -> None:
+        """
+        Starts the server thread
+        """
+        threading.Thread(target=self.serve_forever,
+                         name='psec_metrics',
+                         daemon=True).start()
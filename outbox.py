@@ -0,0 +1,248 @@
+#! /usr/bin/env python3
+"""
+Outbound mail queue (on-disk spool and one SMTP connection)
+"""
+import itertools
+import json
+import logging
+import os
+import smtplib
+import threading
+import time
+from typing import Any, Dict, List, Optional, Union
+
+# Spool file names are unique within the process
+_counter = itertools.count()
+
+
+def outbox_dir(config: dict) -> str:
+    """
+    Spool directory
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        (str): Directory path
+    """
+    return config.get('outbox_dir', config['proj_dir'] + 'outbox/')
+
+
+def spool_message(config: dict,
+                  to_addrs: Union[str, List[str]],
+                  message: str
+                  ) -> str:
+    """
+    Puts a message in the spool (any process)
+    The message is sent by the outbox thread of the main process
+
+    Args:
+        config (dict): Dict with config data
+        to_addrs (str, list): Recipients
+        message (str): Message in the string form
+
+    Returns:
+        (str): Spool file path
+    """
+    spool = outbox_dir(config)
+    os.makedirs(spool, exist_ok=True)
+    name = f'{time.time():.6f}_{os.getpid()}_{next(_counter)}'
+    tmp_path = spool + '.' + name + '.tmp'
+    with open(tmp_path, 'w') as spool_f:
+        json.dump({'from': config['mail_from'],
+                   'to': to_addrs,
+                   'message': message,
+                   'spooled': time.time(),
+                   'attempts': 0}, spool_f)
+    # The sender sees only complete files
+    os.replace(tmp_path, spool + name + '.json')
+    return spool + name + '.json'
+
+
+class Outbox:
+    """
+    Sends the spooled messages over one reusable SMTP connection
+    Failed sends are retried with backoff,
+    after 'outbox_max_attempts' the message is moved to 'failed/'
+    (a spool file that can not be read is moved there at once)
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        self.server = config.get('smtp_server', config['mail_server'])
+        self.spool = outbox_dir(config)
+        self.poll_interval = float(config.get('outbox_poll_interval', 1))
+        self.idle_timeout = float(config.get('outbox_idle_timeout', 60))
+        self.max_attempts = int(config.get('outbox_max_attempts', 5))
+        self.smtp: Optional[smtplib.SMTP] = None
+        self.last_used = 0.0
+        self.retry_at: Dict[str, float] = {}
+        self.wake = threading.Event()
+        self.sent = 0
+        self.failed = 0
+        self.connections = 0
+        self.last_send = 0.0
+        self.latency_sum = 0.0
+
+    def pending(self) -> List[str]:
+        """
+        Spooled messages, the oldest first
+
+        Returns:
+            (list): Spool file names
+        """
+        try:
+            names = os.listdir(self.spool)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.endswith('.json'))
+
+    def connect(self) -> smtplib.SMTP:
+        """
+        SMTP connection (opened if needed)
+
+        Returns:
+            (smtplib.SMTP): SMTP connection
+        """
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.server, timeout=30)
+            self.connections += 1
+        return self.smtp
+
+    def disconnect(self) -> None:
+        """
+        Closes the SMTP connection, errors are ignored
+        """
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.smtp = None
+
+    def put_aside(self, name: str) -> None:
+        """
+        Moves a message that will not be sent to 'failed/'
+
+        Args:
+            name (str): Spool file name
+        """
+        os.makedirs(self.spool + 'failed/', exist_ok=True)
+        os.replace(self.spool + name, self.spool + 'failed/' + name)
+        self.retry_at.pop(name, None)
+        self.failed += 1
+
+    def send(self, name: str) -> None:
+        """
+        Sends one spooled message
+
+        Args:
+            name (str): Spool file name
+        """
+        path = self.spool + name
+        try:
+            with open(path, 'r') as spool_f:
+                data: Dict[str, Any] = json.load(spool_f)
+            envelope = (data['from'], data['to'], data['message'])
+            data['attempts'] = int(data.get('attempts', 0))
+        # Removed by hand
+        except FileNotFoundError:
+            self.retry_at.pop(name, None)
+            return
+        except (ValueError, KeyError, TypeError):
+            logging.exception('Spooled message ' + name +
+                              ' can not be read, moved to failed/')
+            self.put_aside(name)
+            return
+        start = time.monotonic()
+        try:
+            try:
+                self.connect().sendmail(*envelope)
+            # The server has closed the idle connection
+            except smtplib.SMTPServerDisconnected:
+                self.disconnect()
+                self.connect().sendmail(*envelope)
+        except (smtplib.SMTPException, OSError):
+            self.disconnect()
+            data['attempts'] += 1
+            if data['attempts'] >= self.max_attempts:
+                logging.exception('Spooled message ' + name + ' not sent '
+                                  'after ' + str(data['attempts']) +
+                                  ' attempts, moved to failed/')
+                self.put_aside(name)
+                return
+            with open(path, 'w') as spool_f:
+                json.dump(data, spool_f)
+            # Backoff: 2, 4, 8... seconds (at most 5 minutes)
+            self.retry_at[name] = time.monotonic() + \
+                min(2 ** data['attempts'], 300)
+            return
+        self.last_used = time.monotonic()
+        self.last_send = self.last_used - start
+        self.latency_sum += time.time() - data.get('spooled', time.time())
+        self.sent += 1
+        self.retry_at.pop(name, None)
+        os.remove(path)
+
+    def flush(self) -> None:
+        """
+        Sends all messages that are due
+        """
+        now = time.monotonic()
+        for name in self.pending():
+            if self.retry_at.get(name, 0.0) > now:
+                continue
+            # One broken message does not hold up the others
+            try:
+                self.send(name)
+            # Catch all ¯\_(ツ)_/¯
+            except Exception:
+                logging.exception('Spooled message ' + name + ' not sent')
+                self.disconnect()
+                self.retry_at[name] = time.monotonic() + 300
+        # The connection is not kept for a quiet mailbox
+        if self.smtp is not None and \
+                time.monotonic() - self.last_used > self.idle_timeout:
+            self.disconnect()
+
+    def run(self) -> None:
+        """
+        Outbox loop
+        """
+        while True:
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            # Catch all ¯\_(ツ)_/¯
+            except Exception:
+                logging.exception('Outbox flush failed')
+                self.disconnect()
+
+    def start(self) -> None:
+        """
+        Starts the outbox thread
+        """
+        threading.Thread(target=self.run,
+                         name='psec_outbox',
+                         daemon=True).start()
+
+    def report(self) -> Dict[str, str]:
+        """
+        Outbox statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        average = self.latency_sum / self.sent if self.sent else 0.0
+        return {
+            'Outbox depth': str(len(self.pending())),
+            'Outbox sent': str(self.sent),
+            'Outbox failed': str(self.failed),
+            'Outbox SMTP connections': str(self.connections),
+            'Outbox last send (s)': f'{self.last_send:.2f}',
+            'Outbox average delivery (s)': f'{average:.2f}',
+        }
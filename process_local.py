@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+"""
+State of the current process
+SQLite stores shared by all task processes
+and objects created once per task process
+"""
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+
+
+class SQLiteStore:
+    """
+    Local SQLite store shared by all task processes
+    Each process opens its own connection (WAL journal),
+    the tables are created on the first connection
+    """
+    # Table and index statements
+    schema: Tuple[str, ...] = ()
+
+    def __init__(self, path: str) -> None:
+        """
+        Args:
+            path (str): DB file path
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.pid = 0
+
+    def connection(self) -> sqlite3.Connection:
+        """
+        Connection of the current process
+        (a connection is not used after fork)
+
+        Returns:
+            (sqlite3.Connection): DB connection
+        """
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path,
+                                        timeout=30,
+                                        check_same_thread=False,
+                                        isolation_level=None)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                self.conn.execute(statement)
+            self.migrate(self.conn)
+            self.pid = os.getpid()
+        return self.conn
+
+    def migrate(self, conn: sqlite3.Connection) -> None:
+        """
+        Upgrades the store of a previous version
+        (nothing to upgrade by default)
+
+        Args:
+            conn (sqlite3.Connection): DB connection
+        """
+
+
+def process_instance(instances: Dict[str, T], create: Callable[[], T]) -> T:
+    """
+    Object of the current task process, created on first use
+
+    Args:
+        instances (dict): Module dict keeping the object
+        create (Callable): Creates the object
+
+    Returns:
+        (object): The object
+    """
+    if 'instance' not in instances:
+        instances['instance'] = create()
+    return instances['instance']
@@ -6,28 +6,57 @@ import datetime
 import json
 import logging
 import os
-import poplib
+import re
+import threading
 import time
 import traceback
-from email.parser import Parser
-from multiprocessing import Process
 from sys import argv
 from typing import Callable, Dict
 
-from cisco_conn import cisco_connection
-from log_parser import log_parse
-from log_serv_conn import log_server_check
-from service_funcs import (clearing_message,
-                           create_sql_query,
+from archiver import LogArchiver
+from cisco_conn import cisco_bulk_connection, cisco_connection
+from log_parser import REG_IP, bulk_parse, log_parse
+from log_pipeline import (TaskContext,
+                          TaskLogWriter,
+                          install_writer,
+                          task_logging)
+from log_serv_conn import LogServerDB, log_server_watch
+from log_watcher import LogWatcher
+from mac_extract import ticket_macs
+from mail_intake import make_intake
+from metrics import (MetricsRegistry,
+                     MetricsServer,
+                     count,
+                     install_metrics,
+                     observe,
+                     timed)
+from outbox import Outbox
+from service_funcs import (BODY_LIMIT,
+                           clearing_message,
+                           close_task,
+                           end_bulk_task,
                            find_macs_in_mess,
                            find_macs_in_mess_check,
                            ip_list_check,
-                           kill_task,
-                           log_rotation,
+                           make_log_dirs,
+                           send_busy,
+                           send_error,
+                           send_merged,
                            send_report,
+                           send_bulk_start,
                            send_start,
+                           send_status,
                            send_violation,
                            sql_answer_check)
+from syslog_receiver import SyslogReceiver
+from task_store import STAGES, TaskRegistry, TaskRow, TaskStore, task_macs
+from worker_pool import TaskCancelled, WorkerPool, post_event
+
+# Histogram of the task stage durations
+STAGE_METRIC = 'psec_stage_duration_seconds'
+
+# Answers of the bulk tasks being located (main process)
+bulk_lock = threading.Lock()
 
 
 def check_glob_err(main: Callable) -> Callable:
@@ -101,52 +130,379 @@ def connect(log_file_name: str,
                          "other vendors are not yet implemented")
 
 
-@check_task_err
-def execute_task(decoded_message: str) -> None:
+def parse_task(task: TaskRow) -> TaskRow:
     """
-    Performs processing of a single task
+    Parse stage: finds the MAC in the ticket and opens the task log
+    (the MACs of a bulk ticket are found when it is submitted)
 
     Args:
-        decoded_message (str): Deccoded message from email
+        task (TaskRow): Task state
+
+    Returns:
+        (TaskRow): Task state after the stage
     """
-    mac = find_macs_in_mess(decoded_message)
+    macs = task_macs(task)
+    if len(macs) > 1:
+        mac = task.mac
+        name = 'bulk-' + str(len(macs))
+    else:
+        mac = macs[0] if macs else find_macs_in_mess(task.message)
+        name = 'nomac' if len(mac) > 12 else mac.replace('.', '-')
     # Logger setup
-    if len(mac) > 12:
-        log_file_name = 'task_' + str(os.getpid()) + '__' + 'nomac' + '__' + \
-            datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    log_file_name = 'task_' + str(os.getpid()) + '__' + name + '__' + \
+        datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    context.set(tracker=log_file_name, mac=mac, stage='parse')
+    logging.info(f'\r\n=============================TASK=REPORT======'
+                 f'=======================\r\n\r\n{log_file_name}'
+                 f'\r\n\r\n>>>--------------------------MESSAGE------'
+                 f'--------------------<<<\r\n\r\n{task.message}'
+                 f'\r\n\r\n>>>---------------------------------------'
+                 f'--------------------<<<\r\n\r\n')
+    if len(macs) > 1:
+        logging.info('Bulk request, ' + str(len(macs)) + ' MACs:\r\n' +
+                     '\r\n'.join(macs) + '\r\n\r\n')
+    else:
+        # Finds the MAC in the ticket
+        find_macs_in_mess_check(log_file_name, mac, config)
+    return store.advance(task.id, 'notify',
+                         tracker=log_file_name, mac=mac)
+
+
+def run_stages(task: TaskRow) -> None:
+    """
+    Runs the task from its current stage
+    MAC parse -> notify -> locate -> exclusion check -> configure
+    The task process is released while the device is located
+
+    Args:
+        task (TaskRow): Task state
+    """
+    if task.stage == 'parse':
+        with timed(STAGE_METRIC, stage='parse'):
+            task = parse_task(task)
     else:
-        log_file_name = 'task_' + str(os.getpid()) + '__' + \
-            mac.replace('.', '-') + '__' + \
-            datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    logging.basicConfig(filename=config['proj_dir'] +
-                        'logs/' +
-                        log_file_name +
-                        '.txt',
-                        format='%(asctime)s %(message)s',
-                        level=logging.INFO,
-                        datefmt='%Y-%m-%d %H:%M:%S')
-    logging.getLogger("paramiko").setLevel(logging.WARNING)
-    logging.info(f'\r\n=============================TASK=REPORT============'
-                 f'=================\r\n\r\n{log_file_name}'
-                 f'\r\n\r\n>>>--------------------------MESSAGE------------'
-                 f'--------------<<<\r\n\r\n{decoded_message}'
-                 f'\r\n\r\n>>>---------------------------------------------'
-                 f'--------------<<<\r\n\r\n')
-    # Finds the MAC in the ticket
-    find_macs_in_mess_check(log_file_name, mac, config)
-    # Sends an "request accepted" message with the MAC of the device
-    send_start(log_file_name, mac, config)
-    # Create a request
-    sql_query = create_sql_query(mac, config)
-    # Makes a request to a log server
-    sql_answer = log_server_check(sql_query, log_file_name, mac, config)
-    sql_answer_check(log_file_name, sql_answer, mac, config)
-    # Parses the response
-    task_params = log_parse(sql_answer, log_file_name, mac, config)
-    # Checks if the switch is in the excluded list
-    ip_list_check(log_file_name, task_params, mac, config)
-    # Connects to the device and performs settings
-    connect(log_file_name, task_params, mac, config)
+        context.set(tracker=task.tracker, mac=task.mac, stage=task.stage)
+    if task.stage == 'notify':
+        context.set(stage='notify')
+        with timed(STAGE_METRIC, stage='notify'):
+            # Sends an "request accepted" message with the MAC of the device
+            if len(task_macs(task)) > 1:
+                send_bulk_start(task.tracker, task_macs(task), config)
+            else:
+                send_start(task.tracker, task.mac, config)
+            store.advance(task.id, 'locate')
+            # Waits for the device connection event on the log server
+            log_server_watch(task.id, task.tracker, task.mac)
+        return
+    if len(task_macs(task)) > 1:
+        run_bulk_stages(task)
+        return
+    if task.stage == 'check':
+        context.set(stage='check')
+        with timed(STAGE_METRIC, stage='check'):
+            sql_answer_check(task.tracker, task.answer, task.mac, config)
+            # Parses the response
+            task_params = log_parse(task.answer, task.tracker, task.mac,
+                                    config)
+            # Checks if the switch is in the excluded list
+            ip_list_check(task.tracker, task_params, task.mac, config)
+            task = store.advance(task.id, 'configure', params=task_params)
+    if task.stage == 'configure':
+        context.set(stage='configure', switch=task.params['ip_addr'])
+        with timed(STAGE_METRIC, stage='configure'):
+            # Connects to the device and performs settings
+            connect(task.tracker, task.params, task.mac, config)
+
+
+def run_bulk_stages(task: TaskRow) -> None:
+    """
+    Check and configure stages of a bulk task
+    The located devices are grouped by switch, each switch is configured
+    in one session, one report with the result of every MAC is sent
+
+    Args:
+        task (TaskRow): Task state
+    """
+    if task.stage == 'check':
+        context.set(stage='check')
+        with timed(STAGE_METRIC, stage='check'):
+            ports, failed = bulk_parse(task.answer, config)
+            task = store.advance(task.id, 'configure',
+                                 params={'ports': ports, 'results': failed})
+    if task.stage == 'configure':
+        ports = task.params['ports']
+        results = dict(task.params['results'])
+        switches: Dict[str, Dict[str, Dict[str, str]]] = {}
+        for mac, task_params in ports.items():
+            switches.setdefault(task_params['ip_addr'], {})[mac] = \
+                task_params
+        for host, switch_ports in sorted(switches.items()):
+            context.set(stage='configure', switch=host)
+            with timed(STAGE_METRIC, stage='configure'):
+                results.update(cisco_bulk_connection(task.tracker,
+                                                     host,
+                                                     switch_ports,
+                                                     config))
+        end_bulk_task(task.tracker,
+                      {mac: results.get(mac, 'other')
+                       for mac in task_macs(task)},
+                      ports,
+                      config)
+
+
+@check_task_err
+def execute_task(task_id: int) -> None:
+    """
+    Performs processing of a single task
+    (a new one or resumed from the saved stage)
+
+    Args:
+        task_id (int): Task ID in the task store
+    """
+    task = store.get(task_id)
+    if task is None or task.stage not in STAGES:
+        return
+    # Log records and task states are sent to the main process
+    task_logging(context)
+    store.listener = lambda changed: post_event('task', changed)
+    # Task process (cleared when the stage ends)
+    task = store.advance(task_id, task.stage, pid=os.getpid())
+    try:
+        run_stages(task)
+    # end_task() - the task is finished
+    except SystemExit:
+        store.advance(task_id, 'done')
+        post_event('finished', task_id)
+        raise
+    # Killed - the task log was sent by kill_stored_task()
+    except TaskCancelled:
+        post_event('release', task.tracker)
+        raise
+    except Exception:
+        store.advance(task_id, 'failed')
+        count('psec_tasks_total', result='failed')
+        count('psec_task_failures_total', reason='error')
+        post_event('release', task.tracker)
+        raise
+    finally:
+        store.release(task_id)
+
+
+def task_host(task: TaskRow) -> str:
+    """
+    Switch of the task for the worker choice
+    (the first switch of a bulk task)
+
+    Args:
+        task (TaskRow): Task state
+
+    Returns:
+        (str): Switch IP-address, '' if the task is not located yet
+    """
+    switches = TaskRegistry.switches(task)
+    if switches:
+        return sorted(switches)[0]
+    answers = task.answer or {}
+    # Answer of a single task or answers of a bulk task by MAC
+    if 'answer' in answers:
+        answers = {task.mac: answers}
+    for mac in sorted(answers):
+        match_ip = re.search(REG_IP, answers[mac].get('answer', ''))
+        if match_ip is not None:
+            return match_ip.group()
+    return ''
+
+
+def locate_task(slot: int, task_id: int) -> None:
+    """
+    Registers a waiting task in the log watcher
+    (worker event handler, also used to resume tasks after a restart)
+
+    Args:
+        slot (int): Worker slot number
+        task_id (int): Task ID
+    """
+    task = store.get(task_id)
+    if task is None or task.stage != 'locate':
+        return
+    if len(task_macs(task)) > 1:
+        locate_bulk(task)
+        return
+
+    def located(answer: Dict[str, str]) -> None:
+        observe(STAGE_METRIC, time.time() - task.updated, stage='locate')
+        # The answer is saved and the task goes back to the pool
+        checked = store.advance(task_id, 'check', answer=answer)
+        if checked.stage == 'check':
+            pool.submit(task_id, host=task_host(checked))
+    watcher.register(task.mac, task.tracker, located)
+    # The device may have been connected before the ticket arrived
+    if receiver is not None:
+        receiver.replay(task.mac)
+
+
+def locate_bulk(task: TaskRow) -> None:
+    """
+    Registers every MAC of a bulk task in the log watcher
+    (all of them are looked up by the same batched query)
+    The answers are saved as they come, the task goes back to the pool
+    when all devices are located or 'bulk_wait' seconds after the first
+
+    Args:
+        task (TaskRow): Task state
+    """
+    answers = task.answer or {}
+    start = task.updated
+
+    def located(mac: str) -> Callable[[Dict[str, str]], None]:
+        def save_answer(answer: Dict[str, str]) -> None:
+            with bulk_lock:
+                current = store.get(task.id)
+                if current is None or current.stage != 'locate':
+                    return
+                found = dict(current.answer or {}, **{mac: answer})
+                store.advance(task.id, 'locate', answer=found)
+            if len(found) == len(task_macs(task)):
+                bulk_located(task.id, start)
+            elif len(found) == 1:
+                wait_bulk(task.id, start, time.time())
+        return save_answer
+    for mac in task_macs(task):
+        if mac not in answers:
+            watcher.register(mac, task.tracker, located(mac))
+    # The last answer was saved at 'updated', the wait is counted
+    # from it (the time of the first one is not kept)
+    if answers:
+        wait_bulk(task.id, start, task.updated)
+    # The devices may have been connected before the ticket arrived
+    if receiver is not None:
+        for mac in task_macs(task):
+            receiver.replay(mac)
+
+
+def wait_bulk(task_id: int, start: float, since: float) -> None:
+    """
+    Ends the wait for the rest of the bulk task devices
+    'bulk_wait' seconds after the wait began
+    (a resumed task only waits for the rest of it)
+
+    Args:
+        task_id (int): Task ID
+        start (float): Start of the locate stage (timestamp)
+        since (float): Start of the wait (timestamp)
+    """
+    left = float(config.get('bulk_wait', 3600)) - (time.time() - since)
+    timer = threading.Timer(max(0.0, left),
+                            bulk_located,
+                            (task_id, start))
+    timer.daemon = True
+    timer.start()
+
+
+def bulk_located(task_id: int, start: float) -> None:
+    """
+    Sends a bulk task to the check stage,
+    devices not located by now are failed
+
+    Args:
+        task_id (int): Task ID
+        start (float): Start of the locate stage (timestamp)
+    """
+    with bulk_lock:
+        task = store.get(task_id)
+        if task is None or task.stage != 'locate':
+            return
+        answers = dict(task.answer or {})
+        for mac in task_macs(task):
+            if mac not in answers:
+                watcher.unregister(mac, task.tracker)
+                answers[mac] = {'vendor': 'None',
+                                'answer': '!!!NOT OK!!! Events with this '
+                                'device were not found in the log server '
+                                'database while the other devices of the '
+                                'bulk request were connected\r\n\r\n'
+                                'Task failed'}
+        task = store.advance(task_id, 'check', answer=answers)
+    observe(STAGE_METRIC, time.time() - start, stage='locate')
+    pool.submit(task_id, host=task_host(task))
+
+
+def kill_stored_task(message_dict: Dict[str, str]) -> bool:
+    """
+    Ends a task from the task store
+    A waiting task has no process, only its row is closed,
+    a running task is cancelled in its worker (a queued one
+    is skipped when a worker takes it)
+
+    Args:
+        message_dict (dict): Dict with message data
+            (senders email, and actual data)
+
+    Returns:
+        (bool): True if the task was found in the task store
+    """
+    task_match = re.search(r'(task_\S+)', message_dict['message'])
+    if task_match is None:
+        return False
+    task = registry.tracker(task_match.groups()[0])
+    if task is None:
+        return False
+    # State before the kill (the store is ahead of the registry)
+    task = store.kill(task.id)
+    if task is None:
+        return False
+    if task.stage == 'locate':
+        for mac in task_macs(task):
+            watcher.unregister(mac, task.tracker)
+    # The worker stops at its next switch command
+    pool.cancel(task.id, float(config.get('kill_grace', 30)))
+    close_task(task.tracker, task.mac, task.tracker + ' terminated', config)
+    archiver.notify()
+    return True
+
+
+def merge_ticket(mac: str) -> bool:
+    """
+    Merges a request into the active task for the same MAC
+    (the request gets the same completion notice)
+
+    Args:
+        mac (str): Device MAC-address
+
+    Returns:
+        (bool): True if merged
+    """
+    for task in registry.find(mac):
+        merged = store.merge(task.id)
+        if merged is None:
+            continue
+        if merged.tracker:
+            logging.info('Duplicate request merged into this request ' +
+                         '(' + str(merged.duplicates) + ' in total)\r\n',
+                         extra={'tracker': merged.tracker, 'mac': mac})
+        send_merged(merged.tracker, mac, config)
+        return True
+    return False
+
+
+def submit_ticket(message: str) -> None:
+    """
+    Starts a task for the ticket
+    A ticket with several MACs (up to 'bulk_max_macs') is one bulk task,
+    MACs that already have an active task are merged into it
+
+    Args:
+        message (str): Decoded message from email
+    """
+    # Each MAC once, in order of the message
+    macs = ticket_macs(message)
+    # No MAC or too many MACs - the task fails in the parse stage
+    if not macs or len(macs) > max(1, int(config.get('bulk_max_macs', 50))):
+        pool.submit(store.create(message))
+        return
+    macs = [mac for mac in macs if not merge_ticket(mac)]
+    if macs:
+        pool.submit(store.create(message, ' '.join(macs)))
 
 
 def check_message(message_dict: Dict[str, str]) -> None:
@@ -166,86 +522,211 @@ def check_message(message_dict: Dict[str, str]) -> None:
         # Service message <REPORT>
         if 'REPORT' in message_dict['message']:
             if message_dict['email'] == config['mailbox']:
-                send_report(message_dict['email'], config)
+                # The logs are archived off the intake loop
+                threading.Thread(target=send_report,
+                                 args=(message_dict['email'],
+                                       config,
+                                       service_stats(),
+                                       registry.active()),
+                                 name='psec_report',
+                                 daemon=True).start()
         # Service message <KILL>
         elif 'KILL' in message_dict['message']:
             if message_dict['email'] == config['mailbox']:
-                kill_task(message_dict, config)
+                if not kill_stored_task(message_dict):
+                    send_error(message_dict, 'There is no active task '
+                               'with this tracker', config)
+        # Service message <STATUS mac|tracker|ip>
+        elif 'STATUS' in message_dict['message']:
+            if message_dict['email'] == config['mailbox']:
+                status_match = re.search(r'STATUS\s+(\S+)',
+                                         message_dict['message'])
+                if status_match is not None:
+                    key = status_match.groups()[0]
+                    send_status(message_dict['email'],
+                                key,
+                                registry.find(key),
+                                config)
         else:
             # Sender from inf-sec?
             if message_dict['email'] in config['infsec_emails']:
-                proc = Process(target=execute_task,
-                               name='execute_task',
-                               args=(message_dict['message'],))
-                proc.daemon = True
-                proc.start()
+                # Too many tickets are waiting for a task process
+                if pool.full():
+                    count('psec_tickets_rejected_total')
+                    send_busy(message_dict, config)
+                else:
+                    submit_ticket(message_dict['message'])
             else:
                 sender_restriction: str = 'Request not accepted: ' \
                     'sender not from inf-sec'
                 send_violation(message_dict, sender_restriction, config)
 
 
-def read_mail(config: dict) -> Dict[str, str]:
+def check_raw_message(raw_message_dict: Dict[str, str]) -> None:
     """
-    Picks up mail from mailbox
+    Message check (called by the intake before the message
+    is deleted from the mailbox, the ticket is saved by then)
 
     Args:
-        config (dict): Dict with config data
-
-    Returns:
         raw_message_dict (dict): Dict with message data
             (senders email, and actual data in raw format)
-        (dict): {'email': 'Empty', 'message': 'No messages or other exception'}
-            if mailbox is empty (or other exception)
     """
-    server = poplib.POP3(config['mail_server'])
-    server.user(config['mail_from'])
-    server.pass_(config['mail_pass'])
+    message_dict = clearing_message(
+        raw_message_dict,
+        int(config.get('mail_body_limit', BODY_LIMIT)))
+    check_message(message_dict)
+    intake.dispatch(message_dict.get('received'))
+
+
+def service_stats() -> Dict[str, str]:
+    """
+    Service statistics for the <REPORT> message
+
+    Returns:
+        stats (dict): Statistics names and values
+    """
+    stats: dict = {}
+    stats.update(intake.report())
+    stats.update(pool.report())
+    stats.update(store.report())
+    stats['Tasks active'] = str(len(registry))
+    stats.update(outbox.report())
+    stats.update(archiver.report())
+    stats.update(writer.report())
+    stats.update(watcher.report())
+    if receiver is not None:
+        stats.update(receiver.report())
+    return stats
+
+
+def render_log(slot: int, tracker: str) -> None:
+    """
+    Sends the task log to the worker
+    (worker event handler, the worker always gets a reply)
+
+    Args:
+        slot (int): Worker slot number
+        tracker (str): Task tracker
+    """
+    log = ''
     try:
-        resp, lines, octets = server.retr(1)
-        msg_content = b'\r\n'.join(lines).decode('utf-8')
-        msg = Parser().parsestr(msg_content)
-        email_from = (msg.get('From')).split('<')[1].replace('>', '')
-        if msg.is_multipart():
-            raw_mess: str = ''
-            for part in msg.get_payload():
-                charset = part.get_content_charset()
-                if charset is not None:
-                    mess_part = part.get_payload(decode=True).decode(charset)
-            raw_mess += mess_part
-        else:
-            charset = msg.get_content_charset()
-            raw_mess = msg.get_payload(decode=True).decode(charset)
-        raw_message_dict = {'email': email_from, 'message': raw_mess}
-        # Deleting a processed message
-        server.dele(1)
-        server.quit()
-        return raw_message_dict
-    # If mailbox is empty or other exception ¯\_(ツ)_/¯
+        log = writer.render(tracker)
+    # Catch all ¯\_(ツ)_/¯
     except Exception:
-        server.quit()
-        return {'email': 'Empty', 'message': 'No messages or other exception'}
+        logging.exception('Task log of ' + tracker + ' not rendered')
+    finally:
+        pool.reply(slot, 'render ' + tracker, log)
+
+
+def worker_metric(slot: int,
+                  kind: str,
+                  name: str,
+                  labels: Dict[str, str],
+                  value: float
+                  ) -> None:
+    """
+    Records an observation of a task process
+    (worker event handler, gauges are kept per worker slot)
+
+    Args:
+        slot (int): Worker slot number
+        kind (str): 'observe', 'count' or 'gauge'
+        name (str): Metric name
+        labels (dict): Label names and values
+        value (float): Value
+    """
+    if kind == 'gauge':
+        labels = dict(labels, worker=str(slot))
+    metrics.record(kind, name, labels, value)
 
 
 @check_glob_err
 def main() -> None:
     """
-    Message processing one by one
+    Message processing in batches
     """
+    make_log_dirs(config)
+    writer.open()
+    install_writer(writer)
+    install_metrics(metrics)
+    metrics.gauge('psec_tasks_active', lambda: len(registry))
+    metrics.gauge('psec_mailbox_pending', intake.pending)
+    metrics.gauge('psec_outbox_pending', lambda: len(outbox.pending()))
+    metrics.gauge('psec_pool_queue_depth', pool.depth)
+    metrics.gauge('psec_log_watcher_pending_macs',
+                  lambda: len(watcher.pending))
+    if config.get('metrics_port'):
+        MetricsServer(config, metrics).start()
+    outbox.start()
+    archiver.start()
+    pool.start()
+    pool.serve_events({'locate': locate_task,
+                       'finished': lambda slot, task_id: archiver.notify(),
+                       'log': lambda slot, data: writer.write(data),
+                       'task': lambda slot, task: registry.update(task),
+                       'metric': worker_metric,
+                       'render': render_log,
+                       'release': lambda slot, tracker:
+                           writer.release(tracker)})
+    watcher.start()
+    if receiver is not None:
+        receiver.start()
+    # Tasks interrupted by a restart
+    for task in store.unfinished():
+        store.release(task.id)
+        registry.update(task)
+        if task.stage == 'locate':
+            locate_task(0, task.id)
+        else:
+            pool.submit(task.id, host=task_host(task))
     while True:
-        log_rotation(config)
-        # Decoded message caching
-        raw_message_dict = read_mail(config)
-        if raw_message_dict['message'] != 'No messages or other exception':
-            message_dict = clearing_message(raw_message_dict)
-            check_message(message_dict)
+        # All pending messages are picked up in one session
+        # Messages are checked and saved as tasks
+        # before they are deleted from the mailbox
+        with timed('psec_mail_fetch_duration_seconds'):
+            raw_messages = intake.fetch(check_raw_message)
+        if raw_messages:
+            # Replies to the batch are sent right away
+            outbox.wake.set()
         else:
-            time.sleep(60)
+            # POP3 polling interval or IMAP IDLE
+            intake.wait()
+
+
+def init_service(service_config: dict) -> None:
+    """
+    Creates the service objects of the main process
+
+    Args:
+        service_config (dict): Dict with config data
+    """
+    global config, intake, store, registry, outbox, archiver, writer, \
+        context, pool, watcher, receiver, metrics
+    config = service_config
+    metrics = MetricsRegistry()
+    intake = make_intake(config)
+    store = TaskStore(config)
+    # Active tasks by tracker, MAC and switch (main process)
+    registry = TaskRegistry()
+    store.listener = registry.update
+    # Mail from all processes goes through the spool
+    outbox = Outbox(config)
+    archiver = LogArchiver(config)
+    writer = TaskLogWriter(config)
+    # Fields of the current task (task processes)
+    context = TaskContext()
+    pool = WorkerPool(execute_task, config)
+    watcher = LogWatcher(LogServerDB(config).lookup, config)
+    # Built-in syslog receiver (the log server DB is still polled)
+    if config.get('syslog_port'):
+        receiver = SyslogReceiver(config, watcher.notify)
+    else:
+        receiver = None
 
 
 if __name__ == '__main__':
     # Configuration
     project_dir = argv[1]
     with open(project_dir + 'conf.json', 'r') as conf:
-        config = json.load(conf)
+        init_service(json.load(conf))
     main()
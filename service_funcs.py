@@ -3,72 +3,211 @@
 Service functions
 """
 import datetime
-import glob
+import gzip
 import logging
 import os
 import re
-import smtplib
-import subprocess
 import sys
+import tarfile
+import tempfile
+import time
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import Dict
+from typing import Any, BinaryIO, Dict, List, Optional, Sequence, Tuple
 
+from log_pipeline import task_log
+from mac_extract import MAC_RE, NORMALIZE
+from metrics import count
+from outbox import spool_message
 
-def log_rotation(config: dict) -> None:
+
+def make_log_dirs(config: dict) -> None:
     """
-    Log rotation
+    Creates the task log directories
 
     Args:
         config (dict): Dict with config data
     """
-    if not os.path.exists(config['log_dir'] + 'logs/'):
-        os.mkdir(config['log_dir'] + 'logs/')
-    if not os.path.exists(config['log_dir'] + 'log_archive/'):
-        os.mkdir(config['log_dir'] + 'log_archive/')
-    if len(glob.glob1(config['log_dir'] + 'log_archive/', '*.txt')) >= 50:
-        tar = 'tar czf ' + config['log_dir'] + 'log_archive/log_archive_' + \
-              datetime.datetime.today().strftime('%Y-%m-%d') + \
-              '.tar.gz ' + config['log_dir'] + 'log_archive/*.txt'
-        subprocess.Popen(tar, shell=True, stderr=subprocess.DEVNULL)
-        for log in glob.glob(config['log_dir'] + 'log_archive/*.txt'):
-            os.remove(log)
+    os.makedirs(config['log_dir'] + 'log_archive/', exist_ok=True)
+
+
+def format_stats(stats: Optional[Dict[str, str]]) -> str:
+    """
+    Service statistics block for the <REPORT> message
+
+    Args:
+        stats (dict): Statistics names and values
+
+    Returns:
+        (str): Statistics block
+    """
+    if not stats:
+        return ''
+    lines = [name + ': ' + value for name, value in stats.items()]
+    return '\r\n\r\n----------STATISTICS----------\r\n\r\n' + \
+        '\r\n'.join(lines)
+
+
+def format_tasks(tasks: Optional[Sequence[Any]]) -> str:
+    """
+    Summary table of the open tasks for the <REPORT> and <STATUS> messages
 
+    Args:
+        tasks (list): Task states (tracker, mac, stage, params, created)
 
-def send_report(email: str, config: dict) -> None:
+    Returns:
+        (str): Summary table
     """
-    Sends logs of current requests
+    if not tasks:
+        return ''
+    now = time.time()
+    lines: list = []
+    for task in tasks:
+        age = int(now - task.created)
+        switch = (task.params or {}).get('ip_addr', '-')
+        macs = task.mac.split()
+        # Bulk task
+        if len(macs) > 1:
+            mac = str(len(macs)) + ' MACs'
+            switches = set(params['ip_addr'] for params in
+                           (task.params or {}).get('ports', {}).values())
+            switch = str(len(switches)) + ' switches' if switches else '-'
+        else:
+            mac = task.mac or '-'
+        lines.append((task.tracker or '-') + ' | ' + mac +
+                     ' | ' + task.stage + ' | ' + switch + ' | ' +
+                     f'{age // 3600}h {age % 3600 // 60:02d}m')
+    return '\r\n\r\n----------TASKS----------\r\n\r\n' + \
+        'TRACKER | MAC | STAGE | SWITCH | AGE\r\n' + '\r\n'.join(lines)
+
+
+def tar_entry(name: str, data: bytes) -> bytes:
+    """
+    Tar archive entry of a file (header and data padded to the block size)
+
+    Args:
+        name (str): File name
+        data (bytes): File content
+
+    Returns:
+        (bytes): Entry
+    """
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    rest = len(data) % tarfile.BLOCKSIZE
+    padding = tarfile.NUL * (tarfile.BLOCKSIZE - rest) if rest else b''
+    return info.tobuf() + data + padding
+
+
+def archive_logs(tasks: Sequence[Any],
+                 archive_f: BinaryIO,
+                 max_bytes: int
+                 ) -> List[str]:
+    """
+    Packs the task logs one by one into a compressed tar archive
+    Each log is compressed as a separate gzip member (one log in memory
+    at a time) and added only if the archive stays within 'max_bytes'
+
+    Args:
+        tasks (list): Open task states
+        archive_f (file): Archive file (binary)
+        max_bytes (int): Archive size cap
+
+    Returns:
+        (list): Logs that were not added
+    """
+    skipped: list = []
+    # End of the tar archive (two zero blocks)
+    end = gzip.compress(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+    size = 0
+    for task in tasks:
+        name = task.tracker + '.txt'
+        member = gzip.compress(
+            tar_entry(name, task_log(task.tracker).encode('utf-8')))
+        if size + len(member) + len(end) > max_bytes:
+            skipped.append(name)
+            continue
+        archive_f.write(member)
+        size += len(member)
+    archive_f.write(end)
+    return skipped
+
+
+def send_report(email: str,
+                config: dict,
+                stats: Optional[Dict[str, str]] = None,
+                tasks: Optional[Sequence[Any]] = None
+                ) -> None:
+    """
+    Sends logs of current requests (one compressed attachment)
     Executed if the <REPORT> key is present in the message text
 
     Args:
         config (dict): Dict with config data
         email (str): Request sender email
+        stats (dict): Service statistics
+        tasks (list): Open task states for the summary table
     """
-    files_list = os.listdir(config['log_dir'] + 'logs/')
+    tasks = [task for task in tasks or [] if task.tracker]
     # There are open requests
-    if len(files_list) >= 1:
+    if len(tasks) >= 1:
         msg = MIMEMultipart()
         msg['Subject'] = 'Logs of current requests in attachment'
-        send = smtplib.SMTP(config['mail_server'])
-        for f in files_list:
-            file_path = os.path.join(config['log_dir'] + 'logs/', f)
-            attachment = MIMEApplication(open(file_path, 'rb').read(),
-                                         _subtype='txt')
-            attachment.add_header('Content-Disposition',
-                                  'attachment',
-                                  filename=f)
+        with tempfile.TemporaryFile() as archive_f:
+            skipped = archive_logs(tasks,
+                                   archive_f,
+                                   int(config.get('report_max_bytes',
+                                                  5000000)))
+            archive_f.seek(0)
+            attachment = MIMEApplication(archive_f.read(), _subtype='gzip')
+        attachment.add_header('Content-Disposition',
+                              'attachment',
+                              filename='logs_' + datetime.datetime.today()
+                              .strftime('%Y-%m-%d_%H-%M-%S') + '.tar.gz')
+        # No log fits in the size cap - nothing to attach
+        if len(skipped) < len(tasks):
             msg.attach(attachment)
-        msg.attach(MIMEText('Logs of current requests in attachment'))
-        send.sendmail(config['mail_from'], [email], msg.as_string())
-        send.quit()
+        text = 'Logs of current requests in attachment'
+        if skipped:
+            text += ' (size limit reached, not attached: ' + \
+                ', '.join(skipped) + ')'
+        msg.attach(MIMEText(text + format_tasks(tasks) +
+                            format_stats(stats)))
+        spool_message(config, [email], msg.as_string())
     # No open requests
     else:
         msg = MIMEMultipart()
         msg['Subject'] = 'There are currently no requests being processed'
-        send = smtplib.SMTP(config['mail_server'])
-        send.sendmail(config['mail_from'], [email], msg.as_string())
-        send.quit()
+        msg.attach(MIMEText('There are currently no requests '
+                            'being processed' + format_stats(stats)))
+        spool_message(config, [email], msg.as_string())
+
+
+def send_status(email: str,
+                key: str,
+                tasks: Sequence[Any],
+                config: dict
+                ) -> None:
+    """
+    Sends the state of the tasks found by MAC, tracker or switch
+    Executed if the <STATUS> key is present in the message text
+
+    Args:
+        email (str): Request sender email
+        key (str): MAC, tracker or switch IP-address
+        tasks (list): Task states found
+        config (dict): Dict with config data
+    """
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Status of ' + key
+    if tasks:
+        text = 'Active requests for ' + key + format_tasks(tasks)
+    else:
+        text = 'There are no active requests for ' + key
+    msg.attach(MIMEText(text))
+    spool_message(config, [email], msg.as_string())
 
 
 def send_start(log_file_name: str, mac: str, config: dict) -> None:
@@ -83,16 +222,55 @@ def send_start(log_file_name: str, mac: str, config: dict) -> None:
     """
     msg = MIMEMultipart()
     msg['Subject'] = mac + ' request accepted'
-    send = smtplib.SMTP(config['mail_server'])
     msg.attach(MIMEText(mac + ' request accepted, TRACKER: ' + log_file_name))
-    send.sendmail(config['mail_from'], [config['mailbox']], msg.as_string())
-    send.quit()
+    spool_message(config, [config['mailbox']], msg.as_string())
+
+
+def send_bulk_start(log_file_name: str,
+                    macs: List[str],
+                    config: dict
+                    ) -> None:
+    """
+    Sends a message about the opening of a bulk ticket
+    with the list of MAC addresses and the ticket tracker
+
+    Args:
+        log_file_name (str): Log file name (for current task)
+        macs (list): Device MAC-addresses
+        config (dict): Dict with config data
+    """
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Bulk request accepted (' + str(len(macs)) + ' MACs)'
+    msg.attach(MIMEText('Bulk request accepted, TRACKER: ' + log_file_name +
+                        '\r\n\r\n' + '\r\n'.join(macs)))
+    spool_message(config, [config['mailbox']], msg.as_string())
+
+
+def send_merged(log_file_name: str, mac: str, config: dict) -> None:
+    """
+    Sends a message that a duplicate request was attached
+    to the request in progress for the same MAC
+
+    Args:
+        log_file_name (str): Log file name of the request in progress
+            (empty if its MAC has not been parsed yet)
+        mac (str): Device MAC-address
+        config (dict): Dict with config data
+    """
+    msg = MIMEMultipart()
+    msg['Subject'] = mac + ' request merged'
+    text = mac + ' request merged with the request in progress'
+    if log_file_name:
+        text += ', TRACKER: ' + log_file_name
+    msg.attach(MIMEText(text))
+    spool_message(config, [config['mailbox']], msg.as_string())
 
 
 def send_end(log_file_name: str,
              mac: str,
              task_result: str,
-             config: dict
+             config: dict,
+             log: Optional[str] = None
              ) -> None:
     """
     Sends a message about the closing of the request
@@ -103,15 +281,14 @@ def send_end(log_file_name: str,
         mac (str): Device MAC-address
         task_result (str): Task result
         config (dict): Dict with config data
+        log (str): Task log (rendered from the log records if not given)
     """
     msg = MIMEMultipart()
     msg['Subject'] = task_result + ' ' + mac
-    send = smtplib.SMTP(config['mail_server'])
-    with open(config['log_dir'] + 'logs/' + log_file_name + '.txt', 'r') as f:
-        log = f.read()
+    if log is None:
+        log = task_log(log_file_name)
     msg.attach(MIMEText(log))
-    send.sendmail(config['mail_from'], [config['mailbox']], msg.as_string())
-    send.quit()
+    spool_message(config, [config['mailbox']], msg.as_string())
 
 
 def send_violation(message_dict: Dict[str, str],
@@ -129,65 +306,46 @@ def send_violation(message_dict: Dict[str, str],
     """
     msg = MIMEMultipart()
     msg['Subject'] = 'Security notice. Message from: ' + message_dict['email']
-    send = smtplib.SMTP(config['mail_server'])
     msg.attach(MIMEText(restriction +
                         '\r\n\r\n----------MESSAGE----------\r\n\r\n' +
                         message_dict['message']))
-    send.sendmail(config['mail_from'], [config['mailbox']], msg.as_string())
-    send.quit()
+    spool_message(config, [config['mailbox']], msg.as_string())
 
 
-def send_error(message_dict: Dict[str, str], error: str, config: dict) -> None:
+def send_busy(message_dict: Dict[str, str], config: dict) -> None:
     """
-    Error message
+    Request rejected, too many tickets are waiting for a task process
 
     Args:
         message_dict (dict): Dict with message data
             (senders email, and actual data)
-        error (str): Error string
         config (dict): Dict with config data
     """
     msg = MIMEMultipart()
-    msg['Subject'] = 'Error, such request does not exist'
-    send = smtplib.SMTP(config['mail_server'])
-    msg.attach(MIMEText(error +
+    msg['Subject'] = 'Request not accepted, the service is busy'
+    msg.attach(MIMEText('Too many requests are waiting, '
+                        'please send the request again later'
                         '\r\n\r\n----------MESSAGE----------\r\n\r\n' +
                         message_dict['message']))
-    send.sendmail(config['mail_from'], message_dict['email'], msg.as_string())
-    send.quit()
+    spool_message(config, message_dict['email'], msg.as_string())
 
 
-def kill_task(message_dict: Dict[str, str], config: dict) -> None:
+def send_error(message_dict: Dict[str, str], error: str, config: dict) -> None:
     """
-    Forces the request to end if the <KILL> key is present in the message
-    After the specified key in the message,
-    the ticket tracker must be indicated
+    Error message
 
     Args:
         message_dict (dict): Dict with message data
             (senders email, and actual data)
+        error (str): Error string
         config (dict): Dict with config data
     """
-    try:
-        reg_kill: str = r'(task_\S+)'
-        decoded_message = message_dict['message']
-        task_match = re.search(reg_kill, decoded_message)
-        assert task_match is not None
-        log_file_name = task_match.groups()[0]
-        kill_proc = int(log_file_name.split('_')[1])
-        try:
-            os.kill(kill_proc, 9)
-            mac = log_file_name.split('__')[1].replace('-', '.')
-            task_result = log_file_name + ' terminated'
-            send_end(log_file_name, mac, task_result, config)
-            mv = 'mv ' + config['log_dir'] + 'logs/' + \
-                log_file_name + '.txt ' + \
-                config['log_dir'] + 'log_archive/' + log_file_name + '.txt'
-            subprocess.Popen(mv, shell=True)
-        except Exception as error:
-            send_error(message_dict, str(error), config)
-    except Exception as error:
-        send_error(message_dict, str(error), config)
+    msg = MIMEMultipart()
+    msg['Subject'] = 'Error, such request does not exist'
+    msg.attach(MIMEText(error +
+                        '\r\n\r\n----------MESSAGE----------\r\n\r\n' +
+                        message_dict['message']))
+    spool_message(config, message_dict['email'], msg.as_string())
 
 
 def ip_list_check(log_file_name: str,
@@ -211,7 +369,7 @@ def ip_list_check(log_file_name: str,
         logging.info('!!!NOT OK!!! This host is in the list '
                      'of excluded addresses\r\n\r\nTask failed')
         task_result: str = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
+        end_task(log_file_name, mac, task_result, config, 'excluded_switch')
 
 
 def sql_answer_check(log_file_name: str,
@@ -231,26 +389,94 @@ def sql_answer_check(log_file_name: str,
     if 'Task failed' in sql_answer['answer']:
         logging.info(sql_answer['answer'])
         task_result: str = 'Task failed'
-        end_task(log_file_name, mac, task_result, config)
+        if 'CONNECTION ERROR' in sql_answer['answer']:
+            reason = 'log_server_error'
+        else:
+            reason = 'not_located'
+        end_task(log_file_name, mac, task_result, config, reason)
     else:
         logging.info('SQL_ANSWER: ' + sql_answer['answer'] + '\r\n')
 
 
-def clearing_message(raw_message_dict: Dict[str, str]) -> Dict[str, str]:
+# Markup of an HTML body: comment, style or script block, tag, entity
+# A tag ends at the next '<' or '>', an unclosed '<' stays in the text
+MARKUP_RE = re.compile(r'<!--|<(style|script)\b|<[^<>]*>'
+                       r'|&(?:#\d{1,7}|#x[0-9a-f]{1,6}|[a-z]\w{1,31});',
+                       re.IGNORECASE)
+# End of a comment or block
+BLOCK_END_RE = {'<!--': re.compile('-->'),
+                'style': re.compile(r'</style\s*>', re.IGNORECASE),
+                'script': re.compile(r'</script\s*>', re.IGNORECASE)}
+LINE_BREAKS_RE = re.compile(r'(\r\n){5,}')
+
+# Default body size limit (characters)
+BODY_LIMIT = 262144
+
+
+def strip_markup(text: str) -> str:
+    """
+    Removes HTML markup in one pass over the text
+    Comments, style and script blocks are removed with their contents
+    (an unclosed block is removed up to the end of the text)
+
+    Args:
+        text (str): HTML text
+
+    Returns:
+        (str): Text without markup
+    """
+    chunks: List[str] = []
+    pos = 0
+    match = MARKUP_RE.search(text)
+    while match is not None:
+        chunks.append(text[pos:match.start()])
+        pos = match.end()
+        block = (match.group(1) or match.group()).lower()
+        if block in BLOCK_END_RE:
+            block_end = BLOCK_END_RE[block].search(text, pos)
+            pos = block_end.end() if block_end is not None else len(text)
+        match = MARKUP_RE.search(text, pos)
+    chunks.append(text[pos:])
+    return ''.join(chunks)
+
+
+def strip_css(text: str) -> str:
+    """
+    Removes inline CSS: every line is cut after its last ';}'
+
+    Args:
+        text (str): Message text
+
+    Returns:
+        (str): Text without CSS
+    """
+    if ';}' not in text:
+        return text
+    return '\n'.join(line.rpartition(';}')[2] for line in text.split('\n'))
+
+
+def clearing_message(raw_message_dict: Dict[str, str],
+                     body_limit: int = BODY_LIMIT
+                     ) -> Dict[str, str]:
     """
     Message clearing
+    Runs in linear time, the body is cut to 'body_limit' characters,
+    a text/plain body is not cleared of markup
 
     Args:
         raw_message_dict (dict): Dict with message data
             (senders email, and actual data in raw format)
+        body_limit (int): Body size limit in characters (0 - no limit)
     Returns:
         raw_message_dict (dict): Dict with cleared message data
             (senders email, and actual data in raw format)
     """
-    reg_mess: str = r'<[\s\S|.]*?>|&nbsp;|&quot;|.*?;}'
-    clean_mess = re.sub(reg_mess, '', raw_message_dict['message'])
-    reg_line_break = r'(\r\n){5,}'
-    clean_mess = re.sub(reg_line_break, '\r\n', clean_mess)
+    clean_mess = raw_message_dict['message']
+    if body_limit > 0:
+        clean_mess = clean_mess[:body_limit]
+    if raw_message_dict.get('html', True):
+        clean_mess = strip_css(strip_markup(clean_mess))
+    clean_mess = LINE_BREAKS_RE.sub('\r\n', clean_mess)
     raw_message_dict.update({'message': clean_mess})
     return raw_message_dict
 
@@ -266,26 +492,8 @@ def find_macs_in_mess(decoded_message: str) -> str:
         no_mac (str): No MAC addresses found
         too_much_mac (str): To many matches in message
     """
-    reg = re.compile('\s(?P<mac>([0-9A-Fa-fАаВСсЕеOО]{2}[\s:.-]){5}'
-                     '([0-9A-Fa-fАаВСсЕеOО]{2})'
-                     '|([0-9A-Fa-fАаВСсЕеOО]{3}[\s:.-]){3}'
-                     '([0-9A-Fa-fАаВСсЕеOО]{3})'
-                     '|([([0-9A-Fa-fАаВСсЕеOО]{4}[\s:.-]){2}'
-                     '([0-9A-Fa-fАаВСсЕеOО]{4})'
-                     '|([0-9A-Fa-fАаВСсЕеOО]{12}))\s')
-    m = reg.finditer(decoded_message)
-    matches: list = []
-    for mat in m:
-        matches.append(mat.group('mac'))
-    format_matches: list = []
-    for match in matches:
-        match = match.replace(':', "").replace('-', "").replace('.', "") \
-                     .replace(' ', "").replace('\n', "").replace('\t', "")
-        match = match.lower()
-        # Replace Cyrillic characters
-        match = match.replace('а', 'a').replace('в', 'b').replace('с', 'c') \
-                     .replace('е', 'e').replace('о', '0').replace('o', '0')
-        format_matches.append(match)
+    format_matches = [match.group(1).translate(NORMALIZE)
+                      for match in MAC_RE.finditer(decoded_message)]
     if len(format_matches) == 1:
         new_mac = format_matches[0]
         return new_mac
@@ -313,44 +521,162 @@ def find_macs_in_mess_check(log_file_name: str,
     if 'No MAC addresses found' in mac:
         logging.info(mac)
         no_mac: str = 'No MAC addresses found'
-        end_task(log_file_name, no_mac, task_result, config)
-    elif 'Too many matches' in mac:
+        end_task(log_file_name, no_mac, task_result, config, 'no_mac')
+    elif 'many matches' in mac:
         logging.info(mac)
         to_many_mac: str = 'Too many matches'
-        end_task(log_file_name, to_many_mac, task_result, config)
+        end_task(log_file_name, to_many_mac, task_result, config,
+                 'too_many_macs')
     else:
         pass
 
 
-def create_sql_query(mac: str, config: dict) -> str:
+def create_sql_query(macs: List[str],
+                     after_id: int,
+                     upto_id: int
+                     ) -> Tuple[str, List[Any]]:
     """
-    Creates a SQL query for the log server
+    Creates one parameterized SQL query for the log server
+    covering all waiting MACs
+    Only today's rows in the (after_id, upto_id] ID range are scanned,
+    both conditions can be served by indexes
 
     Args:
+        macs (list): Device MAC-addresses
+        after_id (int): Last ID seen by the previous query
+        upto_id (int): Last ID of the table
+
+    Returns:
+        match_sql (str): SQL query
+        params (list): Query parameters
+    """
+    macs_cisco = [re.escape(mac[:4] + '.' + mac[4:8] + '.' + mac[8:12])
+                  for mac in macs]
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    match_sql = ('SELECT ID, FromHost, Message, DeviceReportedTime '
+                 'FROM SystemEvents WHERE ID > %s AND ID <= %s '
+                 'AND DeviceReportedTime >= %s AND DeviceReportedTime < %s '
+                 'AND Message REGEXP %s ORDER BY ID DESC')
+    params = [after_id,
+              upto_id,
+              today,
+              today + datetime.timedelta(days=1),
+              '(' + '|'.join(macs_cisco) + ')']
+    return match_sql, params
+
+
+def archive_task_log(log_file_name: str, log: str, config: dict) -> None:
+    """
+    Leaves the task log to the log archiver
+    The log is written under a name the archiver does not pick up
+    and moved in place, so a half-written log is never packed
+
+    Args:
+        log_file_name (str): Log file name (for current task)
+        log (str): Task log
+        config (dict): Dict with config data
+    """
+    path = config['log_dir'] + 'log_archive/' + log_file_name
+    with open(path + '.tmp', 'w') as log_f:
+        log_f.write(log)
+    os.replace(path + '.tmp', path + '.txt')
+
+
+def close_task(log_file_name: str,
+               mac: str,
+               task_result: str,
+               config: dict,
+               reason: str = ''
+               ) -> None:
+    """
+    Sends the request result and archives the task log
+
+    Args:
+        log_file_name (str): Log file name (for current task)
         mac (str): Device MAC-address
+        task_result (str): Task result string
         config (dict): Dict with config data
+        reason (str): Failure reason (metrics label)
+    """
+    if 'Task completed' in task_result:
+        count('psec_tasks_total', result='completed')
+    elif 'Task failed' in task_result:
+        count('psec_tasks_total', result='failed')
+        count('psec_task_failures_total', reason=reason or 'other')
+    else:
+        count('psec_tasks_total', result='killed')
+    logging.info(task_result, extra={'tracker': log_file_name,
+                                     'mac': mac,
+                                     'outcome': task_result})
+    log = task_log(log_file_name)
+    send_end(log_file_name, mac, task_result, config, log)
+    archive_task_log(log_file_name, log, config)
+
+
+def format_results(results: Dict[str, str],
+                   ports: Dict[str, Dict[str, str]]
+                   ) -> str:
+    """
+    Result table of a bulk task
+
+    Args:
+        results (dict): 'completed' or the failure reason by MAC
+        ports (dict): Task params by MAC (located devices)
 
     Returns:
-        match_sql (str): SQL query
+        (str): Result table
+    """
+    lines: list = []
+    for mac, reason in results.items():
+        params = ports.get(mac, {})
+        if reason == 'completed':
+            result = 'Task completed'
+        else:
+            result = 'Task failed (' + reason + ')'
+        lines.append(mac + ' | ' + params.get('ip_addr', '-') + ' | ' +
+                     params.get('port_num', '-') + ' | ' + result)
+    return '----------RESULTS----------\r\n\r\n' + \
+        'MAC | SWITCH | PORT | RESULT\r\n' + '\r\n'.join(lines) + \
+        '\r\n\r\n'
+
+
+def close_bulk_task(log_file_name: str,
+                    results: Dict[str, str],
+                    ports: Dict[str, Dict[str, str]],
+                    config: dict
+                    ) -> None:
+    """
+    Sends one report with the result of every MAC of a bulk task
+    and archives the task log
+
+    Args:
+        log_file_name (str): Log file name (for current task)
+        results (dict): 'completed' or the failure reason by MAC
+        ports (dict): Task params by MAC (located devices)
+        config (dict): Dict with config data
     """
-    mac_cisco = mac[:4] + '.' + mac[4:8] + '.' + mac[8:12]
-    match_sql = ('''mysql -u ''' +
-                 config['db_user'] +
-                 ''' -p''' +
-                 config['db_pass'] +
-                 ''' -D Syslog -e "SELECT FromHost, Message FROM '''
-                 '''SystemEvents WHERE DeviceReportedTime LIKE '%''' +
-                 datetime.datetime.today().strftime('%Y-%m-%d') +
-                 '''%' AND Message REGEXP '.*(''' +
-                 mac_cisco +
-                 ''').*' ORDER BY ID DESC LIMIT 1;"''')
-    return match_sql
+    for reason in results.values():
+        if reason == 'completed':
+            count('psec_tasks_total', result='completed')
+        else:
+            count('psec_tasks_total', result='failed')
+            count('psec_task_failures_total', reason=reason)
+    completed = sum(reason == 'completed' for reason in results.values())
+    task_result = 'Bulk task: ' + str(completed) + ' of ' + \
+        str(len(results)) + ' completed'
+    logging.info(task_result, extra={'tracker': log_file_name,
+                                     'mac': ' '.join(results),
+                                     'outcome': task_result})
+    log = format_results(results, ports) + task_log(log_file_name)
+    send_end(log_file_name, log_file_name, task_result, config, log)
+    archive_task_log(log_file_name, log, config)
 
 
 def end_task(log_file_name: str,
              mac: str,
              task_result: str,
-             config: dict
+             config: dict,
+             reason: str = ''
              ) -> None:
     """
     Ends a request
@@ -360,9 +686,25 @@ def end_task(log_file_name: str,
         mac (str): Device MAC-address
         task_result (str): Task result string
         config (dict): Dict with config data
+        reason (str): Failure reason (metrics label)
+    """
+    close_task(log_file_name, mac, task_result, config, reason)
+    sys.exit()
+
+
+def end_bulk_task(log_file_name: str,
+                  results: Dict[str, str],
+                  ports: Dict[str, Dict[str, str]],
+                  config: dict
+                  ) -> None:
+    """
+    Ends a bulk request
+
+    Args:
+        log_file_name (str): Log file name (for current task)
+        results (dict): 'completed' or the failure reason by MAC
+        ports (dict): Task params by MAC (located devices)
+        config (dict): Dict with config data
     """
-    send_end(log_file_name, mac, task_result, config)
-    mv = 'mv ' + config['log_dir'] + 'logs/' + log_file_name + '.txt ' + \
-        config['log_dir'] + 'log_archive/' + log_file_name + '.txt'
-    subprocess.Popen(mv, shell=True)
+    close_bulk_task(log_file_name, results, ports, config)
     sys.exit()
@@ -0,0 +1,247 @@
+#! /usr/bin/env python3
+"""
+Pool of authenticated switch SSH sessions (one pool per task process)
+"""
+import fcntl
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from metrics import observe, set_gauge
+from process_local import process_instance
+
+
+def netmiko_connect(params: Dict[str, Any]) -> Any:
+    """
+    Opens an SSH session and enters the privileged mode
+
+    Args:
+        params (dict): Netmiko connection params
+
+    Returns:
+        ssh (netmiko.BaseConnection): SSH session
+    """
+    # Imported here, the connection function can be replaced
+    from netmiko import ConnectHandler
+    ssh = ConnectHandler(**params)
+    ssh.enable()
+    return ssh
+
+
+class SessionPool:
+    """
+    Authenticated SSH sessions keyed by switch host
+    Sessions are reused by the following tasks of the process,
+    checked before reuse and closed after 'ssh_idle_timeout' seconds
+    """
+    def __init__(self,
+                 config: dict,
+                 connect: Callable[[Dict[str, Any]], Any] = netmiko_connect
+                 ) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+            connect (Callable): Opens a session from connection params
+        """
+        self.connect = connect
+        self.idle_timeout = float(config.get('ssh_idle_timeout', 300))
+        self.lock_dir = config['proj_dir'] + 'locks/'
+        self.sessions: Dict[str, Any] = {}
+        self.last_used: Dict[str, float] = {}
+        self.login_time: Dict[str, float] = {}
+        self.in_use: set = set()
+        self.lock = threading.Lock()
+        self.evictor: Optional[threading.Thread] = None
+        self.logins = 0
+        self.reused = 0
+        self.saved = 0.0
+
+    @contextmanager
+    def session(self, host: str, params: Dict[str, Any]) -> Iterator[Any]:
+        """
+        Takes the session to the host (a new one is opened if needed)
+        A session broken by an exception is closed
+
+        Args:
+            host (str): Switch address
+            params (dict): Connection params
+
+        Yields:
+            ssh (Any): SSH session
+        """
+        self.evict_idle()
+        with self.lock:
+            ssh = self.sessions.pop(host, None)
+            self.in_use.add(host)
+        try:
+            if ssh is not None and self.alive(ssh):
+                login = self.login_time.get(host, 0.0)
+                self.reused += 1
+                self.saved += login
+                logging.info('SSH session to ' + host + ' reused, saved ' +
+                             f'{login:.2f}' + ' s of login\r\n')
+            else:
+                if ssh is not None:
+                    self.disconnect(ssh)
+                start = time.monotonic()
+                ssh = self.connect(params)
+                self.login_time[host] = time.monotonic() - start
+                self.logins += 1
+                observe('psec_ssh_login_duration_seconds',
+                        self.login_time[host])
+                self.open_sessions()
+                logging.info('SSH login to ' + host + ' took ' +
+                             f'{self.login_time[host]:.2f}' + ' s\r\n')
+            try:
+                yield ssh
+            except Exception:
+                self.disconnect(ssh)
+                raise
+            # Normal end (including end_task()) - session goes back
+            except BaseException:
+                self.release(host, ssh)
+                raise
+            self.release(host, ssh)
+        finally:
+            with self.lock:
+                self.in_use.discard(host)
+            self.open_sessions()
+
+    def release(self, host: str, ssh: Any) -> None:
+        """
+        Returns the session to the pool
+
+        Args:
+            host (str): Switch address
+            ssh (Any): SSH session
+        """
+        with self.lock:
+            old = self.sessions.pop(host, None)
+            self.sessions[host] = ssh
+            self.last_used[host] = time.monotonic()
+        if old is not None:
+            self.disconnect(old)
+        self.start_evictor()
+
+    @staticmethod
+    def alive(ssh: Any) -> bool:
+        """
+        Session health check
+
+        Args:
+            ssh (Any): SSH session
+
+        Returns:
+            (bool): True if the session can be used
+        """
+        try:
+            return bool(ssh.is_alive())
+        except Exception:
+            return False
+
+    def open_sessions(self) -> int:
+        """
+        Number of open sessions (also sent to the metrics)
+
+        Returns:
+            (int): Idle and used sessions
+        """
+        with self.lock:
+            number = len(self.sessions) + len(self.in_use)
+        set_gauge('psec_ssh_open_sessions', number)
+        return number
+
+    @staticmethod
+    def disconnect(ssh: Any) -> None:
+        """
+        Closes a session, errors are ignored
+
+        Args:
+            ssh (Any): SSH session
+        """
+        try:
+            ssh.disconnect()
+        except Exception:
+            pass
+
+    def evict_idle(self) -> None:
+        """
+        Closes sessions idle for more than 'ssh_idle_timeout' seconds
+        """
+        deadline = time.monotonic() - self.idle_timeout
+        with self.lock:
+            hosts = [host for host in self.sessions
+                     if self.last_used.get(host, 0.0) < deadline and
+                     host not in self.in_use]
+            idle = [self.sessions.pop(host) for host in hosts]
+        for ssh in idle:
+            self.disconnect(ssh)
+        if idle:
+            self.open_sessions()
+
+    def start_evictor(self) -> None:
+        """
+        Starts the thread closing idle sessions (once per process)
+        """
+        if self.evictor is not None:
+            return
+
+        def evict() -> None:
+            while True:
+                time.sleep(min(self.idle_timeout, 30))
+                self.evict_idle()
+        self.evictor = threading.Thread(target=evict,
+                                        name='psec_ssh_evictor',
+                                        daemon=True)
+        self.evictor.start()
+
+    @contextmanager
+    def host_lock(self, host: str) -> Iterator[None]:
+        """
+        Serializes configuration changes on the host
+        between all task processes (file lock)
+
+        Args:
+            host (str): Switch address
+        """
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with open(self.lock_dir + host + '.lock', 'w') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def report(self) -> Dict[str, str]:
+        """
+        Pool statistics
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        return {
+            'SSH open sessions': str(len(self.sessions) + len(self.in_use)),
+            'SSH logins': str(self.logins),
+            'SSH reused sessions': str(self.reused),
+            'SSH login time saved (s)': f'{self.saved:.2f}',
+        }
+
+
+# Session pool of the current task process
+_pool: Dict[str, SessionPool] = {}
+
+
+def get_pool(config: dict) -> SessionPool:
+    """
+    Session pool of the current task process
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        (SessionPool): Session pool
+    """
+    return process_instance(_pool, lambda: SessionPool(config))
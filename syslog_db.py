@@ -0,0 +1,214 @@
+#! /usr/bin/env python3
+"""
+Log server database client (rsyslog 'Syslog' DB)
+"""
+import datetime
+import queue
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Iterator, List, NamedTuple, Optional, Sequence
+
+
+class SyslogEvent(NamedTuple):
+    """
+    Row of the SystemEvents table
+    """
+    id: int
+    from_host: str
+    message: str
+    reported_time: datetime.datetime
+
+
+# SystemEvents table of the rsyslog schema (for the SQLite stand-in)
+SQLITE_SCHEMA = '''CREATE TABLE IF NOT EXISTS SystemEvents (
+    ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    DeviceReportedTime TIMESTAMP,
+    FromHost VARCHAR(60),
+    Message TEXT
+)'''
+
+# Same index as in syslog_indexes.sql (migration for the real DB)
+SQLITE_INDEX = '''CREATE INDEX IF NOT EXISTS psec_reported_time
+    ON SystemEvents (DeviceReportedTime)'''
+
+
+def connect_mysql(config: dict) -> Any:
+    """
+    Connection to the MySQL/MariaDB log server database
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        (pymysql.connections.Connection): DB connection
+    """
+    # PyMySQL is needed only for the MySQL backend
+    import pymysql
+    return pymysql.connect(host=config['db_host'],
+                           port=int(config.get('db_port', 3306)),
+                           user=config['db_user'],
+                           password=config['db_pass'],
+                           database=config.get('db_name', 'Syslog'),
+                           connect_timeout=10,
+                           autocommit=True)
+
+
+def sqlite_regexp(pattern: str, value: Optional[str]) -> bool:
+    """
+    REGEXP operator for SQLite
+
+    Args:
+        pattern (str): Regular expression
+        value (str): Column value
+
+    Returns:
+        (bool): True if value matches
+    """
+    return value is not None and re.search(pattern, value) is not None
+
+
+def connect_sqlite(config: dict) -> sqlite3.Connection:
+    """
+    Connection to the local SQLite stand-in of the log server database
+
+    Args:
+        config (dict): Dict with config data
+
+    Returns:
+        conn (sqlite3.Connection): DB connection
+    """
+    conn = sqlite3.connect(config.get('db_path', 'syslog.db'),
+                           detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=False,
+                           isolation_level=None)
+    conn.create_function('REGEXP', 2, sqlite_regexp)
+    return conn
+
+
+class SyslogDB:
+    """
+    Pool of connections to the log server database
+    Queries are written with the '%s' placeholder for all backends
+    """
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+
+        Raises:
+            ValueError("config['db_backend'] must be 'mysql' or 'sqlite'"):
+                Unknown DB backend
+        """
+        self.config = config
+        self.backend = config.get('db_backend', 'mysql')
+        if self.backend not in ('mysql', 'sqlite'):
+            raise ValueError("config['db_backend'] must be "
+                             "'mysql' or 'sqlite'")
+        self.size = int(config.get('db_pool_size', 2))
+        self.idle: Any = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def connect(self) -> Any:
+        """
+        Opens a new DB connection
+
+        Returns:
+            (Any): DB connection
+        """
+        if self.backend == 'mysql':
+            return connect_mysql(self.config)
+        conn = connect_sqlite(self.config)
+        conn.execute(SQLITE_SCHEMA)
+        conn.execute(SQLITE_INDEX)
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[Any]:
+        """
+        Takes a connection from the pool
+        A new one is opened while the pool is not full,
+        otherwise waits for a free one.
+        A connection broken by an exception is closed
+
+        Yields:
+            conn (Any): DB connection
+        """
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                spare = self.opened < self.size
+                if spare:
+                    self.opened += 1
+            if spare:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.lock:
+                        self.opened -= 1
+                    raise
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        except Exception:
+            with self.lock:
+                self.opened -= 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+            raise
+        self.idle.put(conn)
+
+    def execute(self, query: str, params: Sequence[Any] = ()) -> List[Any]:
+        """
+        Executes a parameterized query
+
+        Args:
+            query (str): SQL query with '%s' placeholders
+            params (list): Query parameters
+
+        Returns:
+            (list): Result rows
+        """
+        if self.backend == 'sqlite':
+            query = query.replace('%s', '?')
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, tuple(params))
+                return list(cursor.fetchall())
+            finally:
+                cursor.close()
+
+    def events(self, query: str, params: Sequence[Any] = ()
+               ) -> List[SyslogEvent]:
+        """
+        Executes a SystemEvents query
+        (columns: ID, FromHost, Message, DeviceReportedTime)
+
+        Args:
+            query (str): SQL query with '%s' placeholders
+            params (list): Query parameters
+
+        Returns:
+            (list): SystemEvents rows
+        """
+        return [SyslogEvent(*row) for row in self.execute(query, params)]
+
+    def close(self) -> None:
+        """
+        Closes idle connections
+        """
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                self.opened -= 1
+            conn.close()
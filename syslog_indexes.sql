@@ -0,0 +1,9 @@
+-- Psec: index migration for the rsyslog 'Syslog' database (MySQL/MariaDB)
+-- mysql -u root -p Syslog < syslog_indexes.sql
+--
+-- SystemEvents.ID is the primary key in the rsyslog schema already,
+-- it serves the 'ID > last seen' cursor of every poll.
+-- The index below serves the DeviceReportedTime range used when
+-- a newly registered MAC is searched in today's rows.
+ALTER TABLE SystemEvents
+    ADD INDEX psec_reported_time (DeviceReportedTime);
@@ -0,0 +1,254 @@
+#! /usr/bin/env python3
+"""
+Syslog receiver for port-security violation messages
+"""
+import re
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+
+class MacEntry(NamedTuple):
+    """
+    Last violation seen for a MAC
+    """
+    ip_addr: str
+    port_num: str
+    message: str
+    timestamp: float
+
+
+class MacIndex:
+    """
+    Bounded, time-expiring MAC -> (switch IP, port, timestamp) index
+    """
+    def __init__(self, size: int, ttl: float) -> None:
+        """
+        Args:
+            size (int): Maximum number of MACs
+            ttl (float): Entry lifetime in seconds
+        """
+        self.size = size
+        self.ttl = ttl
+        self.entries: Any = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, mac: str, entry: MacEntry) -> None:
+        """
+        Adds (or refreshes) a MAC, the oldest MAC is dropped if full
+
+        Args:
+            mac (str): Device MAC-address
+            entry (MacEntry): Violation data
+        """
+        with self.lock:
+            self.entries.pop(mac, None)
+            self.entries[mac] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def get(self, mac: str) -> Optional[MacEntry]:
+        """
+        Looks up a MAC
+
+        Args:
+            mac (str): Device MAC-address
+
+        Returns:
+            (MacEntry): Violation data
+            (None): MAC is unknown or the entry has expired
+        """
+        deadline = time.time() - self.ttl
+        with self.lock:
+            self.expire(deadline)
+            entry = self.entries.get(mac)
+            if entry is not None and entry.timestamp < deadline:
+                del self.entries[mac]
+                return None
+            return entry
+
+    def expire(self, deadline: float) -> None:
+        """
+        Drops expired entries (the oldest are at the beginning)
+
+        Args:
+            deadline (float): Entries received before are expired
+        """
+        while self.entries:
+            mac, entry = next(iter(self.entries.items()))
+            if entry.timestamp >= deadline:
+                return
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+def parse_violation(message: str) -> Optional[Dict[str, str]]:
+    """
+    Parses a port-security violation syslog message
+
+    Args:
+        message (str): Syslog message
+
+    Returns:
+        (dict): MAC (without separators) and port number
+        (None): Not a violation message
+    """
+    if 'PORT_SECURITY-2-PSECURE_VIOLATION' not in message:
+        return None
+    reg_mac: str = r'([0-9a-fA-F]{4}[.][0-9a-fA-F]{4}[.][0-9a-fA-F]{4})'
+    re_port: str = r'(\S+Ethernet\d+/\d+/\d+)' \
+        r'|(\S+Ethernet\d+/\d+)|(\S+Ethernet\d+)'
+    match_mac = re.search(reg_mac, message)
+    match_port = re.search(re_port, message)
+    if match_mac is None or match_port is None:
+        return None
+    return {'mac': match_mac.group().replace('.', '').lower(),
+            'port_num': match_port.group()}
+
+
+class SyslogUDPHandler(socketserver.BaseRequestHandler):
+    """
+    One syslog datagram
+    """
+    def handle(self) -> None:
+        data = self.request[0]
+        self.server.receiver.receive(self.client_address[0],
+                                     data.decode('utf-8', 'replace'))
+
+
+class SyslogTCPHandler(socketserver.StreamRequestHandler):
+    """
+    Syslog TCP session (newline-delimited messages)
+    """
+    def handle(self) -> None:
+        for line in self.rfile:
+            self.server.receiver.receive(self.client_address[0],
+                                         line.decode('utf-8', 'replace'))
+
+
+class SyslogUDPServer(socketserver.ThreadingUDPServer):
+    """
+    Syslog UDP listener
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SyslogTCPServer(socketserver.ThreadingTCPServer):
+    """
+    Syslog TCP listener
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SyslogReceiver:
+    """
+    UDP/TCP syslog listener
+    Violation messages are put in the MAC index
+    and waiting tasks are notified right away
+    """
+    def __init__(self,
+                 config: dict,
+                 notify: Callable[[str, Dict[str, str]], int]
+                 ) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+            notify (Callable): Passes the answer to the tasks waiting
+                for the MAC (LogWatcher.notify)
+        """
+        self.notify = notify
+        self.index = MacIndex(int(config.get('syslog_index_size', 10000)),
+                              float(config.get('syslog_index_ttl', 43200)))
+        address = (config.get('syslog_address', '0.0.0.0'),
+                   int(config['syslog_port']))
+        self.servers = [SyslogUDPServer(address, SyslogUDPHandler),
+                        SyslogTCPServer(address, SyslogTCPHandler)]
+        for server in self.servers:
+            server.receiver = self
+        self.received = 0
+        self.violations = 0
+        self.hits = 0
+
+    @staticmethod
+    def answer(entry: MacEntry) -> Dict[str, str]:
+        """
+        Answer in the log-server format
+
+        Args:
+            entry (MacEntry): Violation data
+
+        Returns:
+            (dict): Answer with vendor indication
+        """
+        return {'vendor': 'cisco',
+                'answer': entry.ip_addr + ' ' + entry.message}
+
+    def receive(self, host: str, message: str) -> None:
+        """
+        Handles one syslog message
+
+        Args:
+            host (str): Switch IP-address (message source)
+            message (str): Syslog message
+        """
+        self.received += 1
+        violation = parse_violation(message)
+        if violation is None:
+            return
+        self.violations += 1
+        entry = MacEntry(host,
+                         violation['port_num'],
+                         message.strip(),
+                         time.time())
+        self.index.add(violation['mac'], entry)
+        self.hits += self.notify(violation['mac'],
+                                 self.answer(entry))
+
+    def replay(self, mac: str) -> None:
+        """
+        Notifies a newly registered task
+        if the device has already been connected
+
+        Args:
+            mac (str): Device MAC-address
+        """
+        entry = self.index.get(mac)
+        if entry is not None:
+            self.hits += self.notify(mac, self.answer(entry))
+
+    def start(self) -> None:
+        """
+        Starts the listener threads
+        """
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever,
+                             name='psec_syslog',
+                             daemon=True).start()
+
+    def close(self) -> None:
+        """
+        Stops the listeners
+        """
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def report(self) -> Dict[str, str]:
+        """
+        Receiver statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        return {
+            'Syslog messages received': str(self.received),
+            'Syslog violations': str(self.violations),
+            'Syslog indexed MACs': str(len(self.index)),
+            'Syslog task hits': str(self.hits),
+        }
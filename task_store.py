@@ -0,0 +1,411 @@
+#! /usr/bin/env python3
+"""
+Durable task state (local SQLite store)
+"""
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set
+
+from process_local import SQLiteStore
+
+# Task stages in order of execution
+STAGES = ('parse', 'notify', 'locate', 'check', 'configure')
+# Task is no longer executed
+FINAL_STAGES = ('done', 'failed', 'killed')
+# Finished task IDs remembered by the task registry
+FINISHED_KEEP = 10000
+
+TASK_SCHEMA = '''CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    stage TEXT NOT NULL,
+    message TEXT NOT NULL,
+    tracker TEXT NOT NULL DEFAULT '',
+    mac TEXT NOT NULL DEFAULT '',
+    answer TEXT,
+    params TEXT,
+    pid INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    duplicates INTEGER NOT NULL DEFAULT 0
+)'''
+
+TASK_INDEX = '''CREATE INDEX IF NOT EXISTS tasks_stage ON tasks (stage)'''
+
+
+class TaskRow(NamedTuple):
+    """
+    Task state
+    """
+    id: int
+    stage: str
+    message: str
+    tracker: str
+    mac: str
+    answer: Optional[Dict[str, str]]
+    params: Optional[Dict[str, str]]
+    pid: int
+    created: float
+    updated: float
+    duplicates: int
+
+
+class TaskStore(SQLiteStore):
+    """
+    Task stages persisted in SQLite
+    A waiting task is only a row, tasks are resumed
+    from the last completed stage after a restart
+    """
+    schema = (TASK_SCHEMA, TASK_INDEX)
+
+    def __init__(self, config: dict) -> None:
+        """
+        Args:
+            config (dict): Dict with config data
+        """
+        super().__init__(config.get('task_db',
+                                    config['proj_dir'] + 'tasks.db'))
+        # Gets every changed task state (task registry)
+        self.listener: Optional[Callable[[TaskRow], None]] = None
+
+    def changed(self, task: Optional[TaskRow]) -> Optional[TaskRow]:
+        """
+        Passes a changed task state to the listener
+
+        Args:
+            task (TaskRow): Task state
+
+        Returns:
+            (TaskRow): The same task state
+        """
+        if task is not None and self.listener is not None:
+            self.listener(task)
+        return task
+
+    def migrate(self, conn: sqlite3.Connection) -> None:
+        """
+        Adds the columns missing in the store of a previous version
+
+        Args:
+            conn (sqlite3.Connection): DB connection
+        """
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(tasks)')]
+        if 'duplicates' not in columns:
+            conn.execute('ALTER TABLE tasks ADD COLUMN duplicates '
+                         'INTEGER NOT NULL DEFAULT 0')
+
+    def execute(self, query: str, params: tuple = ()) -> List[Any]:
+        """
+        Executes a query
+
+        Args:
+            query (str): SQL query
+            params (tuple): Query parameters
+
+        Returns:
+            (list): Result rows
+        """
+        with self.lock:
+            cursor = self.connection().execute(query, params)
+            try:
+                return cursor.fetchall()
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def row(data: tuple) -> TaskRow:
+        """
+        Task state from a table row
+
+        Args:
+            data (tuple): Table row
+
+        Returns:
+            (TaskRow): Task state
+        """
+        values = list(data)
+        for number in (5, 6):
+            if values[number] is not None:
+                values[number] = json.loads(values[number])
+        return TaskRow(*values)
+
+    def create(self, message: str, mac: str = '') -> int:
+        """
+        Adds a new task
+
+        Args:
+            message (str): Decoded message from email
+            mac (str): Device MAC-address (if found in the message),
+                MAC-addresses of a bulk task separated by spaces
+
+        Returns:
+            (int): Task ID
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.connection().execute(
+                'INSERT INTO tasks (stage, message, mac, created, updated) '
+                'VALUES (?, ?, ?, ?, ?)', (STAGES[0], message, mac, now, now))
+            try:
+                task_id = cursor.lastrowid
+            finally:
+                cursor.close()
+        self.changed(self.get(task_id))
+        return task_id
+
+    def get(self, task_id: int) -> Optional[TaskRow]:
+        """
+        Task state
+
+        Args:
+            task_id (int): Task ID
+
+        Returns:
+            (TaskRow): Task state
+            (None): Unknown task
+        """
+        rows = self.execute('SELECT * FROM tasks WHERE id = ?', (task_id,))
+        return self.row(rows[0]) if rows else None
+
+    def advance(self, task_id: int, stage: str, **fields: Any
+                ) -> Optional[TaskRow]:
+        """
+        Moves the task to the stage (a finished task is not changed)
+
+        Args:
+            task_id (int): Task ID
+            stage (str): New stage
+            **fields: Task data (tracker, mac, answer, params, pid)
+
+        Returns:
+            (TaskRow): Task state
+            (None): Unknown task
+        """
+        columns = ['stage = ?', 'updated = ?']
+        params: list = [stage, time.time()]
+        for name, value in fields.items():
+            columns.append(name + ' = ?')
+            if name in ('answer', 'params'):
+                value = json.dumps(value)
+            params.append(value)
+        params.append(task_id)
+        self.execute('UPDATE tasks SET ' + ', '.join(columns) +
+                     ' WHERE id = ? AND stage NOT IN ' +
+                     str(FINAL_STAGES), tuple(params))
+        return self.changed(self.get(task_id))
+
+    def release(self, task_id: int) -> None:
+        """
+        Clears the task process (the task is between stages
+        or resumed after a restart)
+
+        Args:
+            task_id (int): Task ID
+        """
+        self.execute('UPDATE tasks SET pid = 0 WHERE id = ?', (task_id,))
+
+    def kill(self, task_id: int) -> Optional[TaskRow]:
+        """
+        Marks the task as killed
+
+        Args:
+            task_id (int): Task ID
+
+        Returns:
+            (TaskRow): Task state before the kill
+            (None): Unknown or finished task
+        """
+        with self.lock:
+            conn = self.connection()
+            rows = conn.execute('SELECT * FROM tasks WHERE id = ? '
+                                'AND stage NOT IN ' + str(FINAL_STAGES),
+                                (task_id,)).fetchall()
+            if not rows:
+                return None
+            conn.execute("UPDATE tasks SET stage = 'killed', updated = ? "
+                         "WHERE id = ?", (time.time(), task_id))
+        self.changed(self.get(task_id))
+        return self.row(rows[0])
+
+    def merge(self, task_id: int) -> Optional[TaskRow]:
+        """
+        Counts a duplicate request merged into the task
+
+        Args:
+            task_id (int): Task ID
+
+        Returns:
+            (TaskRow): Task state
+            (None): The task has finished
+        """
+        with self.lock:
+            cursor = self.connection().execute(
+                'UPDATE tasks SET duplicates = duplicates + 1 '
+                'WHERE id = ? AND stage NOT IN ' + str(FINAL_STAGES),
+                (task_id,))
+            try:
+                merged = cursor.rowcount
+            finally:
+                cursor.close()
+        if not merged:
+            return None
+        return self.changed(self.get(task_id))
+
+    def unfinished(self) -> List[TaskRow]:
+        """
+        Tasks to resume after a restart
+
+        Returns:
+            (list): Task states
+        """
+        rows = self.execute('SELECT * FROM tasks WHERE stage NOT IN ' +
+                            str(FINAL_STAGES) + ' ORDER BY id')
+        return [self.row(data) for data in rows]
+
+    def report(self) -> Dict[str, str]:
+        """
+        Task store statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        counts = dict(self.execute('SELECT stage, COUNT(*) FROM tasks '
+                                   'GROUP BY stage'))
+        stats = {'Tasks ' + stage: str(counts.get(stage, 0))
+                 for stage in STAGES + FINAL_STAGES}
+        duplicates = self.execute('SELECT SUM(duplicates) FROM tasks')
+        stats['Duplicate requests merged'] = str(duplicates[0][0] or 0)
+        return stats
+
+
+def task_macs(task: TaskRow) -> List[str]:
+    """
+    MAC-addresses of the task
+    (a bulk task keeps its MACs separated by spaces)
+
+    Args:
+        task (TaskRow): Task state
+
+    Returns:
+        (list): Device MAC-addresses
+    """
+    return task.mac.split()
+
+
+class TaskRegistry:
+    """
+    Active tasks of the main process indexed by tracker, MAC and switch
+    (a bulk task is indexed by each of its MACs and switches)
+    (kept in step with the task store through its listener,
+    states from worker events may arrive late and out of order)
+    """
+    def __init__(self) -> None:
+        self.tasks: Dict[int, TaskRow] = {}
+        # Recently finished tasks (in order of finishing)
+        self.finished: Dict[int, None] = {}
+        self.by_tracker: Dict[str, int] = {}
+        self.by_mac: Dict[str, Set[int]] = {}
+        self.by_switch: Dict[str, Set[int]] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def switches(task: TaskRow) -> Set[str]:
+        """
+        Switch IP-addresses of the task (known after the check stage,
+        a bulk task has the switches of its ports)
+
+        Args:
+            task (TaskRow): Task state
+
+        Returns:
+            (set): IP-addresses
+        """
+        params = task.params or {}
+        if 'ports' in params:
+            return set(port['ip_addr'] for port in params['ports'].values())
+        return {params['ip_addr']} if 'ip_addr' in params else set()
+
+    def update(self, task: TaskRow) -> None:
+        """
+        Indexes a changed task, finished tasks are removed
+        A state older than the indexed one or a state of a finished
+        task (posted by a worker before the task was killed)
+        is ignored
+
+        Args:
+            task (TaskRow): Task state
+        """
+        with self.lock:
+            if task.id in self.finished:
+                return
+            old = self.tasks.get(task.id)
+            if old is not None and task.updated < old.updated:
+                return
+            self.tasks.pop(task.id, None)
+            if old is not None:
+                self.by_tracker.pop(old.tracker, None)
+                for mac in task_macs(old):
+                    self.by_mac.get(mac, set()).discard(old.id)
+                for switch in self.switches(old):
+                    self.by_switch.get(switch, set()).discard(old.id)
+            if task.stage in FINAL_STAGES:
+                self.finished[task.id] = None
+                if len(self.finished) > FINISHED_KEEP:
+                    del self.finished[next(iter(self.finished))]
+                return
+            self.tasks[task.id] = task
+            if task.tracker:
+                self.by_tracker[task.tracker] = task.id
+            for mac in task_macs(task):
+                self.by_mac.setdefault(mac, set()).add(task.id)
+            for switch in self.switches(task):
+                self.by_switch.setdefault(switch, set()).add(task.id)
+
+    def tracker(self, tracker: str) -> Optional[TaskRow]:
+        """
+        Task by tracker
+
+        Args:
+            tracker (str): Task tracker
+
+        Returns:
+            (TaskRow): Task state
+            (None): No such active task
+        """
+        with self.lock:
+            task_id = self.by_tracker.get(tracker)
+            return self.tasks.get(task_id) if task_id is not None else None
+
+    def find(self, key: str) -> List[TaskRow]:
+        """
+        Active tasks by tracker, MAC (any format) or switch IP-address
+
+        Args:
+            key (str): Tracker, MAC or IP-address
+
+        Returns:
+            (list): Task states
+        """
+        mac = ''.join(char for char in key.lower() if char.isalnum())
+        with self.lock:
+            if key in self.by_tracker:
+                ids = {self.by_tracker[key]}
+            elif key in self.by_switch:
+                ids = set(self.by_switch[key])
+            else:
+                ids = set(self.by_mac.get(mac, ()))
+            return [self.tasks[task_id] for task_id in sorted(ids)]
+
+    def active(self) -> List[TaskRow]:
+        """
+        All active tasks
+
+        Returns:
+            (list): Task states
+        """
+        with self.lock:
+            return [self.tasks[task_id] for task_id in sorted(self.tasks)]
+
+    def __len__(self) -> int:
+        return len(self.tasks)
@@ -3,11 +3,312 @@
 Some unit tests
 """
 import datetime
+import email
+import io
+import json
+import logging
+import multiprocessing
+import os
+import select
+import socket
+import socketserver
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
+import urllib.request
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import formatdate
 
-from service_funcs import (clearing_message,
+from archiver import LogArchiver
+from cisco_class import BaseCiscoSSH, BulkCiscoSSH, RunningConfig
+from cisco_conn import cisco_bulk_connection
+import command_timing
+from command_timing import CommandTimer, TimingStore
+import commit_scheduler
+from commit_scheduler import CommitScheduler
+import log_pipeline
+import ssh_pool
+from log_parser import bulk_parse, match_events
+from log_pipeline import TaskContext, TaskLogWriter, record_dict
+from log_serv_conn import LogServerDB
+from log_watcher import LogWatcher
+import metrics
+from mac_extract import MacCandidate, extract_macs, ticket_macs
+from mail_intake import ImapIdleIntake, IntakeStats, make_intake, read_mail
+from outbox import Outbox, outbox_dir, spool_message
+import psec
+from service_funcs import (archive_task_log,
+                           clearing_message,
                            find_macs_in_mess,
-                           create_sql_query)
+                           create_sql_query,
+                           send_report)
+from ssh_pool import SessionPool
+from syslog_db import SyslogDB, SyslogEvent
+from syslog_receiver import MacEntry, MacIndex, SyslogReceiver
+from task_store import TaskRegistry, TaskRow, TaskStore
+from worker_pool import (TaskCancelled,
+                         WorkerPool,
+                         check_cancelled,
+                         post_event,
+                         wait_reply)
+
+# Results of pool tasks (shared with workers through inheritance)
+pool_results = multiprocessing.Queue()
+
+
+def pool_task(number: int) -> None:
+    """
+    Test task, every second one ends with sys.exit() like end_task()
+    """
+    pool_results.put((number, os.getpid()))
+    if number % 2:
+        sys.exit()
+
+
+def pool_watch_task(number: int) -> None:
+    """
+    Test task waiting for a reply from the main process
+    """
+    post_event('watch', 'task_' + str(number), number)
+    pool_results.put(wait_reply('task_' + str(number)))
+
+
+def pool_noreply_task(number: int) -> None:
+    """
+    Test task waiting for a reply that does not come
+    """
+    pool_results.put(wait_reply('task_' + str(number), 0.2, 'timeout'))
+
+
+def pool_switch_task(number: int, host: str) -> None:
+    """
+    Test task taking a switch session from the pool of its worker
+    (the first switch is slow)
+    """
+    with ssh_pool.get_pool({}).session(host, {}):
+        if host == '10.0.0.1':
+            time.sleep(0.2)
+    pool_results.put((number, os.getpid(), ssh_pool.get_pool({}).logins))
+
+
+def pool_cancel_task(number: int) -> None:
+    """
+    Test task checking for cancellation (number 9 never checks)
+    """
+    pool_results.put(('started', number))
+    try:
+        while True:
+            time.sleep(0.05)
+            if number != 9:
+                check_cancelled()
+    except TaskCancelled:
+        pool_results.put(('cancelled', number))
+        raise
+
+
+def make_mail(number: int) -> bytes:
+    """
+    Test message
+    """
+    return ('Received: from mx.example.com by mail.example.com; ' +
+            formatdate() + '\r\n'
+            'From: Infsec <infsec@example.com>\r\n'
+            'Subject: ticket\r\n'
+            'Date: ' + formatdate() + '\r\n'
+            'Content-Type: text/plain; charset="utf-8"\r\n'
+            '\r\n'
+            'Ticket ' + str(number) + ' 0912.AB34.0009 \r\n').encode()
+
+
+class FakePOP3Handler(socketserver.StreamRequestHandler):
+    """
+    Minimal POP3 server session
+    """
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self) -> None:
+        mailbox = self.server.mailbox
+        self.server.sessions += 1
+        deleted: set = set()
+        self.reply('+OK ready')
+        for raw_line in self.rfile:
+            command, *args = raw_line.decode().split()
+            command = command.upper()
+            if command in ('USER', 'PASS'):
+                self.reply('+OK')
+            elif command == 'STAT':
+                self.reply('+OK ' + str(len(mailbox)) + ' ' +
+                           str(sum(len(mail) for mail in mailbox)))
+            elif command == 'LIST':
+                self.reply('+OK')
+                for number, mail in enumerate(mailbox, 1):
+                    self.reply(str(number) + ' ' + str(len(mail)))
+                self.reply('.')
+            elif command == 'RETR':
+                self.server.retrieved += 1
+                self.wfile.write(b'+OK\r\n' + mailbox[int(args[0]) - 1] +
+                                 b'.\r\n')
+            elif command == 'DELE':
+                deleted.add(int(args[0]) - 1)
+                self.reply('+OK')
+            elif command == 'QUIT':
+                mailbox[:] = [mail for number, mail in enumerate(mailbox)
+                              if number not in deleted]
+                self.reply('+OK')
+                return
+
+
+class FakePOP3Server(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the mail server
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: list) -> None:
+        super().__init__(('127.0.0.1', 0), FakePOP3Handler)
+        self.mailbox = mailbox
+        self.sessions = 0
+        self.retrieved = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def config(self, batch_size: int = 0) -> dict:
+        return {
+            'mail_server': '127.0.0.1',
+            'pop3_port': self.server_address[1],
+            'mail_from': 'psec@example.com',
+            'mail_pass': 'PASS',
+            'mail_batch_size': batch_size,
+        }
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal SMTP session
+    """
+
+    def handle(self) -> None:
+        self.server.sessions += 1
+        self.wfile.write(b'220 fake ESMTP\r\n')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                for data_line in self.rfile:
+                    if data_line == b'.\r\n':
+                        break
+                self.server.delivered += 1
+                self.wfile.write(b'250 queued\r\n')
+            elif command == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the mail relay
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.sessions = 0
+        self.delivered = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class OutboxTests(unittest.TestCase):
+    """
+    Outbound mail queue
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.server = FakeSMTPServer()
+        self.addCleanup(self.server.stop)
+        self.config = {'proj_dir': self.tmp_dir.name + '/',
+                       'mail_server': '127.0.0.1:' +
+                       str(self.server.server_address[1]),
+                       'mail_from': 'psec@example.com',
+                       'outbox_max_attempts': 2}
+
+    def test_one_connection(self):
+        """
+        Spooled messages are sent over one SMTP connection
+        """
+        for number in range(5):
+            spool_message(self.config, ['noc@example.com'],
+                          'Subject: ' + str(number) + '\r\n\r\ntext')
+        outbox = Outbox(self.config)
+        self.assertEqual(outbox.report()['Outbox depth'], '5')
+        outbox.flush()
+        self.assertEqual(self.server.delivered, 5)
+        self.assertEqual(self.server.sessions, 1)
+        self.assertEqual(outbox.report()['Outbox depth'], '0')
+        self.assertEqual(outbox.report()['Outbox sent'], '5')
+        outbox.disconnect()
+
+    def test_retry(self):
+        """
+        Failed sends are retried with backoff, then put aside
+        """
+        spool_message(self.config, ['noc@example.com'],
+                      'Subject: 1\r\n\r\ntext')
+        self.server.stop()
+        outbox = Outbox(self.config)
+        outbox.flush()
+        self.assertEqual(len(outbox.pending()), 1)
+        # Backoff, the message is not sent again right away
+        outbox.flush()
+        self.assertEqual(len(outbox.retry_at), 1)
+        outbox.retry_at.clear()
+        outbox.flush()
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual(len(os.listdir(outbox.spool + 'failed/')), 1)
+        self.assertEqual(outbox.report()['Outbox failed'], '1')
+
+    def test_corrupt_spool_file(self):
+        """
+        A spool file that can not be read is put aside,
+        the messages behind it are sent
+        """
+        spool = outbox_dir(self.config)
+        os.makedirs(spool)
+        with open(spool + '0_corrupt.json', 'w') as spool_f:
+            spool_f.write('{"from": "psec@example.com", "to"')
+        with open(spool + '1_missing.json', 'w') as spool_f:
+            json.dump({'from': 'psec@example.com'}, spool_f)
+        spool_message(self.config, ['noc@example.com'],
+                      'Subject: 1\r\n\r\ntext')
+        outbox = Outbox(self.config)
+        with self.assertLogs(level='ERROR'):
+            outbox.flush()
+        outbox.disconnect()
+        self.assertEqual(self.server.delivered, 1)
+        self.assertEqual(outbox.pending(), [])
+        self.assertEqual(sorted(os.listdir(spool + 'failed/')),
+                         ['0_corrupt.json', '1_missing.json'])
 
 
 class ServiceTests(unittest.TestCase):
@@ -50,6 +351,33 @@ class ServiceTests(unittest.TestCase):
             'message': '\r\npassed'
         })
 
+        # Unclosed '<' does not swallow the rest of the body
+        raw_message_dict = {
+            'message': 'a < b <br>0912.AB34.0009&amp;'
+        }
+        self.assertEqual(clearing_message(raw_message_dict), {
+            'message': 'a < b 0912.AB34.0009'
+        })
+
+        # Style blocks and comments are removed with their contents
+        raw_message_dict = {
+            'message': '<STYLE>\r\np.Mso\r\n\t{margin:0cm}\r\n</STYLE>'
+                       '<!-- [if gte mso 9] -->pas<p class="x">sed'
+        }
+        self.assertEqual(clearing_message(raw_message_dict), {
+            'message': 'passed'
+        })
+
+        # Plain text is not cleared of markup, the body is limited
+        raw_message_dict = {
+            'message': 'MAC <0912.AB34.0009> &nbsp;' + 'x' * 100,
+            'html': False
+        }
+        self.assertEqual(clearing_message(raw_message_dict, 26), {
+            'message': 'MAC <0912.AB34.0009> &nbsp',
+            'html': False
+        })
+
     def test_find_macs_in_mess(self):
         """
         Find MACs in mesage test
@@ -149,22 +477,1453 @@ class ServiceTests(unittest.TestCase):
         decoded_message = ('Some messsage 0912AO340009 for test')
         self.assertEqual(find_macs_in_mess(decoded_message), '0912a0340009')
 
+    def test_extract_macs(self):
+        """
+        Batch MAC extraction test
+        """
+        messages = ['0912.AB34.0009',
+                    'Printer 09:12:ab:34:00:09 09-12-АВ-34-ОО-09\r\n',
+                    'Phone 8 495 123 4567, inv. 123456789012',
+                    'Some messsage for test']
+        self.assertEqual(extract_macs(messages), [
+            [MacCandidate('0912ab340009', 0, 14, 1.0)],
+            [MacCandidate('0912ab340009', 8, 25, 1.0),
+             MacCandidate('0912ab340009', 26, 43, 0.8)],
+            [MacCandidate('123456789012', 27, 39, 0.5)],
+            []])
+
+        # Mixed separators
+        self.assertEqual(extract_macs(['x 0912.ab34-0009 y'])[0][0].confidence,
+                         0.7)
+
+        # Adjacent MACs are all found
+        decoded_message = 'Some messsage 0912AB340009 0912AB340010 for test'
+        self.assertEqual(find_macs_in_mess(decoded_message),
+                         'To many matches\r\n\r\nTask failed')
+
+    def test_ticket_macs(self):
+        """
+        A number next to a MAC does not make the ticket a bulk request
+        """
+        self.assertEqual(ticket_macs('Printer 09:12:ab:34:00:09 '
+                                     'inv. 123456789012'),
+                         ['0912ab340009'])
+        self.assertEqual(ticket_macs('Printer 0912.AB34.0009 '
+                                     '09-12-АВ-34-ОО-09 0912.ab34.0010'),
+                         ['0912ab340009', '0912ab340010'])
+        # Only digits - still a MAC
+        self.assertEqual(ticket_macs('Phone 001122334455'),
+                         ['001122334455'])
+
     def test_create_sql_query(self):
         """
         Generate SQL query test
         """
-        mac = '4516ab87ea90'
-        date = datetime.datetime.today().strftime('%Y-%m-%d')
-        config = {
-            'db_user': 'USER',
-            'db_pass': 'PASS',
+        macs = ['4516ab87ea90', '0912ab340009']
+        today = datetime.datetime.combine(datetime.date.today(),
+                                          datetime.time())
+        self.assertEqual(create_sql_query(macs, 10, 20), (
+            'SELECT ID, FromHost, Message, DeviceReportedTime '
+            'FROM SystemEvents WHERE ID > %s AND ID <= %s '
+            'AND DeviceReportedTime >= %s AND DeviceReportedTime < %s '
+            'AND Message REGEXP %s ORDER BY ID DESC',
+            [10, 20, today, today + datetime.timedelta(days=1),
+             r'(4516\.ab87\.ea90|0912\.ab34\.0009)']))
+
+    def test_match_events(self):
+        """
+        Events of a batched query are split by MAC
+        """
+        now = datetime.datetime.now()
+        events = [
+            SyslogEvent(2, '10.0.0.2', '%PORT_SECURITY-2-PSECURE_VIOLATION: '
+                        'caused by MAC address 4516.ab87.ea90 on port '
+                        'GigabitEthernet0/2.', now),
+            SyslogEvent(1, '10.0.0.1', '%PORT_SECURITY-2-PSECURE_VIOLATION: '
+                        'caused by MAC address 4516.ab87.ea90 on port '
+                        'GigabitEthernet0/1.', now),
+        ]
+        found = match_events(events, ['4516ab87ea90', '0912ab340009'])
+        self.assertEqual(list(found), ['4516ab87ea90'])
+        self.assertEqual(found['4516ab87ea90']['vendor'], 'cisco')
+        self.assertTrue(found['4516ab87ea90']['answer'].startswith('10.0.0.2'))
+
+    def test_send_report(self):
+        """
+        REPORT logs in one compressed attachment under the size cap
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = {'proj_dir': tmp_dir.name + '/',
+                  'log_dir': tmp_dir.name + '/',
+                  'mail_from': 'psec@example.com',
+                  'report_max_bytes': 2800}
+        writer = TaskLogWriter(config)
+        writer.open()
+        self.addCleanup(writer.close)
+        log_pipeline._main['writer'] = writer
+        self.addCleanup(log_pipeline._main.clear)
+        tasks = []
+        for number in range(3):
+            writer.write({'time': time.time(),
+                          'tracker': 'task_' + str(number),
+                          'message': os.urandom(1000).hex()})
+            tasks.append(TaskRow(number, 'locate', '',
+                                 'task_' + str(number), '4516ab87ea90',
+                                 None, None, 0, time.time() - 3700,
+                                 time.time(), 0))
+        send_report('noc@example.com', config, {'Tasks': '1'}, tasks)
+        spool = tmp_dir.name + '/outbox/'
+        with open(spool + os.listdir(spool)[0]) as spool_f:
+            msg = email.message_from_string(json.load(spool_f)['message'])
+        parts = msg.get_payload()
+        self.assertEqual(len(parts), 2)
+        archive = parts[0].get_payload(decode=True)
+        # The cap is hard (compressed size)
+        self.assertLessEqual(len(archive), 2800)
+        with tarfile.open(fileobj=io.BytesIO(archive), mode='r:gz') as tar:
+            self.assertEqual(tar.getnames(), ['task_0.txt', 'task_1.txt'])
+            self.assertEqual(len(tar.extractfile('task_1.txt')
+                                 .read().split()[-1]), 2000)
+        text = parts[1].get_payload()
+        self.assertIn('not attached: task_2.txt', text)
+        self.assertIn('task_0 | 4516ab87ea90 | locate | - | 1h 01m', text)
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal IMAP server session (with IDLE)
+    """
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self) -> None:
+        mailbox = self.server.mailbox
+        deleted: set = set()
+        self.reply('* OK IMAP4rev1 ready')
+        for raw_line in self.rfile:
+            tag, command, *args = raw_line.decode().split()
+            command = command.upper()
+            if command == 'CAPABILITY':
+                self.reply('* CAPABILITY IMAP4rev1 IDLE')
+            elif command == 'SELECT':
+                self.reply('* ' + str(len(mailbox)) + ' EXISTS')
+            elif command == 'SEARCH':
+                self.reply('* SEARCH ' + ' '.join(
+                    str(number) for number in range(1, len(mailbox) + 1)))
+            elif command == 'FETCH':
+                mail = mailbox[int(args[0]) - 1]
+                self.wfile.write(('* ' + args[0] + ' FETCH (RFC822 {' +
+                                  str(len(mail)) + '}\r\n').encode() +
+                                 mail + b')\r\n')
+            elif command == 'STORE':
+                deleted.add(int(args[0]) - 1)
+            elif command == 'EXPUNGE':
+                mailbox[:] = [mail for number, mail in enumerate(mailbox)
+                              if number not in deleted]
+                deleted.clear()
+            elif command == 'IDLE':
+                self.idle(len(mailbox))
+            elif command == 'LOGOUT':
+                self.reply('* BYE')
+                self.reply(tag + ' OK LOGOUT completed')
+                return
+            self.reply(tag + ' OK ' + command + ' completed')
+
+    def idle(self, exists: int) -> None:
+        self.reply('+ idling')
+        self.wfile.flush()
+        notified = False
+        while not select.select([self.connection], [], [], 0.01)[0]:
+            if not notified and len(self.server.mailbox) > exists:
+                self.reply('* ' + str(len(self.server.mailbox)) + ' EXISTS')
+                notified = True
+        self.rfile.readline()
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    Local stand-in for the IMAP server
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox: list) -> None:
+        super().__init__(('127.0.0.1', 0), FakeIMAPHandler)
+        self.mailbox = mailbox
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def config(self) -> dict:
+        return {
+            'mail_server': '127.0.0.1',
+            'imap_port': self.server_address[1],
+            'mail_backend': 'imap',
+            'mail_from': 'psec@example.com',
+            'mail_pass': 'PASS',
+            'imap_idle_timeout': 10,
+        }
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class MailIntakeTests(unittest.TestCase):
+    """
+    Mail intake tests
+    """
+
+    def test_read_mail_batch(self):
+        """
+        Whole mailbox is picked up in one session
+        """
+        server = FakePOP3Server([make_mail(number) for number in range(20)])
+        self.addCleanup(server.stop)
+        stats = IntakeStats()
+        raw_messages = read_mail(server.config(), stats)
+        self.assertEqual(len(raw_messages), 20)
+        self.assertEqual(raw_messages[0]['email'], 'infsec@example.com')
+        self.assertIn('Ticket 0 ', raw_messages[0]['message'])
+        self.assertEqual(server.sessions, 1)
+        self.assertEqual(server.mailbox, [])
+        self.assertEqual(stats.report()['Intake POP3 messages'], '20')
+        # Mailbox is empty
+        self.assertEqual(read_mail(server.config(), stats), [])
+
+    def test_read_mail_batch_size(self):
+        """
+        Number of messages per session is limited
+        """
+        server = FakePOP3Server([make_mail(number) for number in range(5)])
+        self.addCleanup(server.stop)
+        raw_messages = read_mail(server.config(batch_size=2))
+        self.assertEqual(len(raw_messages), 2)
+        self.assertEqual(server.retrieved, 2)
+        self.assertEqual(len(server.mailbox), 3)
+        self.assertIn('Ticket 2 ', read_mail(server.config())[0]['message'])
+
+    def test_read_mail_handler(self):
+        """
+        A message is deleted only after the handler has saved it,
+        a message the handler fails on stays in the mailbox
+        """
+        server = FakePOP3Server([make_mail(number) for number in range(3)])
+        self.addCleanup(server.stop)
+        saved: list = []
+
+        def handle(raw_message_dict):
+            if 'Ticket 1 ' in raw_message_dict['message']:
+                raise sqlite3.OperationalError('database is locked')
+            saved.append(raw_message_dict)
+
+        with self.assertLogs(level='ERROR'):
+            raw_messages = read_mail(server.config(), handle=handle)
+        self.assertEqual(raw_messages, saved)
+        self.assertEqual(len(saved), 2)
+        self.assertEqual(len(server.mailbox), 1)
+        self.assertIn('Ticket 1 ', read_mail(server.config())[0]['message'])
+
+    def test_read_mail_unreadable(self):
+        """
+        A message that can not be parsed is forwarded
+        to the network admin mailbox and deleted
+        """
+        server = FakePOP3Server([b'Subject: no sender\r\n\r\nTicket\r\n',
+                                 make_mail(1)])
+        self.addCleanup(server.stop)
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = server.config()
+        config.update({'proj_dir': tmp_dir.name + '/',
+                       'mailbox': 'netadmin@example.com'})
+        with self.assertLogs(level='ERROR'):
+            raw_messages = read_mail(config)
+        self.assertEqual(len(raw_messages), 1)
+        self.assertEqual(server.mailbox, [])
+        spool = tmp_dir.name + '/outbox/'
+        spooled = os.listdir(spool)
+        self.assertEqual(len(spooled), 1)
+        with open(spool + spooled[0]) as spool_f:
+            message = json.load(spool_f)
+        self.assertEqual(message['to'], ['netadmin@example.com'])
+        self.assertIn('Unreadable message', message['message'])
+
+    def test_read_mail_plain_part(self):
+        """
+        The text/plain alternative of a multipart message is taken
+        """
+        mail = MIMEMultipart('alternative')
+        mail['From'] = 'Infsec <infsec@example.com>'
+        # Sender clock an hour behind
+        mail['Date'] = formatdate(time.time() - 3600)
+        mail.attach(MIMEText('Ticket 0912.AB34.0009', 'plain', 'utf-8'))
+        mail.attach(MIMEText('<p style="x">Ticket 0912.AB34.0009</p>',
+                             'html', 'utf-8'))
+        server = FakePOP3Server([mail.as_bytes()])
+        self.addCleanup(server.stop)
+        raw_message = read_mail(server.config())[0]
+        self.assertEqual(raw_message['message'], 'Ticket 0912.AB34.0009')
+        self.assertFalse(raw_message['html'])
+        # No Received header - the local receive time
+        self.assertLess(time.time() - raw_message['received'], 60)
+
+    def test_imap_idle(self):
+        """
+        IMAP IDLE wakes up as soon as a message lands
+        """
+        server = FakeIMAPServer([make_mail(0), make_mail(1)])
+        self.addCleanup(server.stop)
+        intake = make_intake(server.config())
+        self.assertIsInstance(intake, ImapIdleIntake)
+        self.addCleanup(intake.close)
+        raw_messages = intake.fetch()
+        self.assertEqual(len(raw_messages), 2)
+        self.assertEqual(server.mailbox, [])
+        self.assertIsNotNone(raw_messages[0]['received'])
+        timer = threading.Timer(0.2, server.mailbox.append, [make_mail(2)])
+        timer.start()
+        start = time.monotonic()
+        intake.wait()
+        self.assertLess(time.monotonic() - start, 5)
+        raw_messages = intake.fetch()
+        self.assertEqual(len(raw_messages), 1)
+        self.assertIn('Ticket 2 ', raw_messages[0]['message'])
+        intake.dispatch(raw_messages[0]['received'])
+        self.assertEqual(intake.report()['Intake IMAP messages'], '3')
+        self.assertEqual(intake.report()['Intake POP3 messages'], '0')
+
+    def test_imap_fallback(self):
+        """
+        POP3 polling is used while the IMAP server is unavailable
+        """
+        server = FakePOP3Server([make_mail(0)])
+        self.addCleanup(server.stop)
+        config = server.config()
+        config.update({'mail_backend': 'imap', 'imap_port': 1})
+        intake = make_intake(config)
+        self.assertEqual(len(intake.fetch()), 1)
+        self.assertEqual(intake.report()['Intake POP3 messages'], '1')
+
+
+class SyslogDBTests(unittest.TestCase):
+    """
+    Log server DB client tests (SQLite stand-in)
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.db = SyslogDB({'db_backend': 'sqlite',
+                            'db_path': self.tmp_dir.name + '/syslog.db',
+                            'db_pool_size': 2})
+        self.addCleanup(self.db.close)
+
+    def insert_event(self, host: str, mac_cisco: str) -> None:
+        self.db.execute('INSERT INTO SystemEvents (DeviceReportedTime, '
+                        'FromHost, Message) VALUES (%s, %s, %s)',
+                        [datetime.datetime.now().replace(microsecond=0),
+                         host,
+                         '%PORT_SECURITY-2-PSECURE_VIOLATION: Security '
+                         'violation occurred, caused by MAC address ' +
+                         mac_cisco + ' on port GigabitEthernet0/1.'])
+
+    def test_events(self):
+        """
+        Parameterized batched query returns typed rows
+        """
+        self.insert_event('10.0.0.1', '4516.ab87.ea90')
+        self.insert_event('10.0.0.2', '0912.ab34.0009')
+        self.insert_event('10.0.0.3', '1111.2222.3333')
+        events = self.db.events(*create_sql_query(['4516ab87ea90',
+                                                   '0912ab340009'], 0, 3))
+        self.assertEqual([event.from_host for event in events],
+                         ['10.0.0.2', '10.0.0.1'])
+        self.assertIsInstance(events[0].reported_time, datetime.datetime)
+        # Quotes in parameters do not break the query
+        self.assertEqual(self.db.execute('SELECT COUNT(*) FROM SystemEvents '
+                                         'WHERE FromHost = %s',
+                                         ["' OR 1=1 --"]), [(0,)])
+
+    def test_pool(self):
+        """
+        Connections are reused and limited by the pool size
+        """
+        with self.db.connection() as first:
+            with self.db.connection() as second:
+                self.assertIsNot(first, second)
+        with self.db.connection() as third:
+            self.assertIn(third, (first, second))
+        self.assertEqual(self.db.opened, 2)
+
+    def test_cursor(self):
+        """
+        Each poll scans only new rows, new MACs are searched once
+        in today's rows before the cursor
+        """
+        config = {'db_backend': 'sqlite',
+                  'db_path': self.tmp_dir.name + '/syslog.db',
+                  'proj_dir': self.tmp_dir.name + '/'}
+        self.insert_event('10.0.0.1', '4516.ab87.ea90')
+        log_db = LogServerDB(config)
+        self.addCleanup(log_db.db.close)
+        self.assertEqual(list(log_db.lookup(['4516ab87ea90'])),
+                         ['4516ab87ea90'])
+        self.assertEqual(log_db.last_id, 1)
+        # Known MAC, old rows are not scanned again
+        self.assertEqual(log_db.lookup(['4516ab87ea90']), {})
+        self.insert_event('10.0.0.2', '0912.ab34.0009')
+        found = log_db.lookup(['4516ab87ea90', '0912ab340009'])
+        self.assertEqual(list(found), ['0912ab340009'])
+        # The cursor survives a restart
+        self.assertEqual(LogServerDB(config).last_id, 2)
+
+
+class WorkerPoolTests(unittest.TestCase):
+    """
+    Worker pool tests
+    """
+
+    def test_pool(self):
+        """
+        Tickets are served by a bounded set of recycled workers
+        """
+        pool = WorkerPool(pool_task, {'pool_workers': 2,
+                                      'pool_queue_size': 3,
+                                      'pool_max_tasks': 2})
+        pool.start()
+        for number in range(8):
+            pool.submit(number)
+        results = [pool_results.get(timeout=10) for number in range(8)]
+        self.assertEqual(sorted(number for number, pid in results),
+                         list(range(8)))
+        # Every process serves at most 2 tickets
+        pids = [pid for number, pid in results]
+        self.assertTrue(all(pids.count(pid) <= 2 for pid in pids))
+        pool.close()
+        report = pool.report()
+        self.assertEqual(report['Pool tickets taken'], '8')
+        self.assertEqual(report['Pool active workers'], '0')
+
+    def test_pool_submit_full_queue(self):
+        """
+        Submitting does not block while the queue is full
+        """
+        pool = WorkerPool(pool_task, {'pool_workers': 1,
+                                      'pool_queue_size': 1})
+        start = time.monotonic()
+        for number in range(5):
+            pool.submit(number)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(pool.report()['Pool queue depth'], '5')
+        # A new ticket is rejected, the backlog is bounded
+        self.assertTrue(pool.full())
+        pool.start()
+        results = [pool_results.get(timeout=10) for number in range(5)]
+        self.assertEqual([number for number, pid in results], list(range(5)))
+        pool.close()
+
+    def test_pool_switch_affinity(self):
+        """
+        Tickets for the same switch go to the worker holding its session
+        (one login per switch on two workers)
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        # Inherited by the workers
+        ssh_pool._pool['instance'] = SessionPool(
+            {'proj_dir': tmp_dir.name + '/'}, lambda params: FakeSSH())
+        self.addCleanup(ssh_pool._pool.clear)
+        pool = WorkerPool(pool_switch_task, {'pool_workers': 2,
+                                             'pool_affinity_wait': 10})
+        pool.start()
+        self.addCleanup(pool.close)
+        hosts = ['10.0.0.1', '10.0.0.2'] * 3
+        for number, host in enumerate(hosts):
+            pool.submit(number, host, host=host)
+        results = [pool_results.get(timeout=10) for host in hosts]
+        pids: dict = {}
+        for number, pid, logins in results:
+            pids.setdefault(hosts[number], set()).add(pid)
+            self.assertEqual(logins, 1)
+        self.assertEqual([len(pids[host]) for host in sorted(pids)], [1, 1])
+        self.assertNotEqual(pids['10.0.0.1'], pids['10.0.0.2'])
+
+    def test_pool_cancel(self):
+        """
+        A running ticket is cancelled in its worker, a worker that does
+        not stop in time is killed and replaced
+        """
+        pool = WorkerPool(pool_cancel_task, {'pool_workers': 1,
+                                             'pool_reap_interval': 0.1})
+        pool.start()
+        self.addCleanup(pool.close)
+        pool.submit(7)
+        self.assertEqual(pool_results.get(timeout=10), ('started', 7))
+        self.assertFalse(pool.cancel(8, 5))
+        self.assertTrue(pool.cancel(7, 5))
+        self.assertEqual(pool_results.get(timeout=10), ('cancelled', 7))
+        pool.submit(9)
+        self.assertEqual(pool_results.get(timeout=10), ('started', 9))
+        pid = pool.workers[0].pid
+        events = pool.events[0]
+        self.assertTrue(pool.cancel(9, 0.2))
+        deadline = time.monotonic() + 10
+        while pool.workers[0].pid == pid and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self.assertNotEqual(pool.workers[0].pid, pid)
+        self.assertIsNone(pool.slot_of(9))
+        # The killed worker may have held a queue lock, the queues
+        # of its slot are new and the new worker takes tickets
+        self.assertIsNot(pool.events[0], events)
+        pool.submit(10)
+        self.assertEqual(pool_results.get(timeout=10), ('started', 10))
+        self.assertTrue(pool.cancel(10, 5))
+        self.assertEqual(pool_results.get(timeout=10), ('cancelled', 10))
+
+    def test_pool_events(self):
+        """
+        Workers send events to the main process and get replies
+        """
+        pool = WorkerPool(pool_watch_task, {'pool_workers': 2})
+        pool.serve_events({'watch': lambda slot, key, number:
+                           pool.reply(slot, key, number * 10)})
+        pool.start()
+        for number in range(4):
+            pool.submit(number)
+        results = [pool_results.get(timeout=10) for number in range(4)]
+        self.assertEqual(sorted(results), [0, 10, 20, 30])
+        pool.close()
+
+    def test_pool_reply_timeout(self):
+        """
+        A worker does not wait for a lost reply forever
+        """
+        pool = WorkerPool(pool_noreply_task, {'pool_workers': 1})
+        pool.start()
+        self.addCleanup(pool.close)
+        pool.submit(1)
+        self.assertEqual(pool_results.get(timeout=10), 'timeout')
+
+
+class LogWatcherTests(unittest.TestCase):
+    """
+    Log watcher tests
+    """
+
+    def test_batched_poll(self):
+        """
+        One query covers all pending MACs, answers are passed to waiters
+        """
+        queries: list = []
+
+        def lookup(macs):
+            queries.append(macs)
+            return {'4516ab87ea90': {'vendor': 'cisco', 'answer': 'line'}}
+
+        watcher = LogWatcher(lookup, {'work_end_hour': 24})
+        answers: list = []
+        watcher.register('4516ab87ea90', 'task_1', answers.append)
+        watcher.register('4516ab87ea90', 'task_2', answers.append)
+        watcher.register('0912ab340009', 'task_3', answers.append)
+        watcher.poll()
+        self.assertEqual(queries, [['0912ab340009', '4516ab87ea90']])
+        self.assertEqual(len(answers), 2)
+        self.assertEqual(list(watcher.pending), ['0912ab340009'])
+        self.assertEqual(watcher.report()['Log watcher notified tasks'], '2')
+
+    def test_lookup_error(self):
+        """
+        Log server connection error fails the waiting tasks
+        only after 'log_error_timeout'
+        """
+        def lookup(macs):
+            raise OSError('timeout')
+
+        watcher = LogWatcher(lookup, {'work_end_hour': 24,
+                                      'log_error_timeout': 0.2,
+                                      'log_retry_delay': 0.1})
+        answers: list = []
+        watcher.register('4516ab87ea90', 'task_1', answers.append)
+        watcher.poll()
+        self.assertEqual(answers, [])
+        time.sleep(0.25)
+        watcher.poll()
+        self.assertIn('Task failed', answers[0]['answer'])
+        self.assertEqual(watcher.pending, {})
+
+    def test_lookup_retry(self):
+        """
+        A failed query is retried with a growing delay,
+        the MACs stay pending until a query succeeds
+        """
+        results = [OSError('timeout'), OSError('timeout'),
+                   {'4516ab87ea90': {'vendor': 'cisco', 'answer': 'line'}}]
+        queries: list = []
+
+        def lookup(macs):
+            queries.append(macs)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        watcher = LogWatcher(lookup, {'work_end_hour': 24,
+                                      'log_retry_delay': 0.1})
+        answers: list = []
+        watcher.register('4516ab87ea90', 'task_1', answers.append)
+        watcher.poll()
+        # Not retried before the delay
+        watcher.poll()
+        self.assertEqual(len(queries), 1)
+        time.sleep(0.15)
+        watcher.poll()
+        self.assertEqual(len(queries), 2)
+        self.assertAlmostEqual(watcher.retry_at - time.monotonic(), 0.2,
+                               delta=0.05)
+        time.sleep(0.25)
+        watcher.poll()
+        self.assertEqual(answers, [{'vendor': 'cisco', 'answer': 'line'}])
+        self.assertEqual(watcher.pending, {})
+        self.assertEqual(watcher.failures, 0)
+
+
+class SyslogReceiverTests(unittest.TestCase):
+    """
+    Syslog receiver tests
+    """
+
+    violation = ('<186>42: *Oct 18 10:00:00: '
+                 '%PORT_SECURITY-2-PSECURE_VIOLATION: Security violation '
+                 'occurred, caused by MAC address 4516.AB87.EA90 on port '
+                 'GigabitEthernet1/0/7.')
+
+    def test_mac_index(self):
+        """
+        Index is bounded and entries expire
+        """
+        index = MacIndex(2, 60)
+        for number in range(3):
+            index.add(str(number), MacEntry('10.0.0.1', 'Gi0/1', '',
+                                            time.time()))
+        self.assertIsNone(index.get('0'))
+        self.assertIsNotNone(index.get('2'))
+        index.add('3', MacEntry('10.0.0.1', 'Gi0/1', '', time.time() - 61))
+        self.assertIsNone(index.get('3'))
+
+    def test_receiver(self):
+        """
+        Waiting task wakes up on a violation message (UDP and TCP)
+        """
+        watcher = LogWatcher(lambda macs: {}, {})
+        receiver = SyslogReceiver({'syslog_address': '127.0.0.1',
+                                   'syslog_port': 0}, watcher.notify)
+        receiver.start()
+        self.addCleanup(receiver.close)
+        answers: list = []
+        answered = threading.Event()
+        watcher.register('4516ab87ea90', 'task_1',
+                         lambda answer: (answers.append(answer),
+                                         answered.set()))
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(self.violation.encode(),
+                        receiver.servers[0].server_address)
+        self.assertTrue(answered.wait(5))
+        self.assertTrue(answers[0]['answer'].startswith('127.0.0.1 '))
+        self.assertIn('GigabitEthernet1/0/7', answers[0]['answer'])
+        # Device connected before the ticket arrived
+        watcher.register('4516ab87ea90', 'task_2', answers.append)
+        receiver.replay('4516ab87ea90')
+        self.assertEqual(len(answers), 2)
+        self.assertEqual(receiver.report()['Syslog task hits'], '2')
+
+    def test_receiver_tcp(self):
+        """
+        Newline-delimited TCP syslog
+        """
+        receiver = SyslogReceiver({'syslog_address': '127.0.0.1',
+                                   'syslog_port': 0}, lambda mac, answer: 0)
+        receiver.start()
+        self.addCleanup(receiver.close)
+        with socket.create_connection(
+                receiver.servers[1].server_address) as sock:
+            sock.sendall(b'noise\n' + self.violation.encode() + b'\n')
+        deadline = time.monotonic() + 5
+        while receiver.index.get('4516ab87ea90') is None and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(receiver.index.get('4516ab87ea90').port_num,
+                         'GigabitEthernet1/0/7')
+        self.assertEqual(receiver.received, 2)
+
+
+class FakeSSH:
+    """
+    Switch session for the session pool tests
+    """
+
+    def __init__(self) -> None:
+        self.up = True
+        self.closed = False
+
+    def is_alive(self) -> bool:
+        return self.up
+
+    def disconnect(self) -> None:
+        self.closed = True
+
+
+class SessionPoolTests(unittest.TestCase):
+    """
+    Switch SSH session pool
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.opened: list = []
+        self.pool = SessionPool({'proj_dir': self.tmp_dir.name + '/',
+                                 'ssh_idle_timeout': 300}, self.connect)
+
+    def connect(self, params):
+        ssh = FakeSSH()
+        self.opened.append(ssh)
+        return ssh
+
+    def test_reuse(self):
+        """
+        The following task gets the same session
+        """
+        with self.pool.session('10.0.0.1', {}) as first:
+            pass
+        with self.pool.session('10.0.0.1', {}) as second:
+            pass
+        self.assertIs(first, second)
+        with self.pool.session('10.0.0.2', {}):
+            pass
+        report = self.pool.report()
+        self.assertEqual(report['SSH logins'], '2')
+        self.assertEqual(report['SSH reused sessions'], '1')
+        self.assertEqual(report['SSH open sessions'], '2')
+
+    def test_broken_session(self):
+        """
+        Dead and failed sessions are not reused
+        """
+        with self.assertRaises(SystemExit):
+            with self.pool.session('10.0.0.1', {}):
+                sys.exit()
+        self.opened[0].up = False
+        with self.pool.session('10.0.0.1', {}):
+            pass
+        self.assertTrue(self.opened[0].closed)
+        with self.assertRaises(ValueError):
+            with self.pool.session('10.0.0.1', {}):
+                raise ValueError('broken')
+        self.assertTrue(self.opened[1].closed)
+        self.assertEqual(len(self.opened), 2)
+        self.assertEqual(self.pool.report()['SSH open sessions'], '0')
+
+    def test_idle_eviction(self):
+        """
+        Idle sessions are closed
+        """
+        with self.pool.session('10.0.0.1', {}):
+            pass
+        self.pool.idle_timeout = 0
+        time.sleep(0.01)
+        self.pool.evict_idle()
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(self.pool.sessions, {})
+
+    def test_host_lock(self):
+        """
+        Configuration changes on one switch are serialized
+        """
+        order: list = []
+
+        def change(name):
+            with self.pool.host_lock('10.0.0.1'):
+                order.append(name + ' start')
+                time.sleep(0.05)
+                order.append(name + ' end')
+        threads = [threading.Thread(target=change, args=(str(number),))
+                   for number in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order[0].split()[0], order[1].split()[0])
+        self.assertEqual(order[2].split()[0], order[3].split()[0])
+
+
+class StubPool:
+    """
+    Worker pool keeping the submitted task IDs
+    """
+
+    def __init__(self) -> None:
+        self.submitted: list = []
+
+    def submit(self, task_id: int, host: str = '') -> None:
+        self.submitted.append(task_id)
+
+
+class TaskStoreTests(unittest.TestCase):
+    """
+    Durable task states
+    """
+
+    def test_stages(self):
+        """
+        Stages survive a new store instance, finished tasks are not changed
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = {'proj_dir': tmp_dir.name + '/'}
+        store = TaskStore(config)
+        first = store.create('ticket 4516ab87ea90')
+        second = store.create('ticket 4516ab87ea91')
+        self.assertEqual(store.get(first).stage, 'parse')
+        store.advance(first, 'locate', tracker='task_1', mac='4516ab87ea90')
+        task = store.advance(first, 'check',
+                             answer={'vendor': 'cisco', 'answer': 'x'})
+        self.assertEqual(task.answer['vendor'], 'cisco')
+        self.assertEqual(task.tracker, 'task_1')
+        store.advance(second, 'done')
+        # Restart
+        store = TaskStore(config)
+        self.assertEqual([task.id for task in store.unfinished()], [first])
+        self.assertEqual(store.kill(first).stage, 'check')
+        self.assertIsNone(store.kill(first))
+        self.assertEqual(store.advance(first, 'configure').stage, 'killed')
+        self.assertEqual(store.unfinished(), [])
+        report = store.report()
+        self.assertEqual(report['Tasks killed'], '1')
+        self.assertEqual(report['Tasks done'], '1')
+
+    def test_registry(self):
+        """
+        Active tasks by tracker, MAC and switch, kept in step with the store
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        store = TaskStore({'proj_dir': tmp_dir.name + '/'})
+        registry = TaskRegistry()
+        store.listener = registry.update
+        first = store.create('ticket 1')
+        second = store.create('ticket 2')
+        store.advance(first, 'locate', tracker='task_1', mac='4516ab87ea90')
+        store.advance(second, 'configure', tracker='task_2',
+                      mac='4516ab87ea90', params={'ip_addr': '10.0.0.1'})
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.tracker('task_1').stage, 'locate')
+        self.assertEqual([task.id for task in
+                          registry.find('4516.AB87.EA90')], [first, second])
+        self.assertEqual([task.id for task in registry.find('10.0.0.1')],
+                         [second])
+        store.advance(second, 'done')
+        self.assertEqual(registry.find('10.0.0.1'), [])
+        # Duplicate ticket for a MAC in progress
+        self.assertEqual(store.merge(first).duplicates, 1)
+        self.assertIsNone(store.merge(second))
+        self.assertEqual(store.report()['Duplicate requests merged'], '1')
+        # State posted by the worker before the kill, handled after it
+        late = store.get(first)
+        store.kill(first)
+        self.assertIsNone(registry.tracker('task_1'))
+        registry.update(late)
+        self.assertIsNone(registry.tracker('task_1'))
+        self.assertEqual(registry.active(), [])
+        # Bulk task: indexed by each MAC and switch
+        bulk = store.create('ticket 3', '4516ab87ea90 4516ab87ea91')
+        store.advance(bulk, 'configure', tracker='task_3', params={
+            'ports': {'4516ab87ea90': {'ip_addr': '10.0.0.1'},
+                      '4516ab87ea91': {'ip_addr': '10.0.0.2'}},
+            'results': {}})
+        self.assertEqual([task.id for task in
+                          registry.find('4516ab87ea91')], [bulk])
+        self.assertEqual([task.id for task in registry.find('10.0.0.2')],
+                         [bulk])
+        # Older state handled after a newer one
+        registry.update(registry.tracker('task_3')._replace(
+            stage='check', updated=0.0))
+        self.assertEqual(registry.tracker('task_3').stage, 'configure')
+        store.advance(bulk, 'done')
+        self.assertEqual(registry.find('4516ab87ea90'), [])
+
+    def test_submit_ticket(self):
+        """
+        A ticket for a MAC in progress is merged into its task,
+        a ticket after the task has finished starts a new one
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = {'proj_dir': tmp_dir.name + '/',
+                  'mail_server': '127.0.0.1',
+                  'mail_from': 'psec@example.com',
+                  'mailbox': 'noc@example.com'}
+        psec.config = config
+        psec.pool = StubPool()
+        submitted = psec.pool.submitted
+        psec.store = TaskStore(config)
+        psec.registry = TaskRegistry()
+        psec.store.listener = psec.registry.update
+        outbox = Outbox(config)
+        psec.submit_ticket('Printer 4516.ab87.ea90')
+        self.assertEqual(len(submitted), 1)
+        first = submitted[0]
+        psec.store.advance(first, 'locate', tracker='task_1')
+        # Same MAC in another notation - merged, the requester is told
+        psec.submit_ticket('Printer 45-16-AB-87-EA-90 '
+                           'inv. 123456789012')
+        self.assertEqual(submitted, [first])
+        self.assertEqual(psec.store.get(first).duplicates, 1)
+        self.assertEqual(len(outbox.pending()), 1)
+        with open(outbox.spool + outbox.pending()[0]) as spool_f:
+            self.assertIn('4516ab87ea90 request merged',
+                          json.load(spool_f)['message'])
+        # Bulk ticket: the MAC in progress is merged, the other one
+        # gets a task of its own
+        psec.submit_ticket('4516ab87ea90 4516ab87ea91')
+        self.assertEqual(len(submitted), 2)
+        self.assertEqual(psec.store.get(submitted[1]).mac, '4516ab87ea91')
+        self.assertEqual(psec.store.get(first).duplicates, 2)
+        # The first task has finished, a new ticket is a new task
+        psec.store.advance(first, 'done')
+        psec.submit_ticket('Printer 4516.ab87.ea90')
+        self.assertEqual(len(submitted), 3)
+        self.assertEqual(psec.store.get(submitted[2]).mac, '4516ab87ea90')
+        self.assertEqual(len(outbox.pending()), 2)
+
+
+class LogArchiverTests(unittest.TestCase):
+    """
+    Background log archiver
+    """
+
+    def test_archive(self):
+        """
+        Logs are packed at the threshold and removed after the write
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        archive_dir = tmp_dir.name + '/log_archive/'
+        os.mkdir(archive_dir)
+        archiver = LogArchiver({'log_dir': tmp_dir.name + '/',
+                                'archive_batch': 3})
+        for number in range(2):
+            archive_task_log('task_' + str(number), 'log ' + str(number),
+                             {'log_dir': tmp_dir.name + '/'})
+            archiver.notify()
+        # A log being written is not packed
+        with open(archive_dir + 'task_2.tmp', 'w') as log_f:
+            log_f.write('log 2')
+        self.assertFalse(archiver.wake.is_set())
+        archiver.flush()
+        self.assertEqual(len(archiver.finished_logs()), 2)
+        archiver.notify()
+        self.assertTrue(archiver.wake.is_set())
+        archiver.flush(force=True)
+        self.assertEqual(archiver.finished_logs(), [])
+        archives = [name for name in os.listdir(archive_dir)
+                    if name.endswith('.tar.gz')]
+        self.assertEqual(len(archives), 1)
+        self.assertTrue(archives[0].endswith('_001.tar.gz'))
+        with tarfile.open(archive_dir + archives[0]) as tar:
+            self.assertEqual(tar.getnames(), ['task_0.txt', 'task_1.txt'])
+        self.assertTrue(archiver.next_path().endswith('_002.tar.gz'))
+        self.assertEqual(archiver.report()['Archived task logs'], '2')
+
+
+class TaskLogTests(unittest.TestCase):
+    """
+    Structured task logging
+    """
+
+    def test_records(self):
+        """
+        Records carry the task fields, the task log is rendered from them
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        writer = TaskLogWriter({'log_dir': tmp_dir.name + '/'})
+        writer.open()
+        context = TaskContext()
+        context.set(tracker='task_1', mac='4516ab87ea90', stage='parse')
+        logger = logging.getLogger('psec_test')
+        records: list = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record_dict(record))
+        handler.addFilter(context)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning('!!!OK!!! Access port')
+        context.set(stage='configure', switch='10.0.0.1')
+        logger.warning('Task completed', extra={'outcome': 'Task completed'})
+        self.assertEqual(records[0]['stage'], 'parse')
+        self.assertEqual(records[1]['switch'], '10.0.0.1')
+        for data in records:
+            writer.write(data)
+        writer.write({'time': time.time(), 'tracker': 'task_2',
+                      'message': 'waiting'})
+        writer.close()
+        with open(writer.path) as log_f:
+            lines = [json.loads(line) for line in log_f]
+        self.assertEqual([data['tracker'] for data in lines],
+                         ['task_1', 'task_1', 'task_2'])
+        # Restart: only the open task is loaded
+        writer = TaskLogWriter({'log_dir': tmp_dir.name + '/'})
+        writer.open()
+        self.addCleanup(writer.close)
+        self.assertEqual(list(writer.records), ['task_2'])
+        self.assertEqual(writer.render('task_1'), '')
+        self.assertTrue(writer.render('task_2').endswith(' waiting\n'))
+        # Next day: the open task is kept over the rotation and a restart
+        writer.day = '2000-01-01'
+        writer.write({'time': time.time(), 'tracker': 'task_3',
+                      'message': 'failed'})
+        writer.close()
+        self.assertTrue(os.path.exists(tmp_dir.name +
+                                       '/log_archive/tasks_2000-01-01.jsonl'))
+        writer = TaskLogWriter({'log_dir': tmp_dir.name + '/'})
+        writer.open()
+        self.addCleanup(writer.close)
+        self.assertEqual(sorted(writer.records), ['task_2', 'task_3'])
+        self.assertTrue(writer.render('task_2').endswith(' waiting\n'))
+        # Failed or killed task without an outcome
+        writer.release('task_3')
+        self.assertEqual(list(writer.records), ['task_2'])
+
+
+class MetricsTests(unittest.TestCase):
+    """
+    Prometheus metrics endpoint
+    """
+
+    def test_metrics_endpoint(self):
+        """
+        Histograms, counters and gauges are served in the text format
+        """
+        registry = metrics.MetricsRegistry()
+        metrics.install_metrics(registry)
+        self.addCleanup(metrics._main.clear)
+        with metrics.timed('psec_stage_duration_seconds', stage='check'):
+            pass
+        metrics.observe('psec_sticky_wait_seconds', 3)
+        metrics.count('psec_tasks_total', result='completed')
+        metrics.count('psec_tasks_total', result='completed')
+        registry.record('gauge', 'psec_ssh_open_sessions',
+                        {'worker': '1'}, 2)
+        registry.gauge('psec_tasks_active', lambda: 5)
+        server = metrics.MetricsServer({'metrics_port': 0}, registry)
+        server.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:' + str(server.server_address[1])
+        with urllib.request.urlopen(url + '/metrics') as answer:
+            text = answer.read().decode()
+        self.assertIn('# TYPE psec_stage_duration_seconds histogram', text)
+        self.assertIn('psec_stage_duration_seconds_bucket'
+                      '{stage="check",le="0.05"} 1', text)
+        self.assertIn('psec_sticky_wait_seconds_bucket{le="2.5"} 0', text)
+        self.assertIn('psec_sticky_wait_seconds_bucket{le="5"} 1', text)
+        self.assertIn('psec_sticky_wait_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('psec_sticky_wait_seconds_sum 3', text)
+        self.assertIn('psec_tasks_total{result="completed"} 2', text)
+        self.assertIn('psec_ssh_open_sessions{worker="1"} 2', text)
+        self.assertIn('psec_tasks_active 5', text)
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + '/')
+
+
+class FakeSwitch:
+    """
+    Switch session answering show commands
+    """
+
+    def __init__(self, outputs: dict) -> None:
+        self.outputs = outputs
+        self.commands: list = []
+
+    def send_command(self, command: str, delay_factor: int = 1) -> str:
+        self.commands.append(command)
+        for prefix, output in self.outputs.items():
+            if command.startswith(prefix):
+                return output
+        return ''
+
+
+class CiscoStateTests(unittest.TestCase):
+    """
+    Lazy device state of BaseCiscoSSH
+    """
+
+    sh_run = 'interface GigabitEthernet1/0/3\n' \
+        ' switchport mode access\n' \
+        ' switchport port-security maximum 3\n' \
+        ' switchport port-security mac-address sticky\n' \
+        ' switchport port-security mac-address sticky 4516.ab87.ea90\n' \
+        '!\n' \
+        'interface GigabitEthernet1/0/7\n' \
+        ' switchport mode access\n' \
+        '!\n' \
+        'interface Vlan10\n' \
+        ' ip address 10.0.0.1 255.255.255.0\n'
+
+    def test_lazy_state(self):
+        """
+        Each check sends only the commands it reads, once per task
+        """
+        switch = FakeSwitch({
+            'sh run interface Gi1/0/3': self.sh_run,
+            'sh run interface': 'interface GigabitEthernet1/0/7\n'
+                                ' switchport mode access\n',
+            'sh interface': 'GigabitEthernet1/0/7 is up, '
+                            'line protocol is up (connected)',
+            'sh port-security address':
+                '   1    4516.ab87.ea90    SecureSticky   Gi1/0/3    -',
+        })
+        cisco_conn = BaseCiscoSSH({'ip_addr': '10.0.0.1',
+                                   'port_num': 'GigabitEthernet1/0/7',
+                                   'mac_addr': '4516.ab87.ea90'},
+                                  'task_1', {}, switch)
+        self.assertEqual(switch.commands, [])
+        cisco_conn.check_completed_task()
+        cisco_conn.check_access()
+        cisco_conn.check_max_devices()
+        self.assertEqual(switch.commands,
+                         ['sh run interface GigabitEthernet1/0/7'])
+        cisco_conn.check_port_stat()
+        # Only the ports holding the MAC are read, not the whole config
+        self.assertEqual(cisco_conn.sticky_ports, ['Gi1/0/3'])
+        self.assertTrue(cisco_conn.interface_config('Gi1/0/3').hub)
+        self.assertEqual(switch.commands[2:],
+                         ['sh port-security address | include '
+                          '4516.ab87.ea90',
+                          'sh run interface Gi1/0/3'])
+        self.assertIn('switchport mode access', cisco_conn.log)
+        self.assertEqual(len(switch.commands), 4)
+
+    def test_wait_sticky(self):
+        """
+        Sticky learn is confirmed as soon as the MAC is in the table
+        """
+        switch = FakeSwitch({
+            'sh port-security address':
+                '   1    4516.ab87.ea90    SecureSticky   Gi1/0/7    -',
+        })
+        cisco_conn = BaseCiscoSSH({'ip_addr': '10.0.0.1',
+                                   'port_num': 'GigabitEthernet1/0/7',
+                                   'mac_addr': '4516.ab87.ea90'},
+                                  'task_1', {}, switch)
+        start = time.monotonic()
+        self.assertTrue(cisco_conn.wait_sticky(30))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(len(switch.commands), 1)
+        # Learned on another port only
+        cisco_conn.port = 'GigabitEthernet1/0/17'
+        self.assertFalse(cisco_conn.wait_sticky(0.2))
+        self.assertEqual(len(switch.commands), 3)
+
+    def test_running_config(self):
+        """
+        Interface index of the running config
+        """
+        index = RunningConfig(self.sh_run)
+        self.assertEqual(sorted(index.interfaces),
+                         ['GigabitEthernet1/0/3', 'GigabitEthernet1/0/7',
+                          'Vlan10'])
+        port = index.interfaces['GigabitEthernet1/0/3']
+        self.assertTrue(port.access)
+        self.assertEqual(port.maximum, 3)
+        self.assertEqual(index.mac_ports('4516.ab87.ea90'),
+                         ['GigabitEthernet1/0/3'])
+        self.assertFalse(index.interfaces['Vlan10'].access)
+        self.assertEqual(index.mac_ports('0000.0000.0001'), [])
+        self.assertTrue(port.hub)
+        self.assertFalse(index.interfaces['GigabitEthernet1/0/7'].hub)
+
+    def test_maximum_one(self):
+        """
+        An explicit 'maximum 1' is one device per port, not a hub
+        """
+        switch = FakeSwitch({
+            'sh run interface': 'interface GigabitEthernet1/0/7\n'
+                                ' switchport mode access\n'
+                                ' switchport port-security maximum 1\n',
+        })
+        cisco_conn = BaseCiscoSSH({'ip_addr': '10.0.0.1',
+                                   'port_num': 'GigabitEthernet1/0/7',
+                                   'mac_addr': '4516.ab87.ea91'},
+                                  'task_1', {}, switch)
+        # A failed check would end the task
+        cisco_conn.check_max_devices()
+        self.assertFalse(cisco_conn.port_config.hub)
+
+
+class TimedSwitch:
+    """
+    Switch session with netmiko read loops
+    (the next show command can hang until the fixed deadline)
+    """
+
+    def __init__(self) -> None:
+        self.calls: list = []
+        self.hang = False
+
+    def send_command(self, command, delay_factor=1, max_loops=500):
+        self.calls.append((command, delay_factor, max_loops))
+        if command.startswith('sh version'):
+            return 'Model number                    : WS-C2960X-48FPD-L'
+        if self.hang and max_loops < 500:
+            self.hang = False
+            raise OSError('Search pattern never detected')
+        return 'output'
+
+
+class CommandTimingTests(unittest.TestCase):
+    """
+    Adaptive command timing
+    """
+
+    def test_adaptive_timeout(self):
+        """
+        Deadlines follow the measurements, fixed factors are the fallback
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = {'proj_dir': tmp_dir.name + '/', 'timing_min_samples': 3}
+        store = TimingStore(config)
+        switch = TimedSwitch()
+        timer = CommandTimer(store, switch, '10.0.0.1')
+        # No measurements: deadline of the fixed factor, short interval
+        timer.send('sh run interface', 'sh run interface Gi1/0/1', 5)
+        self.assertEqual(timer.model, 'WS-C2960X-48FPD-L')
+        self.assertEqual(switch.calls[-1][1:], (1, 2500))
+        for number in range(3):
+            timer.send('sh run interface', 'sh run interface Gi1/0/1', 5)
+        self.assertEqual(store.timeout('WS-C2960X-48FPD-L',
+                                       'sh run interface', 500), 5)
+        self.assertEqual(switch.calls[-1][1:], (1, 25))
+        # Configuration commands keep the fixed deadline
+        timer.send('wr mem', 'wr mem', 20)
+        self.assertEqual(switch.calls[-1][1:], (1, 10000))
+        # No answer in time: sent again with the fixed factor
+        switch.hang = True
+        self.assertEqual(timer.send('sh run interface',
+                                    'sh run interface Gi1/0/1', 5),
+                         'output')
+        self.assertEqual(switch.calls[-1][1:], (5, 500))
+        self.assertEqual(timer.commands, 6)
+        self.assertGreater(timer.saved, 0)
+        self.assertIn('6 commands', timer.summary())
+        # The model is asked once per switch
+        timer = CommandTimer(TimingStore(config), switch, '10.0.0.1')
+        timer.send('sh run interface', 'sh run interface Gi1/0/1', 5)
+        self.assertEqual(sum(call[0].startswith('sh version')
+                             for call in switch.calls), 1)
+
+
+class BulkSwitch:
+    """
+    Switch session for a bulk task: an access port learns
+    the device MAC after 'clear port-security sticky'
+    """
+
+    def __init__(self, ports: dict, hub_ports: tuple = ()) -> None:
+        self.ports = ports
+        self.hub_ports = hub_ports
+        self.learned: dict = {}
+        self.commands: list = []
+
+    def is_alive(self):
+        return True
+
+    def disconnect(self):
+        pass
+
+    def send_command(self, command, delay_factor=1, max_loops=500):
+        self.commands.append(command)
+        words = command.split()
+        if words[:3] == ['sh', 'run', 'interface']:
+            text = 'interface ' + words[3] + '\n switchport mode access\n'
+            if words[3] in self.hub_ports:
+                text += ' switchport port-security maximum 3\n'
+            if words[3] in self.learned:
+                text += ' switchport port-security mac-address sticky ' + \
+                    self.learned[words[3]] + '\n'
+            return text
+        if words[:2] == ['sh', 'interface']:
+            return words[2] + ' is up, line protocol is up (connected)'
+        if words[:2] == ['sh', 'port-security']:
+            return '\n'.join('10 ' + mac + ' SecureSticky Gi' +
+                             port[len('GigabitEthernet'):]
+                             for port, mac in self.learned.items())
+        if words[:2] == ['clear', 'port-security']:
+            self.learned[words[4]] = self.ports[words[4]]
+        if command == 'wr mem':
+            return 'Building configuration...\n[OK]'
+        return ''
+
+
+class BulkTaskTests(unittest.TestCase):
+    """
+    Bulk tickets with several MACs
+    """
+
+    def test_bulk_parse(self):
+        """
+        Every MAC gets task params or a failure reason
+        """
+        answers = {
+            '4516ab87ea90': {'vendor': 'cisco', 'answer': '10.0.0.1 '
+                             '%PORT_SECURITY-2-PSECURE_VIOLATION: caused by '
+                             'MAC address 4516.ab87.ea90 on port '
+                             'GigabitEthernet1/0/3.'},
+            '4516ab87ea91': {'vendor': 'cisco', 'answer': '10.0.0.9 '
+                             '%PORT_SECURITY-2-PSECURE_VIOLATION: caused by '
+                             'MAC address 4516.ab87.ea91 on port '
+                             'GigabitEthernet1/0/4.'},
+            '4516ab87ea92': {'vendor': 'None', 'answer': 'LOG SERVER '
+                             'CONNECTION ERROR\r\n\r\nTask failed'},
+            '4516ab87ea93': {'vendor': 'None', 'answer': '!!!NOT OK!!! '
+                             'Events with this device were not found'
+                             '\r\n\r\nTask failed'},
+            '4516ab87ea94': {'vendor': 'cisco', 'answer': 'no port'},
         }
-        self.assertEqual(create_sql_query(mac, config), f'''mysql -u USER '''
-                         f'''-pPASS -D Syslog -e "SELECT FromHost, Message '''
-                         f'''FROM SystemEvents WHERE DeviceReportedTime '''
-                         f'''LIKE '%{date}%' AND Message '''
-                         f'''REGEXP '.*(4516.ab87.ea90).*' ORDER BY '''
-                         f'''ID DESC LIMIT 1;"''')
+        ports, failed = bulk_parse(answers, {'bad_ips': ['10.0.0.9']})
+        self.assertEqual(ports, {'4516ab87ea90': {
+            'vendor': 'cisco',
+            'ip_addr': '10.0.0.1',
+            'mac_addr': '4516.ab87.ea90',
+            'port_num': 'GigabitEthernet1/0/3'}})
+        self.assertEqual(failed, {'4516ab87ea91': 'excluded_switch',
+                                  '4516ab87ea92': 'log_server_error',
+                                  '4516ab87ea93': 'not_located',
+                                  '4516ab87ea94': 'log_parse'})
+
+    def test_bulk_connection(self):
+        """
+        The ports of a switch are set up in one session, one 'wr mem'
+        """
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        config = {'proj_dir': tmp_dir.name + '/', 'sticky_first_timeout': 1}
+        with open(config['proj_dir'] + 'cisco_params.json', 'w') as params_f:
+            json.dump({'device_type': 'cisco_ios'}, params_f)
+        switch = BulkSwitch({'GigabitEthernet1/0/3': '4516.ab87.ea90',
+                             'GigabitEthernet1/0/4': '4516.ab87.ea91',
+                             'GigabitEthernet1/0/5': '4516.ab87.ea92'},
+                            hub_ports=('GigabitEthernet1/0/5',))
+        logins: list = []
+
+        def connect(params):
+            logins.append(params['host'])
+            return switch
+        self.addCleanup(ssh_pool._pool.clear)
+        self.addCleanup(command_timing._store.clear)
+        self.addCleanup(commit_scheduler._scheduler.clear)
+        ssh_pool._pool['instance'] = SessionPool(config, connect)
+        ports = {mac: {'vendor': 'cisco',
+                       'ip_addr': '10.0.0.1',
+                       'mac_addr': cisco_mac,
+                       'port_num': port}
+                 for port, cisco_mac in switch.ports.items()
+                 for mac in [cisco_mac.replace('.', '')]}
+        results = cisco_bulk_connection('task_1', '10.0.0.1', ports, config)
+        self.assertEqual(results, {'4516ab87ea90': 'completed',
+                                   '4516ab87ea91': 'completed',
+                                   '4516ab87ea92': 'check_max_devices'})
+        self.assertEqual(logins, ['10.0.0.1'])
+        self.assertEqual(switch.commands.count('wr mem'), 1)
+        self.assertEqual(switch.commands[-1], 'wr mem')
+
+
+class CommitSchedulerTests(unittest.TestCase):
+    """
+    Coalesced running config saves
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.addCleanup(ssh_pool._pool.clear)
+        self.config = {'proj_dir': self.tmp_dir.name + '/',
+                       'commit_delay': 1,
+                       'commit_max_wait': 5}
+        self.saves: list = []
+
+    def save(self):
+        self.saves.append(time.monotonic())
+        time.sleep(0.1)
+        return 'Building configuration...\n[OK]'
+
+    def test_coalesced_save(self):
+        """
+        Changes made within the quiet window are saved by one 'wr mem',
+        every task returns after the save
+        """
+        scheduler = CommitScheduler(self.config)
+        results: list = []
+        returned: list = []
+
+        barrier = threading.Barrier(3)
+
+        def task(delay):
+            with scheduler.writing('10.0.0.1'):
+                barrier.wait()
+                time.sleep(delay)
+                change = scheduler.mark('10.0.0.1')
+                results.append(scheduler.commit('10.0.0.1', change,
+                                                self.save))
+                returned.append(time.monotonic())
+        threads = [threading.Thread(target=task, args=(delay,))
+                   for delay in (0, 0.2, 0.4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.saves), 1)
+        self.assertEqual(sorted(results), [(False, 0), (False, 0), (True, 3)])
+        self.assertTrue(all(end > self.saves[0] for end in returned))
+        # A change after the save needs a new one,
+        # no other task is changing the switch - saved at once
+        start = time.monotonic()
+        change = scheduler.mark('10.0.0.1')
+        self.assertEqual(scheduler.commit('10.0.0.1', change, self.save),
+                         (True, 1))
+        self.assertEqual(len(self.saves), 2)
+        self.assertLess(time.monotonic() - start, 0.3)
+
+    def test_unconfirmed_save(self):
+        """
+        A save without '[OK]' fails the task, the change stays unsaved
+        """
+        scheduler = CommitScheduler(dict(self.config, commit_delay=0))
+        change = scheduler.mark('10.0.0.1')
+        with self.assertRaises(RuntimeError):
+            scheduler.commit('10.0.0.1', change, lambda: '% Error')
+        self.assertEqual(scheduler.state('10.0.0.1')[2], 0)
+        self.assertEqual(scheduler.commit('10.0.0.1', change, self.save),
+                         (True, 1))
+
+    def test_bulk_save(self):
+        """
+        A confirmed save of a bulk port clears its unsaved flag
+        """
+        self.addCleanup(commit_scheduler._scheduler.clear)
+        switch = FakeSwitch({'wr mem': 'Building configuration...\n[OK]'})
+        cisco_conn = BulkCiscoSSH({'ip_addr': '10.0.0.1',
+                                   'port_num': 'GigabitEthernet1/0/7',
+                                   'mac_addr': '4516.ab87.ea90'},
+                                  'task_1', self.config, switch)
+        cisco_conn.save()
+        self.assertTrue(cisco_conn.unsaved)
+        cisco_conn.save_config()
+        self.assertFalse(cisco_conn.unsaved)
+        self.assertEqual(switch.commands, ['wr mem'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,526 @@
+#! /usr/bin/env python3
+"""
+Bounded pool of persistent task processes
+"""
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+# Channel of the current worker process to the main process
+_channel: Dict[str, Any] = {}
+
+# Waiting time for a reply of the main process in seconds
+REPLY_TIMEOUT = 60
+
+
+class TaskCancelled(BaseException):
+    """
+    The main process has cancelled the ticket of this worker
+    (not caught by the 'except Exception' handlers of the task)
+    """
+
+
+def in_worker() -> bool:
+    """
+    Is this a worker process of the pool?
+
+    Returns:
+        (bool): True in a worker process
+    """
+    return 'events' in _channel
+
+
+def post_event(kind: str, *args: Any) -> None:
+    """
+    Sends an event from a worker process to the main process
+    (the slot number of the worker is added to the event)
+
+    Args:
+        kind (str): Event kind
+        *args: Event data
+    """
+    _channel['events'].put((kind, _channel['slot']) + args)
+
+
+def wait_reply(key: str,
+               timeout: float = REPLY_TIMEOUT,
+               default: Any = None
+               ) -> Any:
+    """
+    Waits for a reply from the main process to this worker
+    Stale replies (for tasks killed before or timed out) are skipped
+
+    Args:
+        key (str): Reply key (task tracker)
+        timeout (float): Waiting time in seconds
+        default (Any): Returned if there is no reply in time
+
+    Returns:
+        data (Any): Reply data
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return default
+        try:
+            reply_key, data = _channel['reply'].get(timeout=left)
+        except queue.Empty:
+            return default
+        if reply_key == key:
+            return data
+
+
+def check_cancelled() -> None:
+    """
+    Ends the current ticket if the main process has cancelled it
+    (called between the steps of a task, does nothing outside the pool)
+
+    Raises:
+        TaskCancelled: The ticket is cancelled
+    """
+    if not in_worker():
+        return
+    slot = _channel['slot']
+    running = _channel['running'][slot]
+    if running and _channel['cancelled'][slot] == running:
+        raise TaskCancelled(running)
+
+
+def ticket_key(args: tuple) -> int:
+    """
+    Key of a ticket for cancellation (the task ID argument)
+
+    Args:
+        args (tuple): Task function arguments
+
+    Returns:
+        (int): First integer argument or 0
+    """
+    if args and isinstance(args[0], int):
+        return args[0]
+    return 0
+
+
+def worker_loop(target: Callable,
+                tickets: Any,
+                slot: int,
+                busy: Any,
+                counters: Any,
+                max_tasks: int,
+                events: Any,
+                reply: Any,
+                running: Any,
+                cancelled: Any,
+                finished: Any
+                ) -> None:
+    """
+    Worker process main loop
+    Takes tickets from the queue of its slot until 'max_tasks' tickets
+    are done (0 - no limit), after that the pool replaces the process
+
+    Args:
+        target (Callable): Task function
+        tickets (multiprocessing.Queue): Ticket queue of this worker slot
+        slot (int): Worker slot number
+        busy (multiprocessing.Array): Start time of current task per slot
+        counters (multiprocessing.Array): Taken tickets, wait time sum,
+            max wait time
+        max_tasks (int): Number of tickets before recycling
+        events (multiprocessing.Queue): Events of this worker slot
+            to the main process
+        reply (multiprocessing.Queue): Replies to this worker slot
+        running (multiprocessing.Array): Ticket key of the current task
+            per slot
+        cancelled (multiprocessing.Array): Cancelled ticket key per slot
+        finished (multiprocessing.Array): Done tickets per slot
+    """
+    _channel.update({'slot': slot,
+                     'events': events,
+                     'reply': reply,
+                     'running': running,
+                     'cancelled': cancelled})
+    done = 0
+    while max_tasks <= 0 or done < max_tasks:
+        ticket = tickets.get()
+        # Pool shutdown
+        if ticket is None:
+            return
+        enqueued, args = ticket
+        wait = time.time() - enqueued
+        with counters.get_lock():
+            counters[0] += 1
+            counters[1] += wait
+            counters[2] = max(counters[2], wait)
+        busy[slot] = time.time()
+        running[slot] = ticket_key(args)
+        try:
+            target(*args)
+        # end_task() ends a task with sys.exit(),
+        # a cancelled task stops at the next check_cancelled()
+        except (SystemExit, TaskCancelled):
+            pass
+        finally:
+            running[slot] = 0
+            busy[slot] = 0.0
+            finished[slot] += 1
+        done += 1
+
+
+class PoolFull(RuntimeError):
+    """
+    The backlog has 'pool_queue_size' tickets, a new ticket is rejected
+    """
+
+
+class WorkerPool:
+    """
+    Tickets served by a fixed number of task processes
+    Tickets wait in the backlog of the main process, so submitting never
+    blocks the intake loop or the event handlers, the submitter thread
+    hands a ticket to a free worker
+    Each worker slot has its own queues and the shared arrays are written
+    without locks, a killed worker can not leave a lock taken for the
+    others (the queues of the slot are replaced)
+    A ticket for a switch goes to the worker that served the switch last
+    (its SSH session is reused) if it is free within 'pool_affinity_wait'
+    seconds
+    """
+    def __init__(self, target: Callable, config: dict) -> None:
+        """
+        Args:
+            target (Callable): Task function
+            config (dict): Dict with config data
+        """
+        self.target = target
+        self.size = int(config.get('pool_workers', 8))
+        self.max_tasks = int(config.get('pool_max_tasks', 20))
+        self.affinity_wait = float(config.get('pool_affinity_wait', 5))
+        self.queue_size = int(config.get('pool_queue_size', 100))
+        # Ticket, event and reply queues of each worker slot
+        self.tickets: List[Any] = [multiprocessing.Queue()
+                                   for slot in range(self.size)]
+        self.events: List[Any] = [multiprocessing.Queue()
+                                  for slot in range(self.size)]
+        self.replies: List[Any] = [multiprocessing.Queue()
+                                   for slot in range(self.size)]
+        # Each element is written by one process
+        self.busy: Any = multiprocessing.Array('d', self.size, lock=False)
+        self.running: Any = multiprocessing.Array('q', self.size, lock=False)
+        self.cancelled: Any = multiprocessing.Array('q', self.size,
+                                                    lock=False)
+        # Tickets handed to and done by each slot
+        self.sent = [0] * self.size
+        self.finished: Any = multiprocessing.Array('q', self.size,
+                                                   lock=False)
+        # Slots of killed workers (the queues are replaced)
+        self.killed: Set[int] = set()
+        # Slot that served the switch last
+        self.hosts: Dict[str, int] = {}
+        self.counters: Any = multiprocessing.Array('d', 3)
+        self.workers: List[Any] = [None] * self.size
+        self.recycled = 0
+        self.reap_interval = float(config.get('pool_reap_interval', 1))
+        self.lock = threading.Lock()
+        self.closed = False
+        # Tickets waiting for a free worker (submitter thread)
+        self.backlog: Deque[Tuple[float, str, tuple]] = collections.deque()
+        self.backlog_ready = threading.Condition()
+
+    def spawn(self, slot: int) -> None:
+        """
+        Starts a worker process in the slot
+
+        Args:
+            slot (int): Worker slot number
+        """
+        proc = multiprocessing.Process(target=worker_loop,
+                                       name='psec_worker_' + str(slot),
+                                       args=(self.target,
+                                             self.tickets[slot],
+                                             slot,
+                                             self.busy,
+                                             self.counters,
+                                             self.max_tasks,
+                                             self.events[slot],
+                                             self.replies[slot],
+                                             self.running,
+                                             self.cancelled,
+                                             self.finished))
+        proc.daemon = True
+        proc.start()
+        self.workers[slot] = proc
+
+    def start(self) -> None:
+        """
+        Starts all worker processes, the reaper and the submitter threads
+        """
+        for slot in range(self.size):
+            self.spawn(slot)
+
+        def reap() -> None:
+            while True:
+                time.sleep(self.reap_interval)
+                self.maintain()
+        threading.Thread(target=reap,
+                         name='psec_pool_reaper',
+                         daemon=True).start()
+        threading.Thread(target=self.feed,
+                         name='psec_pool_submitter',
+                         daemon=True).start()
+
+    def maintain(self) -> None:
+        """
+        Reaps finished (recycled or killed) workers and replaces them
+        """
+        with self.lock:
+            if self.closed:
+                return
+            for slot, proc in enumerate(self.workers):
+                if proc is not None and not proc.is_alive():
+                    proc.join()
+                    # Killed during a ticket - the slot is free again
+                    if self.busy[slot]:
+                        self.finished[slot] += 1
+                    self.busy[slot] = 0.0
+                    self.running[slot] = 0
+                    # The killed worker may have held a queue lock
+                    if slot in self.killed:
+                        self.killed.discard(slot)
+                        self.tickets[slot] = multiprocessing.Queue()
+                        self.events[slot] = multiprocessing.Queue()
+                        self.replies[slot] = multiprocessing.Queue()
+                    self.recycled += 1
+                    self.spawn(slot)
+
+    def full(self) -> bool:
+        """
+        Is there no room for a new ticket in the backlog?
+        (tasks going back to the pool after the locate stage
+        are always accepted)
+
+        Returns:
+            (bool): True if the backlog has 'pool_queue_size' tickets
+        """
+        with self.backlog_ready:
+            return len(self.backlog) >= self.queue_size
+
+    def submit(self, *args: Any, host: str = '') -> None:
+        """
+        Adds a ticket to the backlog (does not block)
+        The submitter thread hands it to a worker
+
+        Args:
+            *args: Task function arguments
+            host (str): Switch of the ticket ('' if not known yet)
+        """
+        with self.backlog_ready:
+            self.backlog.append((time.time(), host, args))
+            self.backlog_ready.notify()
+
+    def free_slots(self) -> List[int]:
+        """
+        Worker slots without a ticket
+
+        Returns:
+            (list): Slot numbers
+        """
+        return [slot for slot in range(self.size)
+                if self.sent[slot] == self.finished[slot]]
+
+    def dispatch(self) -> None:
+        """
+        Hands the backlog tickets to free workers in order
+        (called by the submitter thread with the backlog lock held)
+        A ticket waiting for the worker of its switch is skipped,
+        the tickets behind it go on
+        """
+        free = self.free_slots()
+        now = time.time()
+        for ticket in list(self.backlog):
+            if not free:
+                return
+            enqueued, host, args = ticket
+            owner = self.hosts.get(host) if host else None
+            if owner in free:
+                slot = owner
+            elif owner is not None and now - enqueued < self.affinity_wait:
+                continue
+            else:
+                slot = free[0]
+            self.backlog.remove(ticket)
+            free.remove(slot)
+            if host:
+                self.hosts[host] = slot
+            self.sent[slot] += 1
+            self.tickets[slot].put((enqueued, args))
+
+    def feed(self) -> None:
+        """
+        Submitter thread: hands the backlog tickets to free workers
+        (a worker has one ticket at a time)
+        """
+        while not self.closed:
+            with self.backlog_ready:
+                self.dispatch()
+                self.backlog_ready.wait(0.05)
+
+    def slot_of(self, key: int) -> Optional[int]:
+        """
+        Worker slot running the ticket
+
+        Args:
+            key (int): Ticket key (task ID)
+
+        Returns:
+            (int): Slot number
+            (None): The ticket is not running
+        """
+        for slot in range(self.size):
+            if key and self.running[slot] == key:
+                return slot
+        return None
+
+    def cancel(self, key: int, grace: float) -> bool:
+        """
+        Asks the worker running the ticket to stop (cooperative,
+        see check_cancelled()), a worker still running the same ticket
+        after 'grace' seconds is killed and replaced
+
+        Args:
+            key (int): Ticket key (task ID)
+            grace (float): Time to stop in seconds
+
+        Returns:
+            (bool): True if the ticket was running
+        """
+        slot = self.slot_of(key)
+        if slot is None:
+            return False
+        self.cancelled[slot] = key
+        timer = threading.Timer(grace, self.kill_slot, (slot, key))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def kill_slot(self, slot: int, key: int) -> None:
+        """
+        Kills the worker if it is still running the ticket
+        (the reaper replaces it)
+
+        Args:
+            slot (int): Worker slot number
+            key (int): Ticket key (task ID)
+        """
+        with self.lock:
+            proc = self.workers[slot]
+            if self.closed or proc is None or not proc.is_alive() or \
+                    self.running[slot] != key:
+                return
+            os.kill(proc.pid, signal.SIGKILL)
+            self.killed.add(slot)
+            self.running[slot] = 0
+
+    def depth(self) -> int:
+        """
+        Tickets waiting for a task process
+
+        Returns:
+            (int): Backlog tickets and tickets handed to a worker
+                but not started
+        """
+        handed = sum(max(0, self.sent[slot] - self.finished[slot] -
+                         (1 if self.busy[slot] else 0))
+                     for slot in range(self.size))
+        return handed + len(self.backlog)
+
+    def reply(self, slot: int, key: str, data: Any) -> None:
+        """
+        Sends a reply to the worker in the slot
+
+        Args:
+            slot (int): Worker slot number
+            key (str): Reply key (task tracker)
+            data (Any): Reply data
+        """
+        self.replies[slot].put((key, data))
+
+    def serve_events(self, handlers: Dict[str, Callable]) -> None:
+        """
+        Starts the threads that pass worker events to handlers
+        (one per worker slot, events of a slot are handled in order)
+        Handler gets the worker slot number and event data
+
+        Args:
+            handlers (dict): Event handlers by event kind
+        """
+        def serve(slot: int) -> None:
+            while True:
+                # The queue is replaced after a kill
+                try:
+                    kind, *args = self.events[slot].get(timeout=1)
+                except queue.Empty:
+                    continue
+                # One broken event must not stop the others ¯\_(ツ)_/¯
+                try:
+                    handlers[kind](*args)
+                except Exception:
+                    logging.exception('Worker event ' + kind + ' failed')
+        for slot in range(self.size):
+            threading.Thread(target=serve,
+                             args=(slot,),
+                             name='psec_events_' + str(slot),
+                             daemon=True).start()
+
+    def close(self, timeout: float = 10) -> None:
+        """
+        Stops all worker processes after the queued tickets are done
+
+        Args:
+            timeout (float): Waiting time for each process in seconds
+        """
+        with self.lock:
+            self.closed = True
+        # Backlog tickets are resumed from the task store after a restart
+        with self.backlog_ready:
+            self.backlog_ready.notify_all()
+        alive = [proc for proc in self.workers
+                 if proc is not None and proc.is_alive()]
+        for slot, proc in enumerate(self.workers):
+            if proc is not None and proc.is_alive():
+                self.tickets[slot].put(None)
+        for proc in alive:
+            proc.join(timeout)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+
+    def report(self) -> Dict[str, str]:
+        """
+        Pool statistics for the <REPORT> message
+
+        Returns:
+            (dict): Statistics names and values
+        """
+        with self.counters.get_lock():
+            taken, wait_sum, wait_max = self.counters[:]
+        if taken:
+            wait_avg = wait_sum / taken
+        else:
+            wait_avg = 0.0
+        active = len([start for start in self.busy[:] if start])
+        return {
+            'Pool workers': str(self.size),
+            'Pool active workers': str(active),
+            'Pool queue depth': str(self.depth()),
+            'Pool tickets taken': str(int(taken)),
+            'Pool average queue wait (s)': f'{wait_avg:.2f}',
+            'Pool max queue wait (s)': f'{wait_max:.2f}',
+            'Pool recycled workers': str(self.recycled),
+        }
@@ -4,12 +4,13 @@ Method decorators for results of procedures (device setup)
 """
 from typing import Callable
 
-from service_funcs import end_task
+from metrics import timed
 
 
 class Wrapp:
     """
     Class for handling connection methods
+    (the result ends the task through self.finish())
     """
     @staticmethod
     def failed_check(method: Callable) -> Callable:
@@ -24,12 +25,12 @@ class Wrapp:
             wrapp_failed_check (Callable): Wrapper
         """
         def wrapp_failed_check(self):
-            if not method(self):
+            with timed('psec_cisco_method_duration_seconds',
+                       method=method.__name__):
+                passed = method(self)
+            if not passed:
                 task_result = 'Task failed'
-                end_task(self.log_file_name,
-                         self.mac,
-                         task_result,
-                         self.config)
+                self.finish(task_result, method.__name__)
         return wrapp_failed_check
 
     @staticmethod
@@ -45,12 +46,12 @@ class Wrapp:
             wrapp_next_check (Callable): Wrapper
         """
         def wrapp_next_check(self):
-            if method(self):
+            with timed('psec_cisco_method_duration_seconds',
+                       method=method.__name__):
+                passed = method(self)
+            if passed:
                 task_result = 'Task completed'
-                end_task(self.log_file_name,
-                         self.mac,
-                         task_result,
-                         self.config)
+                self.finish(task_result)
         return wrapp_next_check
 
     @staticmethod
@@ -66,9 +67,12 @@ class Wrapp:
             wrapp_pass_check (Callable): Wrapper
         """
         def wrapp_pass_check(self):
-            if method(self):
+            with timed('psec_cisco_method_duration_seconds',
+                       method=method.__name__):
+                passed = method(self)
+            if passed:
                 task_result = 'Task completed'
             else:
                 task_result = 'Task failed'
-            end_task(self.log_file_name, self.mac, task_result, self.config)
+            self.finish(task_result, method.__name__)
         return wrapp_pass_check